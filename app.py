@@ -1,17 +1,48 @@
 # app.py
 
 import os
+import sys
 import json
 import hashlib
+import hmac
+import re
+import math
 import uuid
 import functools
 import datetime
 import threading
-from flask import Flask, send_from_directory, jsonify, url_for, request, session, redirect, render_template, Response
+import io
+import collections
+import concurrent.futures
+import array
+import unicodedata
+import itertools
+import copy
+import tempfile
+import gzip
+import bisect
+import contextlib
+import sqlite3
+import time
+import subprocess
+import shutil
+import queue
+import base64
+import urllib.parse
+import random
+import heapq
+import atexit
+from flask import Flask, send_from_directory, jsonify, url_for, request, session, redirect, render_template, Response, g
 from dotenv import load_dotenv
 from mutagen import File as MutagenFile
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from werkzeug.security import safe_join, generate_password_hash, check_password_hash
+
+try:
+    from PIL import Image  # サムネイル生成用 (任意)
+except ImportError:
+    Image = None
 
 # .envファイルをロード
 load_dotenv()
@@ -21,11 +52,138 @@ app.secret_key = os.environ.get('SECRET_KEY', 'dev_secret_key_change_in_producti
 app.config['SESSION_TYPE'] = 'filesystem'
 app.config['PERMANENT_SESSION_LIFETIME'] = datetime.timedelta(days=7)
 
-# アルバムアートのキャッシュ (メモリ上)
-album_art_cache = {}
+# Prometheus 形式のメトリクス (/metrics)
+# 値はプロセスごとに持つ (本番モードで複数ワーカーの場合は、応答したワーカーの値になる)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOCK_BUCKETS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+metrics_registry = []
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        """callback を指定すると出力時に値を読む。ラベルがあれば {ラベル値のタプル: 値} を返す関数"""
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.callback = callback
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def label_key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        if self.callback is None:
+            with self.lock:
+                return list(self.values.items())
+        value = self.callback()
+        return list(value.items()) if isinstance(value, dict) else [((), value)]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.samples():
+            if value is not None:
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {float(value):g}")
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.label_key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            entries = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        for key, counts, total, count in entries:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total:g}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+lock_wait_seconds = Histogram('music_lock_wait_seconds', 'Time spent waiting to acquire a lock', ['lock'], LOCK_BUCKETS)
+lock_hold_seconds = Histogram('music_lock_hold_seconds', 'Time a lock was held', ['lock'], LOCK_BUCKETS)
+
+class InstrumentedLock:
+    """待ち時間と保持時間を記録する Lock"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_at = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = time.perf_counter()
+            lock_wait_seconds.observe(self.acquired_at - started, lock=self.name)
+        return acquired
+
+    def release(self):
+        held = time.perf_counter() - self.acquired_at
+        self.lock.release()
+        lock_hold_seconds.observe(held, lock=self.name)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
 
 # スレッドセーフのためのロック
-structure_lock = threading.Lock()
+structure_lock = InstrumentedLock('structure')
 
 # ディレクトリ設定
 MUSIC_DIR = os.environ.get('MUSIC_DIR', 'static/music')  # 音楽ファイルが保存されているディレクトリへのパス
@@ -36,37 +194,240 @@ if os.name == 'posix' and MUSIC_DIR.startswith(('C:\\', 'c:\\')):
 
 USERS_DIR = 'users'  # ユーザー情報を保存するディレクトリ
 MUSIC_STRUCTURE_FILE = 'music_structure.json'
+LIBRARY_DB_FILE = os.environ.get('LIBRARY_DB_FILE', 'library.db')  # ライブラリインデックスの保存先
+
+SUPPORTED_EXTENSIONS = ('.mp3', '.wav', '.flac', '.ogg', '.m4a')
+# フォルダ単位のアルバムアート (優先順)
+FOLDER_COVER_NAMES = ('cover.jpg', 'cover.jpeg', 'cover.png', 'folder.jpg', 'folder.jpeg', 'folder.png', 'front.jpg', 'front.png')
+LYRICS_EXTENSION = '.lrc'  # 曲と同じ名前で置かれた歌詞ファイル
+UNKNOWN_ALBUM = "アルバム不明"
 
 # ディレクトリが存在しない場合は作成
 os.makedirs(USERS_DIR, exist_ok=True)
 os.makedirs(MUSIC_DIR, exist_ok=True)
 
+# アルバムアートのキャッシュ設定
+ALBUM_ART_CACHE_DIR = os.environ.get('ALBUM_ART_CACHE_DIR', os.path.join('cache', 'album_art'))
+ALBUM_ART_MEMORY_BYTES = int(os.environ.get('ALBUM_ART_MEMORY_MB', 64)) * 1024 * 1024
+ALBUM_ART_DISK_BYTES = int(os.environ.get('ALBUM_ART_DISK_MB', 1024)) * 1024 * 1024
+THUMBNAIL_SIZES = (64, 256, 512)
+ALBUM_ART_MAX_AGE = int(os.environ.get('ALBUM_ART_MAX_AGE', 7 * 24 * 3600))  # ブラウザにキャッシュさせる秒数
+
+# 音声配信の設定
+STREAM_CHUNK_BYTES = 256 * 1024
+STREAM_MAX_AGE = int(os.environ.get('STREAM_MAX_AGE', 24 * 3600))  # ブラウザにキャッシュさせる秒数
+STREAM_PREFETCH_BYTES = int(os.environ.get('STREAM_PREFETCH_MB', 8)) * 1024 * 1024  # 次の曲を先読みする量
+STREAM_PREFETCH_TTL = 60  # 同じ曲を続けて先読みしない秒数
+
+# トランスコードの設定
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+TRANSCODE_CACHE_DIR = os.environ.get('TRANSCODE_CACHE_DIR', os.path.join('cache', 'transcode'))
+TRANSCODE_CACHE_BYTES = int(os.environ.get('TRANSCODE_CACHE_MB', 2048)) * 1024 * 1024
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', max(1, (os.cpu_count() or 1) // 2)))  # 同時に動かすエンコーダーの数
+TRANSCODE_WAIT_SECONDS = 10  # エンコーダーの空きを待つ最大時間
+
+# タグ情報 (メタデータカタログ) の読み取りに使うスレッド数
+METADATA_WORKERS = int(os.environ.get('METADATA_WORKERS', min(8, (os.cpu_count() or 1) * 2)))
+
+# 重複検出用に音声データをハッシュするスレッド数 (ディスクの読み込みが中心なので少なめ)
+FINGERPRINT_WORKERS = int(os.environ.get('FINGERPRINT_WORKERS', 2))
+
+# フォルダ監視の設定 (秒)
+WATCHDOG_QUIET_SECONDS = float(os.environ.get('WATCHDOG_QUIET_SECONDS', 2.0))  # 最後のイベントからこの時間静かになったら反映
+WATCHDOG_MAX_DELAY_SECONDS = float(os.environ.get('WATCHDOG_MAX_DELAY_SECONDS', 30.0))  # イベントが続いても最大でこの時間で反映
+
+# ユーザーファイルを読み直すか確認する間隔 (秒)。アプリ外での編集はこの間隔で反映される
+USER_CACHE_CHECK_SECONDS = float(os.environ.get('USER_CACHE_CHECK_SECONDS', 2.0))
+
+# パスワードのハッシュ化 (PBKDF2-SHA256) の反復回数。変更するとログイン時に新しい回数でハッシュし直す
+PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 600000))
+
 # 管理者情報の初期設定
 ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'pass0000')
 
+# 複数ワーカーで動かすときのプロセス間のロック
+FILE_LOCK_DIR = os.path.join('cache', 'locks')
+
+@contextlib.contextmanager
+def process_file_lock(name):
+    """ワーカー間で共有するロックファイル (cache/locks/<name>.lock) を排他的に取る"""
+    os.makedirs(FILE_LOCK_DIR, exist_ok=True)
+    with open(os.path.join(FILE_LOCK_DIR, f"{name}.lock"), 'a+') as lock_file:
+        if os.name == 'nt':
+            import msvcrt
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK は10秒ほどで諦めるので取れるまで繰り返す
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+# ユーザーのプレイリスト (users/<name>.json) の読み書き。ログイン情報はライブラリDBの users テーブルにある
+# 読み込んだ内容はメモリにキャッシュし、ファイルの mtime が変わったときだけ読み直す。
+# 書き込みはユーザー単位のロック (ワーカー間はロックファイル) の中で一時ファイルに書いてから置き換える
+class UserStore:
+    def __init__(self, users_dir, check_seconds):
+        self.users_dir = users_dir
+        self.check_seconds = check_seconds
+        self.cache = {}  # {username: {"mtime": ..., "checked": ..., "data": {...}}}
+        self.user_locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def user_file(self, username):
+        if not username or not isinstance(username, str) or username != os.path.basename(username) \
+                or username.startswith('.'):
+            return None
+        return os.path.join(self.users_dir, f"{username}.json")
+
+    def get(self, username):
+        """ユーザー情報を返す (存在しなければ None)。返した dict は変更しないこと"""
+        user_file = self.user_file(username)
+        if user_file is None:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(username)
+        if entry is not None and now - entry['checked'] < self.check_seconds:
+            return entry['data']
+
+        try:
+            mtime = os.stat(user_file).st_mtime
+        except OSError:
+            with self.lock:
+                self.cache.pop(username, None)
+            return None
+        if entry is None or entry['mtime'] != mtime:
+            with open(user_file, 'r', encoding='utf-8') as file_handle:
+                entry = {"mtime": mtime, "data": json.load(file_handle)}
+        entry = dict(entry, checked=now)
+        with self.lock:
+            self.cache[username] = entry
+        return entry['data']
+
+    def exists(self, username):
+        return self.get(username) is not None
+
+    def usernames(self):
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.users_dir) if f.endswith('.json'))
+
+    def write(self, username, data):
+        user_file = self.user_file(username)
+        fd, tmp_file = tempfile.mkstemp(dir=self.users_dir, prefix=f".{username}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file_handle:
+                json.dump(data, file_handle, ensure_ascii=False, indent=2)
+                file_handle.flush()
+                os.fsync(file_handle.fileno())
+            os.replace(tmp_file, user_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        with self.lock:
+            self.cache[username] = {"mtime": os.stat(user_file).st_mtime, "checked": time.monotonic(), "data": data}
+
+    def create(self, username, data):
+        """新規ユーザーを保存する。既に存在する場合は False"""
+        if self.user_file(username) is None:
+            raise ValueError("Invalid username")
+        with self.user_locks[username], process_file_lock(f"user.{username}"):
+            if os.path.exists(self.user_file(username)):
+                return False
+            self.write(username, data)
+            return True
+
+    def update(self, username, mutate):
+        """ユーザー情報のコピーを mutate(data) で変更して保存し、mutate の戻り値を返す。
+        mutate が False を返した場合は保存しない。ユーザーがいなければ None を返す"""
+        with self.user_locks[username], process_file_lock(f"user.{username}"):
+            with self.lock:
+                self.cache.pop(username, None)  # 最新の内容から変更する
+            data = self.get(username)
+            if data is None:
+                return None
+            data = copy.deepcopy(data)
+            changed = mutate(data)
+            if changed is not False:
+                self.write(username, data)
+            return changed
+
+user_store = UserStore(USERS_DIR, USER_CACHE_CHECK_SECONDS)
+
 # ユーザー管理関数
+LEGACY_HASH_PREFIX = 'legacy-sha256$'  # 旧形式 sha256(パスワード + salt) を移行したもの
+
+def hash_password(password):
+    return generate_password_hash(password, method=f'pbkdf2:sha256:{PASSWORD_HASH_ITERATIONS}')
+
+def verify_password(password_hash, password):
+    if password_hash.startswith(LEGACY_HASH_PREFIX):
+        salt, _, digest = password_hash[len(LEGACY_HASH_PREFIX):].partition('$')
+        return hmac.compare_digest(hashlib.sha256((password + salt).encode()).hexdigest().encode(), digest.encode())
+    return check_password_hash(password_hash, password)
+
+def password_needs_rehash(password_hash):
+    return not password_hash.startswith(f'pbkdf2:sha256:{PASSWORD_HASH_ITERATIONS}$')
+
+def get_credentials(username):
+    """(password_hash, is_admin) を返す。ユーザーがいなければ None"""
+    with library_db() as conn:
+        row = conn.execute('SELECT password_hash, is_admin FROM users WHERE username = ?', (username,)).fetchone()
+    return (row[0], bool(row[1])) if row else None
+
+def create_account(username, password, is_admin):
+    """ログイン情報とプレイリスト用のユーザーファイルを作る。既に存在する場合は False"""
+    try:
+        with library_db() as conn:
+            conn.execute('INSERT INTO users (username, password_hash, is_admin, created) VALUES (?, ?, ?, ?)',
+                         (username, hash_password(password), int(bool(is_admin)), time.time()))
+    except sqlite3.IntegrityError:
+        return False
+    user_store.create(username, {"username": username, "playlists": {}})
+    return True
+
+def import_user_files():
+    """旧形式の users/<name>.json にあるログイン情報をDBに移し、ファイルにはプレイリストだけを残す"""
+    for username in user_store.usernames():
+        user_data = user_store.get(username)
+        if not user_data or 'password_hash' not in user_data:
+            continue
+        password_hash = f"{LEGACY_HASH_PREFIX}{user_data.get('salt', '')}${user_data['password_hash']}"
+        with library_db() as conn:
+            conn.execute('INSERT OR IGNORE INTO users (username, password_hash, is_admin, created) VALUES (?, ?, ?, ?)',
+                         (username, password_hash, int(bool(user_data.get('is_admin', False))), time.time()))
+
+        def strip_credentials(data):
+            for key in ('password_hash', 'salt', 'is_admin'):
+                data.pop(key, None)
+        user_store.update(username, strip_credentials)
+        print(f"Migrated user to the credential store: {username}")
+
 def init_admin_user():
     """管理者ユーザーの初期設定"""
-    admin_file = os.path.join(USERS_DIR, f"{ADMIN_USERNAME}.json")
-    
-    if not os.path.exists(admin_file):
-        salt = uuid.uuid4().hex
-        hashed_password = hashlib.sha256((ADMIN_PASSWORD + salt).encode()).hexdigest()
-        
-        admin_data = {
-            "username": ADMIN_USERNAME,
-            "password_hash": hashed_password,
-            "salt": salt,
-            "is_admin": True,
-            "playlists": {}
-        }
-        
-        with open(admin_file, 'w', encoding='utf-8') as f:
-            json.dump(admin_data, f, ensure_ascii=False, indent=2)
-        
+    if get_credentials(ADMIN_USERNAME) is None and create_account(ADMIN_USERNAME, ADMIN_PASSWORD, True):
         print(f"Admin user created: {ADMIN_USERNAME}")
 
+def session_is_admin():
+    """権限はログイン時に署名付きセッションに入れておく (古いセッションは一度だけDBから引いて入れる)"""
+    if 'is_admin' not in session:
+        credentials = get_credentials(session['user_id'])
+        session['is_admin'] = credentials is not None and credentials[1]
+    return session['is_admin']
+
 # 認証デコレータ
 def login_required(func):
     @functools.wraps(func)
@@ -82,14 +443,7 @@ def admin_required(func):
         if 'user_id' not in session:
             return jsonify({"error": "Unauthorized", "redirect": "/login"}), 401
         
-        user_file = os.path.join(USERS_DIR, f"{session['user_id']}.json")
-        if not os.path.exists(user_file):
-            return jsonify({"error": "User not found"}), 404
-        
-        with open(user_file, 'r', encoding='utf-8') as file_handle:  # 変数名を変更
-            user_data = json.load(file_handle)
-        
-        if not user_data.get('is_admin', False):
+        if not session_is_admin():
             return jsonify({"error": "Forbidden", "message": "Admin access required"}), 403
         
         return func(*args, **kwargs)
@@ -100,17 +454,10 @@ def auth_status():
     if 'user_id' not in session:
         return jsonify({"isAuthenticated": False})
     
-    user_file = os.path.join(USERS_DIR, f"{session['user_id']}.json")
-    is_admin = False
-    if os.path.exists(user_file):
-        with open(user_file, 'r', encoding='utf-8') as f:
-            user_data = json.load(f)
-            is_admin = user_data.get('is_admin', False)
-            
     return jsonify({
         "isAuthenticated": True,
         "username": session['user_id'],
-        "isAdmin": is_admin
+        "isAdmin": session_is_admin()
     })
 
 # 認証ルート
@@ -121,19 +468,19 @@ def login():
         username = data.get('username')
         password = data.get('password')
         
-        user_file = os.path.join(USERS_DIR, f"{username}.json")
+        credentials = get_credentials(username) if isinstance(username, str) else None
         
-        if not os.path.exists(user_file):
+        if credentials is None or not password:
             return jsonify({"error": "Invalid credentials"}), 401
         
-        with open(user_file, 'r', encoding='utf-8') as file_handle:  # 変数名を変更
-            user_data = json.load(file_handle)
-        
-        salt = user_data.get('salt', '')
-        hashed_password = hashlib.sha256((password + salt).encode()).hexdigest()
-        
-        if user_data.get('password_hash') == hashed_password:
+        password_hash, is_admin = credentials
+        if verify_password(password_hash, password):
+            if password_needs_rehash(password_hash):
+                # 旧形式や反復回数が古いハッシュは、平文が手元にあるこの時点で作り直す
+                with library_db() as conn:
+                    conn.execute('UPDATE users SET password_hash = ? WHERE username = ?', (hash_password(password), username))
             session['user_id'] = username
+            session['is_admin'] = is_admin
             session.permanent = True
             return jsonify({"success": True, "redirect": "/"})
         
@@ -145,6 +492,7 @@ def login():
 @app.route('/logout')
 def logout():
     session.pop('user_id', None)
+    session.pop('is_admin', None)
     return redirect('/login')
 
 # 管理者ルート
@@ -155,16 +503,9 @@ def admin_panel():
 @app.route('/api/users', methods=['GET'])
 @admin_required
 def get_users():
-    users = []
-    for filename in os.listdir(USERS_DIR):
-        if filename.endswith('.json'):
-            username = os.path.splitext(filename)[0]
-            with open(os.path.join(USERS_DIR, filename), 'r', encoding='utf-8') as file_handle:
-                user_data = json.load(file_handle)
-                users.append({
-                    "username": username,
-                    "is_admin": user_data.get('is_admin', False)
-                })
+    with library_db() as conn:
+        rows = conn.execute('SELECT username, is_admin FROM users ORDER BY username').fetchall()
+    users = [{"username": username, "is_admin": bool(is_admin)} for username, is_admin in rows]
     
     return jsonify(users)
 
@@ -179,206 +520,2641 @@ def create_user():
     if not username or not password:
         return jsonify({"error": "Username and password are required"}), 400
     
-    user_file = os.path.join(USERS_DIR, f"{username}.json")
+    if user_store.user_file(username) is None:
+        return jsonify({"error": "Invalid username"}), 400
     
-    if os.path.exists(user_file):
+    if not create_account(username, password, is_admin):
         return jsonify({"error": "User already exists"}), 409
     
-    salt = uuid.uuid4().hex
-    hashed_password = hashlib.sha256((password + salt).encode()).hexdigest()
-    
-    user_data = {
-        "username": username,
-        "password_hash": hashed_password,
-        "salt": salt,
-        "is_admin": is_admin,
-        "playlists": {}
-    }
-    
-    with open(user_file, 'w', encoding='utf-8') as file_handle:
-        json.dump(user_data, file_handle, ensure_ascii=False, indent=2)
-    
     return jsonify({"success": True, "username": username})
 
-# 音楽構造をJSONファイルに保存する関数
-def save_music_structure_to_json(directory):
+# ライブラリインデックス
+# MUSIC_DIR を アーティスト/アルバム の深さまで走査した結果をディレクトリ単位で保持し、
+# 変更があったサブツリーだけを再走査してメモリ上の構造とDBに差分を反映する
+library_dirs = {}  # {"" / "Artist" / "Artist/Album": {"mtime": ..., "files": {name: (size, mtime)}, "subdirs": set(), "cover": name,
+                  #                                    "lyrics": {.lrc のファイル名: mtime}}}
+music_structure = {}  # {アーティスト: {アルバム: [曲ファイル名, ...]}}
+
+# インデックス更新 (走査〜反映) を直列化するロック。読み取り側は structure_lock だけを使う
+library_update_lock = threading.Lock()
+library_stats = {"full_rescans": 0, "subtree_rescans": 0}
+library_scan_seconds = Histogram('music_library_scan_seconds', 'Time to scan and apply a library subtree', ['kind'],
+                                 (0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+library_listener_seconds = Histogram('music_library_listener_seconds',
+                                     'Time to rebuild derived indexes after a library change', ['listener'])
+
+# 走査・フォルダ監視・タグ読み取りを担当するプロセスか (複数ワーカー時は1プロセスだけ)
+background_owner = False
+# このプロセスが取り込んだ library_changes の世代
+library_generation = 0
+# 他のプロセスの変更をどこまで読んだか。このプロセス自身が書いた世代は読むときに飛ばす
+library_synced_generation = 0
+own_library_changes = set()
+LIBRARY_CHANGES_KEEP = 1000  # 変更履歴を残す世代数
+
+# /music_structure 用のスナップショット。更新のたびに丸ごと差し替える
+# {"version": n, "etag": 内容のハッシュ, "body": JSONのbytes, "gzip": 圧縮済みbytes, "artists": ソート済みアーティスト名}
+library_snapshot = None
+
+# ライブラリ変更時に呼ばれるコールバック (引数は変更内容。None は全体の再読み込み)
+library_listeners = []
+
+def on_library_changed(func):
+    library_listeners.append(func)
+    return func
+
+def notify_library_changed(changes):
+    if changes is not None and not any(changes.values()) and library_snapshot is not None:
+        return
+    with library_listener_seconds.time(listener='publish_music_structure'):
+        publish_music_structure()
+    for listener in library_listeners:
+        try:
+            with library_listener_seconds.time(listener=listener.__name__):
+                listener(changes)
+        except Exception as e:
+            print(f"Error in library listener {listener.__name__}: {e}")
+
+LIBRARY_DB_MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS dirs (
+        path TEXT PRIMARY KEY,
+        mtime REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS tracks (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS album_art (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        digest TEXT,
+        mime TEXT
+    );
+    """,
+    """
+    ALTER TABLE dirs ADD COLUMN cover TEXT;
+    """,
+    """
+    ALTER TABLE tracks ADD COLUMN title TEXT;
+    ALTER TABLE tracks ADD COLUMN tag_artist TEXT;
+    ALTER TABLE tracks ADD COLUMN tag_album TEXT;
+    ALTER TABLE tracks ADD COLUMN genre TEXT;
+    ALTER TABLE tracks ADD COLUMN track_no INTEGER;
+    ALTER TABLE tracks ADD COLUMN disc_no INTEGER;
+    ALTER TABLE tracks ADD COLUMN year INTEGER;
+    ALTER TABLE tracks ADD COLUMN duration REAL;
+    ALTER TABLE tracks ADD COLUMN bitrate INTEGER;
+    ALTER TABLE tracks ADD COLUMN codec TEXT;
+    ALTER TABLE tracks ADD COLUMN has_art INTEGER;
+    -- タグを読み取った時点のファイルの (size, mtime)。一致している間は読み直さない
+    ALTER TABLE tracks ADD COLUMN tagged_size INTEGER;
+    ALTER TABLE tracks ADD COLUMN tagged_mtime REAL;
+    """,
+    """
+    -- 複数ワーカーで動かすとき、他のプロセスが変更を取り込むための変更履歴
+    -- kind: 'scan' (path は再走査したサブツリー) / 'tags' (path はタグを更新した曲のJSON配列)
+    CREATE TABLE IF NOT EXISTS library_changes (
+        generation INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        path TEXT NOT NULL
+    );
+    """,
+    """
+    -- 分割アップロードの状態。どのワーカーに届いたチャンクでも続きを受け付けられるようDBに置く
+    -- uploads.status: 'uploading' / 'done' / 'duplicate' (同じ内容のファイルが既にある) / 'failed' / 'cancelled'
+    CREATE TABLE IF NOT EXISTS upload_batches (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        created REAL NOT NULL,
+        status TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS uploads (
+        id TEXT PRIMARY KEY,
+        batch TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        sha1 TEXT,
+        updated REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS uploads_batch ON uploads (batch);
+    """,
+    """
+    -- タグを除いた音声データのハッシュ (重複検出用) と、計算した時点のファイルの (size, mtime)
+    ALTER TABLE tracks ADD COLUMN fingerprint TEXT;
+    ALTER TABLE tracks ADD COLUMN fingerprint_size INTEGER;
+    ALTER TABLE tracks ADD COLUMN fingerprint_mtime REAL;
+    CREATE INDEX IF NOT EXISTS tracks_fingerprint ON tracks (fingerprint);
+    """,
+    """
+    -- メタデータの一括編集ジョブの進み具合 (status: 'queued' / 'running' / 'done' / 'failed')
+    CREATE TABLE IF NOT EXISTS metadata_jobs (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        status TEXT NOT NULL,
+        total INTEGER NOT NULL,
+        completed INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        errors TEXT,
+        created REAL NOT NULL,
+        finished REAL
+    );
+    """,
+    """
+    -- 起動時の照合の進み具合など、ワーカー間で共有する小さな状態 (値はJSON)
+    CREATE TABLE IF NOT EXISTS library_state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """,
+    """
+    -- 曲がライブラリに追加された日時 (初めてインデックスに載ったときのファイルの更新日時)
+    ALTER TABLE tracks ADD COLUMN added REAL;
+    UPDATE tracks SET added = mtime;
+    """,
+    """
+    -- ログイン情報 (プレイリストは users/<name>.json のまま)
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password_hash TEXT NOT NULL,
+        is_admin INTEGER NOT NULL DEFAULT 0,
+        created REAL NOT NULL
+    );
+    """,
+    """
+    -- プレイリストが曲を tracks.id で参照するので、削除した曲の id を使い回さないよう AUTOINCREMENT にする
+    CREATE TABLE tracks_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        path TEXT NOT NULL UNIQUE,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        title TEXT,
+        tag_artist TEXT,
+        tag_album TEXT,
+        genre TEXT,
+        track_no INTEGER,
+        disc_no INTEGER,
+        year INTEGER,
+        duration REAL,
+        bitrate INTEGER,
+        codec TEXT,
+        has_art INTEGER,
+        tagged_size INTEGER,
+        tagged_mtime REAL,
+        fingerprint TEXT,
+        fingerprint_size INTEGER,
+        fingerprint_mtime REAL,
+        added REAL
+    );
+    INSERT INTO tracks_new (id, path, size, mtime, title, tag_artist, tag_album, genre, track_no, disc_no, year, duration, bitrate, codec, has_art, tagged_size, tagged_mtime, fingerprint, fingerprint_size, fingerprint_mtime, added)
+        SELECT id, path, size, mtime, title, tag_artist, tag_album, genre, track_no, disc_no, year, duration, bitrate, codec, has_art, tagged_size, tagged_mtime, fingerprint, fingerprint_size, fingerprint_mtime, added FROM tracks;
+    DROP TABLE tracks;
+    ALTER TABLE tracks_new RENAME TO tracks;
+    CREATE INDEX IF NOT EXISTS tracks_fingerprint ON tracks (fingerprint);
+    """,
+    """
+    -- 再生履歴 (追記のみ。古い記録は PLAY_HISTORY_DAYS を過ぎたら消す) と、まとめて足し込む再生回数
+    CREATE TABLE IF NOT EXISTS plays (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        track_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        played_at REAL NOT NULL,
+        duration REAL
+    );
+    CREATE INDEX IF NOT EXISTS plays_user_time ON plays (username, played_at);
+    CREATE INDEX IF NOT EXISTS plays_time ON plays (played_at);
+    CREATE TABLE IF NOT EXISTS play_counts (
+        username TEXT NOT NULL,
+        track_id INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        last_played REAL NOT NULL,
+        PRIMARY KEY (username, track_id)
+    );
+    CREATE INDEX IF NOT EXISTS play_counts_last ON play_counts (username, last_played);
+    CREATE INDEX IF NOT EXISTS play_counts_count ON play_counts (username, count);
+    CREATE TABLE IF NOT EXISTS artist_play_counts (
+        username TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        last_played REAL NOT NULL,
+        PRIMARY KEY (username, artist)
+    );
+    """,
+    """
+    -- フォルダ内の .lrc ファイル ({ファイル名: mtime} のJSON)
+    ALTER TABLE dirs ADD COLUMN lyrics TEXT;
+    """,
+]
+
+@contextlib.contextmanager
+def library_db():
+    conn = sqlite3.connect(LIBRARY_DB_FILE, timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def init_library_db():
+    """ライブラリDBのスキーマを最新に更新"""
+    with library_db() as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for i, script in enumerate(LIBRARY_DB_MIGRATIONS[version:], start=version + 1):
+            conn.executescript(script)
+            conn.execute(f'PRAGMA user_version = {i}')
+
+def to_rel_path(path):
+    """MUSIC_DIR からの相対パス (区切りは '/') を返す。MUSIC_DIR の外なら None"""
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(MUSIC_DIR)).replace('\\', '/')
+    if rel == '.':
+        return ''
+    if rel == '..' or rel.startswith('../'):
+        return None
+    return rel
+
+def track_location(rel_path):
+    """曲の相対パスから (アーティスト, アルバム, 曲ファイル名) を返す"""
+    parts = rel_path.split('/')
+    if len(parts) == 2:  # アーティスト直下に曲がある場合
+        return parts[0], UNKNOWN_ALBUM, parts[1]
+    return parts[0], parts[1], parts[2]
+
+def iter_tree_files(tree):
+    for rel_dir, entry in tree.items():
+        for name, stat in entry['files'].items():
+            yield f"{rel_dir}/{name}", stat
+
+def scan_library_dir(scope, known=None):
+    """scope 以下を アーティスト/アルバム の深さまで走査してディレクトリ単位のツリーを返す。
+    known (前回のツリー) を渡すと、mtime が変わっていないディレクトリは中身を読まずに前回の結果を使う"""
+    tree = {}
+    pending = [scope]
+    while pending:
+        rel_dir = pending.pop()
+        full_dir = os.path.join(MUSIC_DIR, rel_dir) if rel_dir else MUSIC_DIR
+        depth = rel_dir.count('/') + 1 if rel_dir else 0
+        try:
+            mtime = os.stat(full_dir).st_mtime
+            previous = known.get(rel_dir) if known else None
+            if previous is not None and previous['mtime'] == mtime:
+                tree[rel_dir] = {"mtime": mtime, "files": dict(previous['files']), "subdirs": set(previous['subdirs']),
+                                 "cover": previous['cover'], "lyrics": dict(previous['lyrics'])}
+                pending.extend(f"{rel_dir}/{name}" if rel_dir else name for name in previous['subdirs'])
+                continue
+            with os.scandir(full_dir) as it:
+                entries = list(it)
+        except OSError:
+            continue  # 削除済み、またはディレクトリではない
+
+        entry = tree[rel_dir] = {"mtime": mtime, "files": {}, "subdirs": set(), "cover": None, "lyrics": {}}
+        for dir_entry in entries:
+            if dir_entry.name.startswith('.'):
+                continue  # アップロード中の一時ファイル (.uploads) や ._* などの隠しファイル
+            try:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    if depth < 2:
+                        entry['subdirs'].add(dir_entry.name)
+                        pending.append(f"{rel_dir}/{dir_entry.name}" if rel_dir else dir_entry.name)
+                elif depth >= 1 and dir_entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    stat = dir_entry.stat()
+                    entry['files'][dir_entry.name] = (stat.st_size, stat.st_mtime)
+                elif depth >= 1 and dir_entry.name.lower() in FOLDER_COVER_NAMES:
+                    if entry['cover'] is None or \
+                            FOLDER_COVER_NAMES.index(dir_entry.name.lower()) < FOLDER_COVER_NAMES.index(entry['cover'].lower()):
+                        entry['cover'] = dir_entry.name
+                elif depth >= 1 and dir_entry.name.lower().endswith(LYRICS_EXTENSION):
+                    entry['lyrics'][dir_entry.name] = dir_entry.stat().st_mtime
+            except OSError:
+                continue
+    return tree
+
+def collect_library_subtree(scope):
+    subtree = {}
+    pending = [scope]
+    while pending:
+        rel_dir = pending.pop()
+        entry = library_dirs.get(rel_dir)
+        if entry is None:
+            continue
+        subtree[rel_dir] = entry
+        pending.extend(f"{rel_dir}/{name}" if rel_dir else name for name in entry['subdirs'])
+    return subtree
+
+def add_to_structure(rel_path):
+    artist, album, song = track_location(rel_path)
+    songs = music_structure.setdefault(artist, {}).setdefault(album, [])
+    index = bisect.bisect_left(songs, song)
+    if index == len(songs) or songs[index] != song:
+        songs.insert(index, song)
+
+def remove_from_structure(rel_path):
+    artist, album, song = track_location(rel_path)
+    albums = music_structure.get(artist, {})
+    songs = albums.get(album, [])
+    if song in songs:
+        songs.remove(song)
+    if not songs:
+        albums.pop(album, None)
+    if not albums:
+        music_structure.pop(artist, None)
+
+def record_library_change(conn, kind, path):
+    global library_generation
+    library_generation = conn.execute(
+        'INSERT INTO library_changes (kind, path) VALUES (?, ?)', (kind, path)).lastrowid
+    own_library_changes.add(library_generation)  # コミット前に登録し、同期で二重に取り込まないようにする
+    conn.execute('DELETE FROM library_changes WHERE generation <= ?', (library_generation - LIBRARY_CHANGES_KEEP,))
+
+def find_moved_tracks(removed, added):
+    """消えた曲と現れた曲を (size, mtime, 拡張子) で対応付け、移動・名前変更とみなせるものを {新しいパス: 元のパス} で返す"""
+    by_stat = {}
+    for path, stat in sorted(removed.items()):
+        by_stat.setdefault((*stat, os.path.splitext(path)[1].lower()), []).append(path)
+    moved = {}
+    for path, stat in sorted(added.items()):
+        candidates = by_stat.get((*stat, os.path.splitext(path)[1].lower()))
+        if candidates:
+            moved[path] = candidates.pop(0)
+    return moved
+
+def apply_library_scan(scope, tree, persist=True, moved=None):
+    """走査結果をメモリ上のインデックスとDBに反映し、変更されたパスを返す。
+    persist=False のときはDBから読んだツリーをメモリに反映するだけ。
+    移動した曲は tracks の行のパスを書き換えて id を引き継ぐ (moved はまとめて走査したときの {新しいパス: 元のパス})"""
     with structure_lock:
-        music_structure = {}
-        supported_extensions = ('.mp3', '.wav', '.flac', '.ogg', '.m4a')
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                if file.lower().endswith(supported_extensions):
-                    # 相対パスを取得し、バックスラッシュをスラッシュに統一してから分割
-                    rel_path = os.path.relpath(root, start=directory)
-                    artist_album = rel_path.replace('\\', '/').split('/')
-                    
-                    if len(artist_album) == 1:  # アーティスト直下に曲がある場合
-                        artist = artist_album[0]
-                        album = "アルバム不明"
-                        if artist not in music_structure:
-                            music_structure[artist] = {}
-                        if album not in music_structure[artist]:
-                            music_structure[artist][album] = []
-                        music_structure[artist][album].append(file)
-                    elif len(artist_album) == 2:  # アーティスト/アルバムの構造を想定
-                        artist, album = artist_album
-                        if artist not in music_structure:
-                            music_structure[artist] = {}
-                        if album not in music_structure[artist]:
-                            music_structure[artist][album] = []
-                        music_structure[artist][album].append(file)
-        
-        with open(MUSIC_STRUCTURE_FILE, 'w', encoding='utf-8') as outfile:
-            json.dump(music_structure, outfile, ensure_ascii=False)
+        old_tree = collect_library_subtree(scope)
+        old_files = dict(iter_tree_files(old_tree))
+        new_files = dict(iter_tree_files(tree))
+
+        changes = {
+            "added": sorted(p for p in new_files if p not in old_files),
+            "removed": sorted(p for p in old_files if p not in new_files),
+            "modified": sorted(p for p, stat in new_files.items() if p in old_files and old_files[p] != stat),
+        }
+
+        for rel_dir in old_tree:
+            del library_dirs[rel_dir]
+        library_dirs.update(tree)
+        if scope:
+            parent, _, name = scope.rpartition('/')
+            if parent in library_dirs:
+                if scope in tree:
+                    library_dirs[parent]['subdirs'].add(name)
+                else:
+                    library_dirs[parent]['subdirs'].discard(name)
+
+        for rel_path in changes['removed']:
+            remove_from_structure(rel_path)
+        for rel_path in changes['added']:
+            add_to_structure(rel_path)
+
+    if not persist:
+        return changes
+
+    if moved is None:
+        moved = find_moved_tracks({p: old_files[p] for p in changes['removed']},
+                                  {p: new_files[p] for p in changes['added']})
+    added = set(changes['added'])
+    moved_here = [(new, old) for new, old in moved.items() if new in added]
+    # 移動先が別のスコープにある曲は、そちらで行を書き換えるまで消さない
+    moved_elsewhere = {old for new, old in moved.items() if new not in added}
+    removed_dirs = [d for d in old_tree if d not in tree]
+    changed_dirs = [(d, e['mtime'], e['cover'], json.dumps(e['lyrics'], ensure_ascii=False) if e['lyrics'] else None)
+                    for d, e in tree.items()
+                    if d not in old_tree or (old_tree[d]['mtime'], old_tree[d]['cover'], old_tree[d]['lyrics']) !=
+                    (e['mtime'], e['cover'], e['lyrics'])]
+    # 歌詞ファイルだけが変わった場合も、他のワーカーが取り込めるよう変更履歴に残す
+    lyrics_changed = any(old_tree[d]['lyrics'] != e['lyrics'] for d, e in tree.items() if d in old_tree)
+    with library_db() as conn:
+        conn.executemany('DELETE FROM dirs WHERE path = ?', [(d,) for d in removed_dirs])
+        conn.executemany(
+            'INSERT INTO dirs (path, mtime, cover, lyrics) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(path) DO UPDATE SET mtime = excluded.mtime, cover = excluded.cover, lyrics = excluded.lyrics',
+            changed_dirs)
+        conn.executemany('UPDATE OR IGNORE tracks SET path = ? WHERE path = ?', moved_here)
+        conn.executemany('DELETE FROM tracks WHERE path = ?',
+                         [(p,) for p in changes['removed'] if p not in moved_elsewhere])
+        conn.executemany(
+            'INSERT INTO tracks (path, size, mtime, added) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime',
+            [(p, *new_files[p], new_files[p][1]) for p in changes['added'] + changes['modified']])
+        if any(changes.values()) or lyrics_changed:
+            record_library_change(conn, 'scan', scope)
+    return changes
+
+def read_library_tree(conn, scope):
+    """DBに保存されたインデックスから scope 以下のツリーを読み込む"""
+    if scope:
+        condition, args = 'WHERE path = ? OR (path >= ? AND path < ?)', (scope, scope + '/', scope + '0')
+    else:
+        condition, args = '', ()
+    tree = {}
+    for rel_dir, mtime, cover, lyrics in conn.execute(f'SELECT path, mtime, cover, lyrics FROM dirs {condition}', args):
+        tree[rel_dir] = {"mtime": mtime, "files": {}, "subdirs": set(), "cover": cover,
+                         "lyrics": json.loads(lyrics) if lyrics else {}}
+    for rel_path, size, mtime in conn.execute(f'SELECT path, size, mtime FROM tracks {condition}', args):
+        rel_dir, _, name = rel_path.rpartition('/')
+        if rel_dir in tree:
+            tree[rel_dir]['files'][name] = (size, mtime)
+    for rel_dir in tree:
+        if rel_dir != scope:
+            parent, _, name = rel_dir.rpartition('/')
+            if parent in tree:
+                tree[parent]['subdirs'].add(name)
+    return tree
+
+def load_library_index():
+    """DBに保存されたインデックスをメモリに読み込む"""
+    global library_generation, library_synced_generation
+    with library_db() as conn:
+        tree = read_library_tree(conn, '')
+        library_generation = conn.execute('SELECT COALESCE(MAX(generation), 0) FROM library_changes').fetchone()[0]
+        library_synced_generation = library_generation
+        own_library_changes.clear()
+
+    with structure_lock:
+        library_dirs.clear()
+        library_dirs.update(tree)
+        music_structure.clear()
+        for rel_path, _ in iter_tree_files(tree):
+            add_to_structure(rel_path)
+    notify_library_changed(None)
+    print(f"Library index loaded: {sum(len(e['files']) for e in tree.values())} tracks")
+
+def library_scope(rel_path):
+    """変更されたパスから再走査すべきサブツリー (アーティスト or アルバム) を求める"""
+    parts = rel_path.split('/') if rel_path else []
+    if not parts:
+        return ''  # MUSIC_DIR 自体の変更は全体を再走査
+    parent = library_dirs.get('/'.join(parts[:-1]))
+    indexed_file = parent is not None and (parts[-1] in parent['files'] or parts[-1] == parent['cover'] or
+                                           parts[-1] in parent['lyrics'])
+    if len(parts) > 3 or indexed_file or os.path.isfile(os.path.join(MUSIC_DIR, rel_path)):
+        parts = parts[:-1]  # ファイルの場合は親ディレクトリを再走査
+    parts = parts[:2]
+    # 親がまだインデックスにない (新規作成) か既に削除されている場合は範囲を広げる
+    while parts:
+        parent = '/'.join(parts[:-1])
+        if parent in library_dirs and os.path.isdir(os.path.join(MUSIC_DIR, parent) if parent else MUSIC_DIR):
+            break
+        parts.pop()
+    return '/'.join(parts)
+
+def update_library(paths):
+    """変更されたパス (MUSIC_DIR 内の絶対/相対パス) に関係するサブツリーだけを再走査する"""
+    changes = {"added": [], "removed": [], "modified": []}
+    with library_update_lock:
+        scopes = set()
+        for path in paths:
+            rel_path = to_rel_path(path)
+            if rel_path is not None:
+                scopes.add(library_scope(rel_path))
+        # 他のスコープに含まれるスコープは除外
+        scopes = [s for s in scopes if not any(o != s and (not o or s.startswith(o + '/')) for o in scopes)]
+        # フォルダ間の移動は別々のスコープになるので、全部走査してから移動を対応付ける
+        scans = []
+        for scope in sorted(scopes):
+            started = time.perf_counter()
+            scans.append((scope, scan_library_dir(scope), time.perf_counter() - started))
+        with structure_lock:
+            old_files = {p: stat for scope, _, _ in scans for p, stat in iter_tree_files(collect_library_subtree(scope))}
+        new_files = {p: stat for _, tree, _ in scans for p, stat in iter_tree_files(tree)}
+        moved = find_moved_tracks({p: stat for p, stat in old_files.items() if p not in new_files},
+                                  {p: stat for p, stat in new_files.items() if p not in old_files})
+        for scope, tree, scan_seconds in scans:
+            started = time.perf_counter()
+            for key, paths_changed in apply_library_scan(scope, tree, moved=moved).items():
+                changes[key].extend(paths_changed)
+            library_scan_seconds.observe(scan_seconds + time.perf_counter() - started,
+                                         kind='full' if not scope else 'subtree')
+            library_stats['full_rescans' if not scope else 'subtree_rescans'] += 1
+        notify_library_changed(changes)
+    return changes
+
+def rebuild_library():
+    """MUSIC_DIR 全体を再走査する"""
+    with library_update_lock:
+        with library_scan_seconds.time(kind='full'):
+            changes = apply_library_scan('', scan_library_dir(''))
+        library_stats['full_rescans'] += 1
+        notify_library_changed(changes)
+    return changes
+
+def reconcile_library():
+    """保存済みインデックスとディスクをディレクトリの mtime で照合し、変わったディレクトリだけ読み直す。
+    ディレクトリ内のファイルを上書きしただけの変更 (mtime が変わらない) は拾えないので、必要なら再走査する"""
+    started = time.time()
+    set_library_state('reconcile', {"running": True, "started": started})
+    try:
+        with library_update_lock:
+            with structure_lock:
+                known = dict(library_dirs)
+            with library_scan_seconds.time(kind='reconcile'):
+                changes = apply_library_scan('', scan_library_dir('', known))
+            notify_library_changed(changes)
+    except Exception as e:
+        set_library_state('reconcile', {"running": False, "started": started, "finished": time.time(), "error": str(e)})
+        raise
+    counts = {key: len(paths) for key, paths in changes.items()}
+    set_library_state('reconcile', dict(counts, running=False, started=started, finished=time.time()))
+    print(f"Library reconciled in {time.time() - started:.2f}s: {counts}")
+    return changes
+
+def get_library_state(key):
+    with library_db() as conn:
+        row = conn.execute('SELECT value FROM library_state WHERE key = ?', (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def set_library_state(key, value):
+    with library_db() as conn:
+        conn.execute('INSERT INTO library_state (key, value) VALUES (?, ?) '
+                     'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, json.dumps(value)))
+
+def sync_library_from_db():
+    """他のプロセスがDBに書いた変更を取り込む (担当プロセスも、他のワーカーのアップロードやタグ編集を取り込む)"""
+    global library_generation, library_synced_generation
+    with library_db() as conn:
+        rows = conn.execute('SELECT generation, kind, path FROM library_changes WHERE generation > ? ORDER BY generation',
+                            (library_synced_generation,)).fetchall()
+        oldest = conn.execute('SELECT MIN(generation) FROM library_changes').fetchone()[0]
+    if not rows:
+        return
+    if oldest > library_synced_generation + 1:
+        # 取り込む前に履歴が消えてしまった場合は全体を読み直す
+        load_library_index()
+        return
+
+    foreign = [row for row in rows if row[0] not in own_library_changes]
+    changes = {"added": [], "removed": [], "modified": []}
+    tagged = []
+    with library_update_lock:
+        for scope in dict.fromkeys(path for _, kind, path in foreign if kind == 'scan'):
+            with library_db() as conn:
+                tree = read_library_tree(conn, scope)
+            for key, paths_changed in apply_library_scan(scope, tree, persist=False).items():
+                changes[key].extend(paths_changed)
+        tagged = [p for _, kind, path in foreign if kind == 'tags' for p in json.loads(path)]
+        library_synced_generation = rows[-1][0]
+        library_generation = max(library_generation, library_synced_generation)
+        own_library_changes.difference_update(row[0] for row in rows)
+        notify_library_changed(changes)
+    notify_catalog_updated(tagged)
+
+def library_sync_worker(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            if not background_owner and acquire_background_owner():
+                # 担当プロセスが終了したので引き継ぐ
+                sync_library_from_db()
+                start_background_tasks()
+                continue
+            sync_library_from_db()
+        except Exception as e:
+            print(f"Error syncing library: {e}")
+
+# 音楽構造のスナップショットを作り直し、JSONファイルにも保存する関数
+def publish_music_structure():
+    global library_snapshot
+    with structure_lock:
+        body = json.dumps(music_structure, ensure_ascii=False).encode('utf-8')
+        artists = sorted(music_structure)
+    library_snapshot = {
+        "version": library_generation,
+        "etag": hashlib.sha1(body).hexdigest()[:16],  # ワーカー間で同じになるよう内容だけから作る
+        "body": body,
+        "gzip": gzip.compress(body, compresslevel=6),
+        "artists": artists,
+    }
+    if background_owner:
+        with open(MUSIC_STRUCTURE_FILE, 'wb') as outfile:
+            outfile.write(body)
+
+# メタデータカタログ
+# 曲ごとのタグ・再生時間などを tracks テーブルに保存する。ファイルの (size, mtime) が
+# 読み取った時点から変わっていない曲は二度と解析しない
+TAG_FIELDS = ('title', 'tag_artist', 'tag_album', 'genre', 'track_no', 'disc_no', 'year',
+              'duration', 'bitrate', 'codec', 'has_art')
+# フィールドごとの (ID3, Vorbis Comment, MP4) のキー
+TAG_KEYS = {
+    'title': ('TIT2', 'title', '\xa9nam'),
+    'tag_artist': ('TPE1', 'artist', '\xa9ART'),
+    'tag_album': ('TALB', 'album', '\xa9alb'),
+    'genre': ('TCON', 'genre', '\xa9gen'),
+    'track_no': ('TRCK', 'tracknumber', 'trkn'),
+    'disc_no': ('TPOS', 'discnumber', 'disk'),
+    'year': ('TDRC', 'date', '\xa9day'),
+}
+
+catalog_pending = set()
+catalog_condition = threading.Condition()
+catalog_stats = {"parsed": 0, "errors": 0, "started": False}
+
+# タグ情報が保存された後に呼ばれるコールバック (引数は更新された曲のパス)
+catalog_listeners = []
+
+def on_catalog_updated(func):
+    catalog_listeners.append(func)
+    return func
+
+def notify_catalog_updated(paths):
+    if not paths:
+        return
+    for listener in catalog_listeners:
+        try:
+            listener(paths)
+        except Exception as e:
+            print(f"Error in catalog listener {listener.__name__}: {e}")
+
+def first_tag_value(tags, keys):
+    for key in keys:
+        try:
+            value = tags.get(key)
+        except (KeyError, ValueError):
+            value = None
+        if hasattr(value, 'text'):  # ID3 のフレーム
+            value = value.text
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if isinstance(value, tuple):  # MP4 の trkn / disk は (番号, 総数)
+            value = value[0]
+        if value not in (None, ''):
+            return str(value)
+    return None
+
+def leading_int(value):
+    digits = ''
+    for c in (value or '').strip():
+        if not c.isdigit():
+            break
+        digits += c
+    return int(digits) if digits else None
+
+def read_track_tags(full_path):
+    """曲ファイルのタグと再生情報を読み取る"""
+    audio = MutagenFile(full_path)
+    if audio is None:
+        return None
+    tags = audio.tags or {}
+    values = {field: first_tag_value(tags, keys) for field, keys in TAG_KEYS.items()}
+    for field in ('track_no', 'disc_no', 'year'):
+        values[field] = leading_int(values[field])
+    info = audio.info
+    values['duration'] = round(getattr(info, 'length', 0) or 0, 3)
+    values['bitrate'] = getattr(info, 'bitrate', None)
+    values['codec'] = getattr(info, 'codec', None) or type(audio).__name__.lower()
+    values['has_art'] = int(bool(
+        getattr(audio, 'pictures', None) or 'covr' in tags or 'metadata_block_picture' in tags
+        or any(key.startswith('APIC') for key in tags.keys())))
+    return values
+
+def parse_catalog_entry(rel_path):
+    full_path = os.path.join(MUSIC_DIR, rel_path)
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return None
+    try:
+        values = read_track_tags(full_path) or {}
+    except Exception as e:
+        # 壊れたファイルも読み取り済みとして記録し、変更されるまで読み直さない
+        print(f"Error reading tags of {rel_path}: {e}")
+        values = {"error": True}
+    return rel_path, stat.st_size, stat.st_mtime, values
+
+def queue_catalog_update(paths):
+    with catalog_condition:
+        catalog_pending.update(paths)
+        if not catalog_stats['started']:
+            catalog_stats['started'] = True
+            threading.Thread(target=catalog_worker, name='metadata-catalog', daemon=True).start()
+        catalog_condition.notify()
+
+def catalog_worker():
+    with concurrent.futures.ThreadPoolExecutor(METADATA_WORKERS, thread_name_prefix='metadata') as executor:
+        while True:
+            with catalog_condition:
+                while not catalog_pending:
+                    catalog_condition.wait()
+                batch = [catalog_pending.pop() for _ in range(min(256, len(catalog_pending)))]
+
+            rows = []
+            for result in executor.map(parse_catalog_entry, batch):
+                if result is None:
+                    continue
+                rel_path, size, mtime, values = result
+                if values.get('error'):
+                    catalog_stats['errors'] += 1
+                rows.append([values.get(field) for field in TAG_FIELDS] + [size, mtime, rel_path, size, mtime])
+            # インデックス上の (size, mtime) と一致する場合だけ保存する (読み取り中に変わったら捨てる)
+            assignments = ', '.join(f"{field} = ?" for field in TAG_FIELDS)
+            with library_db() as conn:
+                conn.executemany(
+                    f'UPDATE tracks SET {assignments}, tagged_size = ?, tagged_mtime = ? '
+                    'WHERE path = ? AND size = ? AND mtime = ?', rows)
+                if rows:
+                    record_library_change(conn, 'tags', json.dumps([row[-3] for row in rows], ensure_ascii=False))
+            catalog_stats['parsed'] += len(rows)
+            notify_catalog_updated([row[-3] for row in rows])
+
+@on_library_changed
+def update_catalog(changes):
+    if not background_owner:
+        return  # タグの読み取りは担当プロセスだけが行う
+    if changes is None:
+        with library_db() as conn:
+            paths = [row[0] for row in conn.execute(
+                'SELECT path FROM tracks WHERE tagged_mtime IS NULL OR tagged_mtime != mtime OR tagged_size != size')]
+    else:
+        paths = changes['added'] + changes['modified']
+    if paths:
+        queue_catalog_update(paths)
+
+def load_track_metadata(paths):
+    """カタログから曲のメタデータを {path: {...}} で返す"""
+    metadata = {}
+    paths = list(paths)
+    with library_db() as conn:
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            for row in conn.execute(
+                    f"SELECT path, {', '.join(TAG_FIELDS)} FROM tracks WHERE path IN ({placeholders})", chunk):
+                values = dict(zip(TAG_FIELDS, row[1:]))
+                values['has_art'] = bool(values['has_art']) if values['has_art'] is not None else None
+                metadata[row[0]] = values
+    return metadata
+
+# 音声データの指紋 (重複検出)
+# タグ部分を除いた音声データだけをハッシュするので、タグを編集したコピーも同じ指紋になる。
+# メタデータカタログと同様に、(size, mtime) が変わった曲だけをバックグラウンドで計算し直す
+fingerprint_pending = set()
+fingerprint_condition = threading.Condition()
+fingerprint_stats = {"hashed": 0, "bytes": 0, "errors": 0, "started": False}
+
+def id3v2_tag_size(header):
+    """ID3v2 ヘッダー (10バイト) からタグ全体の大きさを返す"""
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7f)
+    return 10 + size + (10 if header[5] & 0x10 else 0)  # フッター付きなら +10
+
+def flac_audio_ranges(f, start, file_size):
+    # fLaC の後にメタデータブロック (タグ・画像・パディング) が並び、最後のブロックの後が音声
+    pos = start + 4
+    while True:
+        f.seek(pos)
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        pos += 4 + int.from_bytes(header[1:4], 'big')
+        if header[0] & 0x80:
+            return [(pos, file_size - pos)]
+
+def mp4_audio_ranges(f, start, file_size):
+    # トップレベルの mdat ボックスの中身が音声 (タグは moov/udta に入る)
+    ranges = []
+    pos = start
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(16)
+        size, header_size = int.from_bytes(header[:4], 'big'), 8
+        if size == 1:
+            size, header_size = int.from_bytes(header[8:16], 'big'), 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header_size:
+            break
+        if header[4:8] == b'mdat':
+            ranges.append((pos + header_size, min(size, file_size - pos) - header_size))
+        pos += size
+    return ranges or None
+
+def wav_audio_ranges(f, start, file_size):
+    # RIFF チャンクのうち data チャンクだけ (タグは LIST / id3 チャンク)
+    ranges = []
+    pos = start + 12
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(8)
+        size = int.from_bytes(header[4:8], 'little')
+        if header[:4] == b'data':
+            ranges.append((pos + 8, min(size, file_size - pos - 8)))
+        pos += 8 + size + (size & 1)
+    return ranges or None
+
+def ogg_audio_ranges(f, start, file_size):
+    # granule position が 0 のページはヘッダー (タグを含む)。それ以外のページの本体だけを使う
+    # ページヘッダーには通し番号と CRC が入っていて、タグの書き換えで変わるので含めない
+    ranges = []
+    pos = start
+    while pos + 27 <= file_size:
+        f.seek(pos)
+        header = f.read(27)
+        if header[:4] != b'OggS':
+            break
+        segments = f.read(header[26])
+        body_size = sum(segments)
+        body_start = pos + 27 + header[26]
+        if int.from_bytes(header[6:14], 'little') != 0 and body_size:
+            if ranges and ranges[-1][0] + ranges[-1][1] == body_start:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + body_size)
+            else:
+                ranges.append((body_start, body_size))
+        pos = body_start + body_size
+    return ranges or None
+
+def audio_payload_ranges(f, file_size):
+    """タグを除いた音声データの範囲 [(開始位置, 長さ), ...] を返す"""
+    start = 0
+    f.seek(0)
+    head = f.read(12)
+    # 先頭の ID3v2 タグ (MP3 のほか FLAC などに付いていることもある)
+    while head[:3] == b'ID3' and len(head) >= 10:
+        start += id3v2_tag_size(head)
+        f.seek(start)
+        head = f.read(12)
+
+    if head[:4] == b'fLaC':
+        ranges = flac_audio_ranges(f, start, file_size)
+    elif head[4:8] == b'ftyp':
+        ranges = mp4_audio_ranges(f, start, file_size)
+    elif head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        ranges = wav_audio_ranges(f, start, file_size)
+    elif head[:4] == b'OggS':
+        ranges = ogg_audio_ranges(f, start, file_size)
+    else:
+        ranges = None
+    if ranges is not None:
+        return ranges
+
+    # MP3 など: 末尾の ID3v1 タグと APEv2 タグを除く (どちらが後ろにあることもある)
+    end = file_size
+    while True:
+        if end - 128 >= start:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+                continue
+        if end - 32 >= start:
+            f.seek(end - 32)
+            footer = f.read(32)
+            tag_size = int.from_bytes(footer[12:16], 'little')
+            if footer[:8] == b'APETAGEX' and tag_size >= 32:  # サイズにはフッター自身が含まれる
+                has_header = int.from_bytes(footer[20:24], 'little') & 0x80000000
+                end = max(start, end - tag_size - (32 if has_header else 0))
+                continue
+        return [(start, end - start)]
+
+def audio_fingerprint(full_path):
+    """タグを除いた音声データの SHA-1 と、その大きさを返す"""
+    hasher = hashlib.sha1()
+    total = 0
+    with open(full_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        for offset, length in audio_payload_ranges(f, file_size):
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(1024 * 1024, length))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                length -= len(chunk)
+                total += len(chunk)
+    return hasher.hexdigest(), total
+
+def fingerprint_entry(rel_path):
+    full_path = os.path.join(MUSIC_DIR, rel_path)
+    try:
+        stat = os.stat(full_path)
+        fingerprint, payload_bytes = audio_fingerprint(full_path)
+    except OSError as e:
+        print(f"Error fingerprinting {rel_path}: {e}")
+        return None
+    return rel_path, stat.st_size, stat.st_mtime, fingerprint, payload_bytes
+
+def queue_fingerprint_update(paths):
+    with fingerprint_condition:
+        fingerprint_pending.update(paths)
+        if not fingerprint_stats['started']:
+            fingerprint_stats['started'] = True
+            threading.Thread(target=fingerprint_worker, name='fingerprint', daemon=True).start()
+        fingerprint_condition.notify()
+
+def fingerprint_worker():
+    with concurrent.futures.ThreadPoolExecutor(FINGERPRINT_WORKERS, thread_name_prefix='fingerprint') as executor:
+        while True:
+            with fingerprint_condition:
+                while not fingerprint_pending:
+                    fingerprint_condition.wait()
+                batch = [fingerprint_pending.pop() for _ in range(min(64, len(fingerprint_pending)))]
+
+            rows = []
+            for result in executor.map(fingerprint_entry, batch):
+                if result is None:
+                    fingerprint_stats['errors'] += 1
+                    continue
+                rel_path, size, mtime, fingerprint, payload_bytes = result
+                fingerprint_stats['bytes'] += payload_bytes
+                rows.append((fingerprint, size, mtime, rel_path, size, mtime))
+            # 計算中にファイルが変わっていたら保存しない (変更後の分は別途キューに入る)
+            with library_db() as conn:
+                conn.executemany(
+                    'UPDATE tracks SET fingerprint = ?, fingerprint_size = ?, fingerprint_mtime = ? '
+                    'WHERE path = ? AND size = ? AND mtime = ?', rows)
+            fingerprint_stats['hashed'] += len(rows)
+
+@on_library_changed
+def update_fingerprints(changes):
+    if not background_owner:
+        return
+    if changes is None:
+        with library_db() as conn:
+            paths = [row[0] for row in conn.execute(
+                'SELECT path FROM tracks WHERE fingerprint_mtime IS NULL '
+                'OR fingerprint_mtime != mtime OR fingerprint_size != size')]
+    else:
+        paths = changes['added'] + changes['modified']
+    if paths:
+        queue_fingerprint_update(paths)
+
+# watchdog のイベントを一定時間まとめてから一括でインデックスに反映するキュー
+class LibraryEventQueue:
+    # 同じパスに続けて届いたイベントの合成結果 (None は打ち消し合って何もしない)
+    MERGE_RULES = {
+        ('created', 'modified'): 'created',
+        ('created', 'deleted'): None,
+        ('deleted', 'created'): 'modified',
+        ('deleted', 'modified'): 'modified',
+        ('modified', 'created'): 'modified',
+        ('modified', 'deleted'): 'deleted',
+    }
+
+    def __init__(self, quiet_seconds, max_delay_seconds):
+        self.quiet_seconds = quiet_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.pending = {}  # {path: action}
+        self.first_event_at = None
+        self.last_event_at = None
+        self.condition = threading.Condition()
+        self.stats = {"events_received": 0, "events_coalesced": 0, "batches": 0, "paths_applied": 0, "paths_skipped": 0}
+
+    def put(self, action, path):
+        with self.condition:
+            self.stats['events_received'] += 1
+            now = time.monotonic()
+            if path in self.pending:
+                self.stats['events_coalesced'] += 1
+                previous = self.pending.pop(path)
+                action = self.MERGE_RULES.get((previous, action), action)
+                if action is None:
+                    return
+            self.pending[path] = action
+            if self.first_event_at is None:
+                self.first_event_at = now
+            self.last_event_at = now
+            self.condition.notify()
+
+    def take_batch(self):
+        """静穏期間 (または最大待ち時間) が経過するまで待ってから溜まったイベントを取り出す"""
+        with self.condition:
+            while True:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                deadline = min(self.last_event_at + self.quiet_seconds,
+                               self.first_event_at + self.max_delay_seconds)
+                if now >= deadline:
+                    break
+                self.condition.wait(deadline - now)
+            batch, self.pending = self.pending, {}
+            self.first_event_at = self.last_event_at = None
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            # アップロードや編集で既に反映済みの変更は再走査しない
+            paths = [path for path in batch if not index_matches_disk(path)]
+            try:
+                if paths:
+                    update_library(paths)
+            except Exception as e:
+                print(f"Error updating library: {e}")
+            with self.condition:
+                self.stats['batches'] += 1
+                self.stats['paths_applied'] += len(paths)
+                self.stats['paths_skipped'] += len(batch) - len(paths)
+
+    def start(self):
+        threading.Thread(target=self.run, name='library-events', daemon=True).start()
+
+library_events = LibraryEventQueue(WATCHDOG_QUIET_SECONDS, WATCHDOG_MAX_DELAY_SECONDS)
+
+def is_library_file(path):
+    """インデックスの対象になるファイル (曲、フォルダのアルバムアート、歌詞ファイル) か"""
+    name = os.path.basename(path).lower()
+    return name.endswith(SUPPORTED_EXTENSIONS) or name in FOLDER_COVER_NAMES or name.endswith(LYRICS_EXTENSION)
+
+def is_hidden_path(path):
+    rel_path = to_rel_path(path)
+    return rel_path is None or any(part.startswith('.') for part in rel_path.split('/'))
+
+def index_matches_disk(path):
+    """ディスク上の状態がインデックスと一致している (再走査しなくてよい) か"""
+    rel_path = to_rel_path(path)
+    if rel_path is None:
+        return True
+    try:
+        stat = os.stat(path)
+    except OSError:
+        stat = None
+    with structure_lock:
+        entry = library_dirs.get(rel_path)
+        if entry is not None:
+            return stat is not None and entry['mtime'] == stat.st_mtime
+        rel_dir, _, name = rel_path.rpartition('/')
+        parent = library_dirs.get(rel_dir)
+        indexed = parent['files'].get(name) if parent else None
+        if parent and name == parent['cover']:
+            return stat is not None
+        if parent and name in parent['lyrics']:
+            return stat is not None and parent['lyrics'][name] == stat.st_mtime
+    if indexed is None:
+        return stat is None
+    return stat is not None and indexed == (stat.st_size, stat.st_mtime)
 
 # フォルダ変更を監視するクラス
 class MusicDirHandler(FileSystemEventHandler):
     def on_any_event(self, event):
-        if event.is_directory:
-            # ディレクトリの変更（作成・削除・移動）も構造に影響するため更新
-            save_music_structure_to_json(MUSIC_DIR)
+        # opened / closed_no_write などの読み取りだけのイベントは無視する
+        if event.event_type == 'moved':
+            changes = [('deleted', event.src_path), ('created', event.dest_path)]
+        elif event.event_type in ('created', 'deleted'):
+            changes = [(event.event_type, event.src_path)]
+        elif event.event_type in ('modified', 'closed') and not event.is_directory:
+            # ディレクトリの modified は中のファイルのイベントで扱える
+            changes = [('modified', event.src_path)]
+        else:
             return
-        
-        # 音楽ファイルの拡張子をチェック
-        supported_extensions = ('.mp3', '.wav', '.flac', '.ogg', '.m4a')
-        if event.src_path.lower().endswith(supported_extensions):
-            save_music_structure_to_json(MUSIC_DIR)
+
+        for action, path in changes:
+            if is_hidden_path(path):
+                continue
+            # ディレクトリの変更（作成・削除・移動）も構造に影響するため更新
+            if event.is_directory or is_library_file(path):
+                library_events.put(action, path)
 
 def start_watchdog():
+    library_events.start()
     event_handler = MusicDirHandler()
     observer = Observer()
     observer.schedule(event_handler, MUSIC_DIR, recursive=True)
     observer.start()
     print(f"Watching for changes in {MUSIC_DIR}...")
 
-# JSONファイルから楽曲データをロードする関数
-def load_music_structure():
+def current_library_snapshot():
+    if library_snapshot is None:
+        publish_music_structure()
+    return library_snapshot
+
+def library_view_response(payload):
+    """ライブラリの部分ビューを、スナップショットのバージョンを ETag にして返す"""
+    response = jsonify(payload)
+    # タグ情報はバックグラウンドで追加されるので、カタログの更新数も ETag に含める
+    response.set_etag(f"{current_library_snapshot()['etag']}-{library_generation}")
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def page_args(default_limit=200, max_limit=1000):
     try:
-        with open(MUSIC_STRUCTURE_FILE, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    except Exception as e:
-        print(f"Error loading music structure: {e}")
-        return {}
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', default_limit)), 1), max_limit)
+    except ValueError:
+        offset, limit = 0, default_limit
+    return offset, limit
+
+# 全文検索
+# アーティスト・アルバム・曲名 (タグがあればタグも) を正規化した語で引く転置インデックス。
+# 日本語のように区切りのない文字列は2文字ずつ (bigram) も登録し、部分一致で検索できるようにする
+SEARCH_MAX_CANDIDATES = 2000  # スコアを計算する候補の上限。上限の高い候補から順に計算し、残りは truncated として返す
+SEARCH_MAX_PREFIX_TERMS = 500  # 前方一致で展開する語の上限
+
+def normalize_search_text(text):
+    """全角/半角・大文字/小文字・カタカナ/ひらがなの違いを吸収し、記号を空白にする"""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    chars = []
+    for c in text:
+        if 'ァ' <= c <= 'ヶ':
+            c = chr(ord(c) - 0x60)
+        chars.append(c if c.isalnum() else ' ')
+    return ' '.join(''.join(chars).split())
+
+def is_cjk_word(word):
+    return any(c > '\u2fff' for c in word)
+
+@functools.lru_cache(maxsize=65536)
+def search_terms(word):
+    """インデックスに登録する語。区切りのない文字列は bigram も登録する"""
+    if is_cjk_word(word) and len(word) > 1:
+        return frozenset({word} | {word[i:i + 2] for i in range(len(word) - 1)})
+    return (word,)
+
+class SearchIndex:
+    FIELDS = ('artist', 'album', 'title')
+    FIELD_WEIGHTS = (3.0, 2.0, 2.0)
+    # 語ごとの doc id の配列には、その語が最も重いフィールドに出るか・フィールドの先頭かを
+    # 4段階の等級にして上位2ビットに入れ、等級の高い順 (同じ等級の中は doc id 順) に並べておく。
+    # 等級から語ごとのスコアの上限がわかるので、候補が多くても上限の高いものから順にスコアを計算できる
+    GRADE_SHIFT = 30
+    DOC_MASK = (1 << GRADE_SHIFT) - 1
+    TOP_WEIGHT, REST_WEIGHT = FIELD_WEIGHTS[0], max(FIELD_WEIGHTS[1:])  # アーティストが最も重い
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = False
+        self.replay = None  # 作り直しの最中に届いた更新 (作り直し後に適用し直す)
+        self.reset()
+
+    def reset(self):
+        self.paths = []  # doc id -> 曲のパス (削除済みは None)
+        self.fields = []  # doc id -> 正規化したフィールドのタプル
+        self.doc_ids = {}  # 曲のパス -> doc id
+        self.postings = {}  # 語 -> (3 - 等級) << GRADE_SHIFT | doc id の配列 (昇順)
+        self.terms = []  # 前方一致用のソート済み語彙 (作り直しの最中は None にして最後にまとめてソートする)
+        self.deleted = 0
+
+    @staticmethod
+    def document(rel_path, metadata):
+        artist, album, song = track_location(rel_path)
+        metadata = metadata or {}
+        return (
+            normalize_search_text(f"{artist} {metadata.get('tag_artist') or ''}"),
+            normalize_search_text(f"{album if album != UNKNOWN_ALBUM else ''} {metadata.get('tag_album') or ''}"),
+            normalize_search_text(f"{os.path.splitext(song)[0]} {metadata.get('title') or ''}"),
+        )
+
+    def add(self, rel_path, fields):
+        doc_id = len(self.paths)
+        self.paths.append(rel_path)
+        self.fields.append(fields)
+        self.doc_ids[rel_path] = doc_id
+        grades = {}
+        for field, weight in zip(fields, self.FIELD_WEIGHTS):
+            top = 2 if weight == self.TOP_WEIGHT else 0
+            for word in field.split():
+                for term in search_terms(word):
+                    grade = top + field.startswith(term)
+                    if grade > grades.get(term, -1):
+                        grades[term] = grade
+        for term, grade in grades.items():
+            code = (3 - grade) << self.GRADE_SHIFT | doc_id
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array.array('I')
+                if self.terms is not None:
+                    bisect.insort(self.terms, term)
+            if self.terms is None or not postings or postings[-1] < code:
+                postings.append(code)
+            else:
+                postings.insert(bisect.bisect_right(postings, code), code)
+
+    def remove(self, rel_path):
+        doc_id = self.doc_ids.pop(rel_path, None)
+        if doc_id is not None:
+            self.paths[doc_id] = None
+            self.fields[doc_id] = None
+            self.deleted += 1
+
+    def apply(self, removed, documents):
+        for rel_path in removed:
+            self.remove(rel_path)
+        for rel_path, fields in documents:
+            self.remove(rel_path)
+            self.add(rel_path, fields)
+
+    def rebuild(self, documents):
+        """documents: [(path, fields)] から作り直して差し替える"""
+        with self.lock:
+            self.replay = []
+        fresh = SearchIndex()
+        fresh.terms = None
+        for rel_path, fields in sorted(documents):
+            fresh.add(rel_path, fields)
+        for postings in fresh.postings.values():
+            if len(postings) > 1:
+                postings[:] = array.array('I', sorted(postings))
+        fresh.terms = sorted(fresh.postings)
+        with self.lock:
+            for removed, updated in self.replay:
+                fresh.apply(removed, updated)
+            for name in ('paths', 'fields', 'doc_ids', 'postings', 'terms', 'deleted'):
+                setattr(self, name, getattr(fresh, name))
+            self.replay = None
+            self.ready = True
+
+    def update(self, removed, documents, existing_only=False):
+        with self.lock:
+            if existing_only:
+                documents = [(p, f) for p, f in documents if p in self.doc_ids]
+            self.apply(removed, documents)
+            if self.replay is not None:
+                self.replay.append((removed, documents))
+            # 削除済みが増えたら作り直す
+            needs_compaction = self.replay is None and self.deleted > max(1000, len(self.paths) // 4)
+            if needs_compaction:
+                documents = [(p, f) for p, f in zip(self.paths, self.fields) if p is not None]
+        if needs_compaction:
+            self.rebuild(documents)
+
+    def candidate_postings(self, term):
+        """語に一致しうる doc id の配列を [(配列, 語として完全一致か)] で返す"""
+        if is_cjk_word(term) and len(term) > 1:
+            bigrams = [self.postings.get(term[i:i + 2]) for i in range(len(term) - 1)]
+            if not all(bigrams):
+                return []
+            return [(min(bigrams, key=len), True)]
+        # 前方一致: 語彙のうち term で始まる語をまとめる
+        start = bisect.bisect_left(self.terms, term)
+        expanded = []
+        for candidate in self.terms[start:start + SEARCH_MAX_PREFIX_TERMS]:
+            if not candidate.startswith(term):
+                break
+            expanded.append((self.postings[candidate], candidate == term))
+        return expanded
+
+    def ranked_candidates(self, expanded):
+        """候補の doc id を、その語によるスコアの上限が高い順に重複なく返す (上限が同じものは doc id 順)"""
+        by_bound = {}
+        for postings, exact in expanded:
+            start = 0
+            for rank in range(4):
+                end = bisect.bisect_left(postings, (rank + 1) << self.GRADE_SHIFT, start)
+                if end > start:
+                    grade = 3 - rank
+                    weight = self.TOP_WEIGHT if grade >= 2 else self.REST_WEIGHT
+                    bound = weight * (2.0 if exact else 1.5) + 0.5 * (grade & 1)
+                    by_bound.setdefault(bound, []).append(
+                        map(self.DOC_MASK.__and__, map(postings.__getitem__, range(start, end))))
+                start = end
+        seen = set()
+        for bound in sorted(by_bound, reverse=True):
+            for doc_id in heapq.merge(*by_bound[bound]):
+                if doc_id not in seen:
+                    seen.add(doc_id)
+                    yield doc_id
+
+    @staticmethod
+    def term_pattern(term):
+        return term, f" {term}", f" {term} ", is_cjk_word(term)
+
+    @staticmethod
+    def match_score(pattern, padded_fields):
+        """各フィールド (前後に空白を付けたもの) との一致度からスコアを計算する。一致しなければ 0"""
+        term, prefix, word, cjk = pattern
+        best = 0.0
+        for field, weight in zip(padded_fields, SearchIndex.FIELD_WEIGHTS):
+            if word in field:
+                score = weight * 2.0  # 語として完全一致
+            elif prefix in field:
+                score = weight * 1.5  # 語の前方一致
+            elif cjk and term in field:
+                score = weight  # 日本語などの部分一致
+            else:
+                continue
+            if field.startswith(prefix):
+                score += 0.5
+            if score > best:
+                best = score
+        return best
+
+    def search(self, query):
+        """(スコア順のパス一覧, 候補が多すぎて打ち切ったか) を返す"""
+        terms = normalize_search_text(query).split()
+        if not terms:
+            return [], False
+        with self.lock:
+            # 一番候補の少ない語から、その語のスコアの上限が高い順に候補を取り出し、残りの語は文字列で確認する
+            expanded = {term: self.candidate_postings(term) for term in terms}
+            driving = min(terms, key=lambda term: sum(len(p) for p, _ in expanded[term]))
+            # 候補を作った語は一致しやすいので最後に確認する
+            patterns = [self.term_pattern(term) for term in terms if term != driving] + [self.term_pattern(driving)]
+            truncated = False
+            results = []
+            scored = 0
+            for doc_id in self.ranked_candidates(expanded[driving]):
+                fields = self.fields[doc_id]
+                if fields is None:
+                    continue
+                if scored == SEARCH_MAX_CANDIDATES:
+                    truncated = True
+                    break
+                scored += 1
+                total = 0.0
+                padded_fields = [f" {field} " for field in fields]
+                for pattern in patterns:
+                    score = self.match_score(pattern, padded_fields)
+                    if not score:
+                        break
+                    total += score
+                else:
+                    results.append((-total, self.paths[doc_id]))
+        results.sort()
+        return [(path, -score) for score, path in results], truncated
+
+search_index = SearchIndex()
+
+def search_documents(paths):
+    paths = list(paths)
+    metadata = load_track_metadata(paths)
+    return [(p, SearchIndex.document(p, metadata.get(p))) for p in paths]
+
+@on_library_changed
+def update_search_index(changes):
+    if changes is None:
+        # 起動時などの全体構築は時間がかかるのでバックグラウンドで行う
+        with structure_lock:
+            paths = [rel_path for rel_path, _ in iter_tree_files(library_dirs)]
+        threading.Thread(target=lambda: search_index.rebuild(search_documents(paths)),
+                         name='search-index', daemon=True).start()
+    else:
+        search_index.update(changes['removed'], search_documents(changes['added'] + changes['modified']))
+
+@on_catalog_updated
+def update_search_tags(paths):
+    # 既に削除された曲を復活させないよう、インデックスにある曲だけ更新する
+    search_index.update([], search_documents(paths), existing_only=True)
 
 # 音楽関連のAPI (認証必須)
 @app.route('/music_structure')
 @login_required
 def get_music_structure():
-    with open(MUSIC_STRUCTURE_FILE, 'r', encoding='utf-8') as infile:
-        music_structure = json.load(infile)
-    return jsonify(music_structure)
+    snapshot = current_library_snapshot()
+    use_gzip = request.accept_encodings['gzip'] > 0
+    response = Response(snapshot['gzip'] if use_gzip else snapshot['body'], mimetype='application/json')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.set_etag(snapshot['etag'] + ('-gzip' if use_gzip else ''))
+    return response.make_conditional(request)
 
-@app.route('/music/<path:path>')
-@login_required
-def stream_music(path):
-    return send_from_directory(MUSIC_DIR, path)
+# ライブラリ一覧 (カーソル方式のページング)
+# 名前順・追加日順に並べたキーの一覧をライブラリ変更のたびに作り直し、
+# カーソル (前のページの最後の項目のキー) より後ろを bisect で探して続きを返す
+BROWSE_SORTS = ('name', 'added')
+library_browse = None
+library_browse_version = 0
+library_browse_lock = threading.Lock()
 
-@app.route('/api/album-art/<path:path>')
+@on_library_changed
+def reset_library_browse(changes):
+    global library_browse, library_browse_version
+    with library_browse_lock:
+        library_browse = None
+        library_browse_version += 1
+
+def album_rel_dir(artist, album):
+    """アルバムの曲があるディレクトリ。アーティスト直下の曲は "アルバム不明" として扱われている (structure_lock を持って呼ぶ)"""
+    if album == UNKNOWN_ALBUM and album not in library_dirs.get(artist, {}).get('subdirs', ()):
+        return artist
+    return f"{artist}/{album}"
+
+def browse_keys(sort, items):
+    """(名前のキー, 追加日) の組から並べ替えキーの一覧を作る。キーの最後の要素で項目を引ける"""
+    if sort == 'added':
+        return sorted((-added, *name) for name, added in items)
+    return sorted(name for name, _ in items)
+
+def build_library_browse():
+    with structure_lock:
+        albums = [(artist, album, album_rel_dir(artist, album), list(songs))
+                  for artist, artist_albums in music_structure.items() for album, songs in artist_albums.items()]
+    with library_db() as conn:
+        added = dict(conn.execute('SELECT path, added FROM tracks'))
+
+    artists, album_entries, tracks = {}, {}, {}
+    for artist, album, rel_dir, songs in albums:
+        paths = [f"{rel_dir}/{song}" for song in songs]
+        for path in paths:
+            tracks[path] = float(added.get(path) or 0)
+        album_added = max((tracks[path] for path in paths), default=0.0)
+        album_entries[(artist, album)] = {"tracks": len(paths), "added": album_added, "art_path": paths[0] if paths else None}
+        entry = artists.setdefault(artist, {"albums": 0, "added": 0.0})
+        entry['albums'] += 1
+        entry['added'] = max(entry['added'], album_added)
+
+    orders = {}
+    for sort in BROWSE_SORTS:
+        orders['artists', sort] = browse_keys(sort, (((name,), e['added']) for name, e in artists.items()))
+        orders['albums', sort] = browse_keys(sort, (((album, artist), e['added']) for (artist, album), e in album_entries.items()))
+        orders['tracks', sort] = browse_keys(sort, (((path,), t) for path, t in tracks.items()))
+    return {"artists": artists, "albums": album_entries, "tracks": tracks, "orders": orders}
+
+def current_library_browse():
+    global library_browse
+    with library_browse_lock:
+        browse, version = library_browse, library_browse_version
+    if browse is None:
+        browse = build_library_browse()
+        with library_browse_lock:
+            if library_browse_version == version:  # 作っている間に変更があれば次のリクエストで作り直す
+                library_browse = browse
+    return browse
+
+def encode_cursor(sort, key):
+    return base64.urlsafe_b64encode(json.dumps([sort, *key], ensure_ascii=False).encode('utf-8')).decode('ascii').rstrip('=')
+
+def cursor_page(keys, sort):
+    """?cursor= (なければ ?offset=) から limit 件のキーと次のカーソルを返す。不正なカーソルは ValueError"""
+    offset, limit = page_args()
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            decoded = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            if not isinstance(decoded, list) or not decoded or decoded[0] != sort:
+                raise ValueError
+            offset = bisect.bisect_right(keys, tuple(decoded[1:]))
+        except (ValueError, TypeError):
+            raise ValueError('Invalid cursor')
+    page = keys[offset:offset + limit]
+    next_cursor = encode_cursor(sort, page[-1]) if page and offset + limit < len(keys) else None
+    return page, next_cursor
+
+def browse_args():
+    sort = request.args.get('sort', 'name')
+    if sort not in BROWSE_SORTS:
+        raise ValueError(f"sort must be one of {list(BROWSE_SORTS)}")
+    return sort, current_library_browse()
+
+def album_art_url(path):
+    return f"/api/album-art/{urllib.parse.quote(path)}"
+
+@app.route('/api/library/artists')
 @login_required
-def get_album_art(path):
-    # キャッシュキーとしてパスを使用
-    if path in album_art_cache:
-        cached_data = album_art_cache[path]
-        if cached_data:
-            return Response(cached_data['data'], mimetype=cached_data['mime'])
-        return jsonify({"error": "No artwork found"}), 404
-
-    full_path = os.path.join(MUSIC_DIR, path)
-    if not os.path.exists(full_path):
-        return jsonify({"error": "File not found"}), 404
+def get_library_artists():
+    """アーティスト一覧 (?sort=name|added&cursor=&limit=)"""
+    snapshot = current_library_snapshot()
+    try:
+        sort, browse = browse_args()
+        keys = browse['orders']['artists', sort]
+        page, next_cursor = cursor_page(keys, sort)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    artists = [dict(browse['artists'][key[-1]], name=key[-1]) for key in page]
+    return library_view_response({
+        "version": snapshot['version'],
+        "total": len(keys),
+        "sort": sort,
+        "next_cursor": next_cursor,
+        "artists": artists
+    })
 
+@app.route('/api/library/albums')
+@login_required
+def get_library_albums():
+    """アルバム一覧 (?artist= で絞り込み)。各アルバムに代表曲のアートのURLと、取得済みならその画像のハッシュを付ける"""
+    snapshot = current_library_snapshot()
     try:
-        audio = MutagenFile(full_path)
-        if audio is None:
-            album_art_cache[path] = None
-            return jsonify({"error": "Unsupported file format"}), 404
-
-        # MP3 (ID3)
-        if 'APIC:' in audio:
-            artwork = audio['APIC:'].data
-            mime = audio['APIC:'].mime
-        # FLAC / OGG (Vorbis Comment)
-        elif hasattr(audio, 'pictures') and audio.pictures:
-            artwork = audio.pictures[0].data
-            mime = audio.pictures[0].mime
-        # MP4 (iTunes style)
-        elif 'covr' in audio:
-            artwork = audio['covr'][0]
-            # covrはMIMEタイプを保持していない場合があるため推測
-            mime = 'image/jpeg' if artwork.startswith(b'\xff\xd8') else 'image/png'
+        sort, browse = browse_args()
+        if 'artist' in request.args:
+            artist = request.args['artist']
+            if artist not in browse['artists']:
+                return jsonify({"error": "Artist not found"}), 404
+            with structure_lock:
+                names = list(music_structure.get(artist, {}))
+            keys = browse_keys(sort, (((album, artist), browse['albums'][artist, album]['added'])
+                                      for album in names if (artist, album) in browse['albums']))
         else:
-            album_art_cache[path] = None
-            return jsonify({"error": "No artwork found"}), 404
-
-        album_art_cache[path] = {'data': artwork, 'mime': mime}
-        return Response(artwork, mimetype=mime)
+            keys = browse['orders']['albums', sort]
+        page, next_cursor = cursor_page(keys, sort)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    except Exception as e:
-        print(f"Error extracting album art: {e}")
-        return jsonify({"error": "Error extracting artwork"}), 500
+    entries = [(key[-1], key[-2], browse['albums'][key[-1], key[-2]]) for key in page]
+    sources = {(artist, album): album_art_source(e['art_path'])[0] for artist, album, e in entries if e['art_path']}
+    digests = album_art_cache.known_digests(sources.values())
+    albums = []
+    for artist, album, e in entries:
+        source = sources.get((artist, album))
+        has_art = source is not None and (source not in digests or digests[source] is not None)
+        albums.append({
+            "artist": artist,
+            "name": album,
+            "tracks": e['tracks'],
+            "added": e['added'],
+            "art": album_art_url(e['art_path']) if has_art else None,
+            "art_hash": digests.get(source),  # 未取得なら None (画像を取得すると決まる)
+        })
+    payload = {"version": snapshot['version'], "total": len(keys), "sort": sort, "next_cursor": next_cursor, "albums": albums}
+    if 'artist' in request.args:
+        payload['artist'] = request.args['artist']
+    return library_view_response(payload)
 
-@app.route('/get-song-data/<string:song_name>')
+@app.route('/api/library/tracks')
 @login_required
-def get_song_data(song_name):
-    music_structure = load_music_structure()  # 楽曲データのロード
-
-    # 楽曲データを検索する処理
-    for artist, albums in music_structure.items():
-        for album, songs in albums.items():
-            if song_name in songs:
-                # 曲が見つかった場合の処理
-                # 音楽ストリーミング用のパスを生成
-                song_path = url_for('stream_music', path=f"{artist}/{album}/{song_name}")
-                return jsonify({"artist": artist, "album": album, "songName": song_name, "path": song_path})
-    
-    return jsonify({"error": "Song not found"}), 404
+def get_library_tracks():
+    """曲一覧 (?artist=&album= で絞り込み。どちらもなければライブラリ全体)"""
+    snapshot = current_library_snapshot()
+    artist = request.args.get('artist')
+    album = request.args.get('album')
+    try:
+        sort, browse = browse_args()
+        if artist is not None and album is not None:
+            if (artist, album) not in browse['albums']:
+                return jsonify({"error": "Album not found"}), 404
+            with structure_lock:
+                rel_dir = album_rel_dir(artist, album)
+                paths = [f"{rel_dir}/{song}" for song in music_structure.get(artist, {}).get(album, [])]
+        elif artist is not None:
+            if artist not in browse['artists']:
+                return jsonify({"error": "Artist not found"}), 404
+            with structure_lock:
+                paths = [f"{album_rel_dir(artist, a)}/{song}" for a, songs in music_structure.get(artist, {}).items()
+                         for song in songs]
+        else:
+            paths = None
+        if paths is None:
+            keys = browse['orders']['tracks', sort]
+        else:
+            keys = browse_keys(sort, (((path,), browse['tracks'].get(path, 0.0)) for path in paths))
+        page, next_cursor = cursor_page(keys, sort)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-# プレイリスト関連のAPI (ユーザー別)
-@app.route('/save_playlist', methods=['POST'])
+    paths = [key[-1] for key in page]
+    metadata = load_track_metadata(paths)
+    tracks = []
+    for path in paths:
+        track_artist, track_album, song = track_location(path)
+        tracks.append(dict(metadata.get(path, {}), song=song, path=path, artist=track_artist, album=track_album,
+                           added=browse['tracks'].get(path)))
+    payload = {"version": snapshot['version'], "total": len(keys), "sort": sort, "next_cursor": next_cursor, "tracks": tracks}
+    if artist is not None:
+        payload['artist'] = artist
+    if album is not None:
+        payload['album'] = album
+    return library_view_response(payload)
+
+@app.route('/api/track-info/<path:path>')
 @login_required
-def save_playlist():
-    data = request.json
-    playlist_name = data.get('name')
-    playlist_items = data.get('items')
-    
-    if not playlist_name or not playlist_items:
-        return jsonify({"error": "Name and items are required"}), 400
-    
-    user_file = os.path.join(USERS_DIR, f"{session['user_id']}.json")
-    
-    if not os.path.exists(user_file):
-        return jsonify({"error": "User not found"}), 404
-    
-    with open(user_file, 'r', encoding='utf-8') as file_handle:
-        user_data = json.load(file_handle)
-    
-    if 'playlists' not in user_data:
-        user_data['playlists'] = {}
-    
-    # Safe name generation
-    safe_name = "".join([c for c in playlist_name if c.isalpha() or c.isdigit() or c==' ' or c=='_']).rstrip()
-    
-    user_data['playlists'][safe_name] = {
-        "name": playlist_name,
-        "items": playlist_items,
-        "created_at": datetime.datetime.now().isoformat()
-    }
-    
-    with open(user_file, 'w', encoding='utf-8') as file_handle:
-        json.dump(user_data, file_handle, ensure_ascii=False, indent=2)
-    
-    return jsonify({"success": True, "name": playlist_name})
+def get_track_info(path):
+    """カタログに保存された曲のタグ・再生時間などを返す"""
+    metadata = load_track_metadata([path]).get(path)
+    if metadata is None:
+        return jsonify({"error": "Song not found"}), 404
+    return jsonify(dict(metadata, path=path))
 
-@app.route('/playlists')
+@app.route('/api/search')
 @login_required
-def get_playlists():
-    user_file = os.path.join(USERS_DIR, f"{session['user_id']}.json")
+def search_library():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    offset, limit = page_args(default_limit=50, max_limit=200)
+
+    started = time.perf_counter()
+    results, truncated = search_index.search(query)
+    page = results[offset:offset + limit]
+    metadata = load_track_metadata(path for path, _ in page)
+    items = []
+    for path, score in page:
+        artist, album, song = track_location(path)
+        items.append(dict(metadata.get(path, {}), path=path, artist=artist, album=album, song=song,
+                          score=round(score, 2)))
+    return jsonify({
+        "query": query,
+        "total": len(results),
+        "truncated": truncated,
+        "ready": search_index.ready,
+        "offset": offset,
+        "results": items,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+    })
+
+@app.route('/api/library/rescan', methods=['POST'])
+@admin_required
+def rescan_library():
+    """ライブラリ全体を強制的に再構築"""
+    started = time.time()
+    changes = rebuild_library()
+    return jsonify({
+        "success": True,
+        "added": len(changes['added']),
+        "removed": len(changes['removed']),
+        "modified": len(changes['modified']),
+        "elapsed": round(time.time() - started, 3)
+    })
+
+@app.route('/api/library/status')
+@admin_required
+def library_status():
+    with library_events.condition:
+        events = dict(library_events.stats, pending=len(library_events.pending))
+    with catalog_condition:
+        catalog = dict(catalog_stats, pending=len(catalog_pending))
+    with fingerprint_condition:
+        fingerprints = dict(fingerprint_stats, pending=len(fingerprint_pending))
+    return jsonify({"events": events, "rescans": library_stats, "catalog": catalog, "fingerprints": fingerprints})
+
+@app.route('/api/ready')
+def readiness():
+    """保存済みインデックスで応答できる状態か、起動時の照合がまだ続いているかを返す (ログイン不要)"""
+    reconcile = get_library_state('reconcile') or {"running": True}
+    return jsonify({
+        "serving": True,
+        "reconciling": reconcile['running'],
+        "ready": not reconcile['running'] and 'error' not in reconcile,
+        "reconcile": reconcile,
+    })
+
+@app.route('/api/library/duplicates')
+@admin_required
+def library_duplicates():
+    """音声データが同じ曲のグループと、1つだけ残した場合に空く容量"""
+    with library_db() as conn:
+        rows = conn.execute(
+            'SELECT fingerprint, path, size FROM tracks WHERE fingerprint IN ('
+            '  SELECT fingerprint FROM tracks WHERE fingerprint IS NOT NULL GROUP BY fingerprint HAVING COUNT(*) > 1'
+            ') ORDER BY fingerprint, path').fetchall()
+        unhashed = conn.execute(
+            'SELECT COUNT(*) FROM tracks WHERE fingerprint_mtime IS NULL '
+            'OR fingerprint_mtime != mtime OR fingerprint_size != size').fetchone()[0]
+
+    groups = []
+    for fingerprint, members in itertools.groupby(rows, key=lambda row: row[0]):
+        tracks = [{"path": path, "size": size} for _, path, size in members]
+        sizes = [track['size'] for track in tracks]
+        groups.append({
+            "fingerprint": fingerprint,
+            "tracks": tracks,
+            "reclaimable_bytes": sum(sizes) - max(sizes),
+        })
+    groups.sort(key=lambda group: group['reclaimable_bytes'], reverse=True)
+    return jsonify({
+        "groups": groups,
+        "duplicate_tracks": sum(len(group['tracks']) - 1 for group in groups),
+        "reclaimable_bytes": sum(group['reclaimable_bytes'] for group in groups),
+        "unhashed_tracks": unhashed,  # まだ指紋を計算していない曲 (結果に含まれない)
+    })
+
+# 音声ファイルの配信
+# Range/If-Range に対応して 206 を返し、サーバーの wsgi.file_wrapper (gunicorn なら sendfile) で
+# ファイルから直接送る。ストリームごとの応答時間・転送速度を記録する
+AUDIO_MIMETYPES = {'.mp3': 'audio/mpeg', '.flac': 'audio/flac', '.ogg': 'audio/ogg', '.m4a': 'audio/mp4', '.wav': 'audio/wav'}
+
+stream_stats = {"streams": 0, "active": 0, "bytes": 0, "partial": 0, "not_modified": 0}
+stream_stats_lock = threading.Lock()
+recent_streams = collections.deque(maxlen=200)  # 直近のストリームの記録
+
+def file_range_iter(file, length, chunk_size=STREAM_CHUNK_BYTES):
+    """wsgi.file_wrapper がないサーバー用に、現在位置から length バイトを読んで返す"""
+    try:
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+class StreamFile:
+    """配信中のファイル。サーバーが閉じた時点で転送時間を記録する"""
+
+    def __init__(self, file, record):
+        self.file = file
+        self.record = record
+        self.closed = False
+        with stream_stats_lock:
+            stream_stats['streams'] += 1
+            stream_stats['active'] += 1
+            stream_stats['partial'] += record['status'] == 206
+
+    def __getattr__(self, name):
+        # fileno/seek/tell/read は元のファイルに任せる (sendfile 用)
+        return getattr(self.file, name)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        record = self.record
+        record['duration'] = time.perf_counter() - record.pop('started')
+        record['throughput'] = record['bytes'] / record['duration'] if record['duration'] > 0 else None
+        with stream_stats_lock:
+            stream_stats['active'] -= 1
+            stream_stats['bytes'] += record['bytes']
+            recent_streams.append(record)
+
+@app.route('/music/<path:path>')
+@login_required
+def stream_music(path):
+    started = time.perf_counter()
+    full_path = safe_join(MUSIC_DIR, path)
+    try:
+        stat = os.stat(full_path) if full_path else None
+    except OSError:
+        stat = None
+    if stat is None or not os.path.isfile(full_path):
+        return jsonify({"error": "File not found"}), 404
+
+    audio_format = request.args.get('format')
+    if audio_format:
+        return transcode_music(path, full_path, stat, audio_format, started)
+    mimetype = AUDIO_MIMETYPES.get(os.path.splitext(full_path)[1].lower(), 'application/octet-stream')
+    return send_audio_file(path, full_path, stat, mimetype, started)
+
+def send_audio_file(path, full_path, stat, mimetype, started):
+    """音声ファイルを Range 対応で返す"""
+    etag = f"{int(stat.st_mtime * 1000):x}-{stat.st_size:x}"
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f'private, max-age={STREAM_MAX_AGE}',
+    }
+
+    def finalize(response):
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response.headers.extend(headers)
+        return response
+
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and request.if_modified_since
+            and int(stat.st_mtime) <= request.if_modified_since.timestamp()):
+        with stream_stats_lock:
+            stream_stats['not_modified'] += 1
+        return finalize(Response(status=304))
+
+    size = stat.st_size
+    start, length, status = 0, size, 200
+    byte_range = request.range
+    # If-Range が一致しない (ファイルが変わった) 場合は全体を返す
+    if byte_range and request.if_range and (request.if_range.etag or request.if_range.date):
+        if request.if_range.etag != etag and not (
+                request.if_range.date and int(stat.st_mtime) <= request.if_range.date.timestamp()):
+            byte_range = None
+    if byte_range and len(byte_range.ranges) == 1:
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            response = finalize(Response(status=416))
+            response.headers['Content-Range'] = f"bytes */{size}"
+            return response
+        start, stop = bounds
+        length, status = stop - start, 206
+
+    if request.method == 'HEAD':
+        body = ()
+    else:
+        audio_file = open(full_path, 'rb')
+        audio_file.seek(start)
+        audio_file = StreamFile(audio_file, {
+            "path": path, "status": status, "offset": start, "bytes": length,
+            "ttfb": time.perf_counter() - started,  # レスポンスを返すまでの時間 (シーク時の待ち時間の目安)
+            "started": started, "at": time.time(),
+        })
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            # サーバーは現在位置から Content-Length 分だけ送る (gunicorn では sendfile)
+            body = file_wrapper(audio_file, STREAM_CHUNK_BYTES)
+        else:
+            body = file_range_iter(audio_file, length)
+    response = finalize(Response(body, status=status, mimetype=mimetype, direct_passthrough=True))
+    response.headers['Content-Length'] = str(length)
+    if status == 206:
+        response.headers['Content-Range'] = f"bytes {start}-{start + length - 1}/{size}"
+    return response
+
+# 低速回線向けのトランスコード (?format=opus&bitrate=128)
+# エンコーダー (ffmpeg) の出力をそのままクライアントに送りながら一時ファイルにも書き、
+# 最後まで変換できたものをキャッシュに入れる。同時に動かすエンコーダーの数は制限する
+TRANSCODE_FORMATS = {
+    # format: (mimetype, 拡張子, エンコーダーの引数)
+    'opus': ('audio/ogg', '.opus', ['-c:a', 'libopus', '-f', 'ogg']),
+    'mp3': ('audio/mpeg', '.mp3', ['-c:a', 'libmp3lame', '-f', 'mp3']),
+    'aac': ('audio/aac', '.aac', ['-c:a', 'aac', '-f', 'adts']),
+}
+TRANSCODE_DEFAULT_BITRATE = 128
+TRANSCODE_BITRATES = (32, 320)  # 指定できるビットレートの範囲 (kbps)
+TRANSCODE_CHUNK_BYTES = 64 * 1024
+
+class TranscodeStream:
+    """エンコーダーの出力をクライアントに流すイテラブル。サーバーが閉じたときに後始末をする"""
+
+    def __init__(self, cache, process, cache_file):
+        self.cache = cache
+        self.process = process
+        self.cache_file = cache_file
+        self.tmp_file = f"{cache_file}.{uuid.uuid4().hex}.tmp"
+        self.output = None
+        self.first_chunk = b''
+        self.finished = False
+        self.aborted = False
+        self.closed = False
+
+    def read_first_chunk(self):
+        """最初の出力を待つ。すぐに失敗したエンコーダーは False"""
+        self.first_chunk = self.process.stdout.read1(TRANSCODE_CHUNK_BYTES)
+        return bool(self.first_chunk) or self.process.wait() == 0
+
+    def __iter__(self):
+        try:
+            self.output = open(self.tmp_file, 'wb')
+        except OSError as e:
+            print(f"Error creating transcode cache file: {e}")
+        chunk = self.first_chunk
+        while chunk:
+            if self.output is not None:
+                self.output.write(chunk)
+            yield chunk
+            # 読めた分だけすぐに送る (変換が終わるのを待たない)
+            chunk = self.process.stdout.read1(TRANSCODE_CHUNK_BYTES)
+        self.finished = self.process.wait() == 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.process.poll() is None:
+            # クライアントが途中で切断した
+            self.aborted = True
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        if self.output is not None:
+            self.output.close()
+        self.cache.finish(self)
+
+class TranscodeCache:
+    """変換済みファイルのディスクキャッシュとエンコーダーの同時実行数の管理"""
+
+    def __init__(self, cache_dir, disk_bytes, workers):
+        self.cache_dir = cache_dir
+        self.disk_bytes = disk_bytes
+        self.encoders = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "active": 0, "completed": 0, "aborted": 0, "failed": 0, "rejected": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_file(self, path, stat, audio_format, bitrate):
+        key = hashlib.sha1(f"{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0{audio_format}-{bitrate}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + TRANSCODE_FORMATS[audio_format][1])
+
+    def lookup(self, cache_file):
+        """キャッシュにあればその stat を返す"""
+        try:
+            os.utime(cache_file)  # 最近使ったものとして残す
+            stat = os.stat(cache_file)
+        except OSError:
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+        with self.lock:
+            self.stats['hits'] += 1
+        return stat
+
+    def start(self, full_path, cache_file, audio_format, bitrate):
+        """エンコーダーを起動する。空きがなければ None"""
+        if not self.encoders.acquire(timeout=TRANSCODE_WAIT_SECONDS):
+            with self.lock:
+                self.stats['rejected'] += 1
+            return None
+        command = [FFMPEG_PATH, '-nostdin', '-v', 'error', '-i', full_path, '-vn',
+                   '-b:a', f'{bitrate}k', *TRANSCODE_FORMATS[audio_format][2], 'pipe:1']
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+        except OSError:
+            self.encoders.release()
+            raise
+        with self.lock:
+            self.stats['active'] += 1
+        return TranscodeStream(self, process, cache_file)
+
+    def finish(self, stream):
+        self.encoders.release()
+        if stream.finished and stream.output is not None:
+            os.replace(stream.tmp_file, stream.cache_file)
+            result = 'completed'
+        else:
+            try:
+                os.remove(stream.tmp_file)
+            except OSError:
+                pass
+            result = 'aborted' if stream.aborted else 'failed'
+        with self.lock:
+            self.stats['active'] -= 1
+            self.stats[result] += 1
+            prune = result == 'completed' and self.stats['completed'] % 10 == 0
+        if prune:
+            self.prune_disk()
+
+    def prune_disk(self):
+        """ディスクキャッシュが上限を超えたら最近使っていないものから削除"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, cache_file in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(cache_file)
+                total -= size
+            except OSError:
+                pass
+
+transcode_cache = TranscodeCache(TRANSCODE_CACHE_DIR, TRANSCODE_CACHE_BYTES, TRANSCODE_WORKERS)
+
+def transcode_music(path, full_path, stat, audio_format, started):
+    if audio_format not in TRANSCODE_FORMATS:
+        return jsonify({"error": f"Unsupported format: {audio_format}"}), 400
+    try:
+        bitrate = int(request.args.get('bitrate', TRANSCODE_DEFAULT_BITRATE))
+    except ValueError:
+        return jsonify({"error": "Invalid bitrate"}), 400
+    bitrate = min(max(bitrate, TRANSCODE_BITRATES[0]), TRANSCODE_BITRATES[1])
+    mimetype = TRANSCODE_FORMATS[audio_format][0]
+
+    cache_file = transcode_cache.cache_file(path, stat, audio_format, bitrate)
+    cached_stat = transcode_cache.lookup(cache_file)
+    if cached_stat is not None:
+        return send_audio_file(path, cache_file, cached_stat, mimetype, started)
+
+    headers = {'Accept-Ranges': 'none', 'Cache-Control': 'private, no-cache'}
+    if request.method == 'HEAD':
+        return Response(status=200, mimetype=mimetype, headers=headers)
+    try:
+        stream = transcode_cache.start(full_path, cache_file, audio_format, bitrate)
+    except OSError as e:
+        print(f"Error starting encoder: {e}")
+        return jsonify({"error": "Transcoding is not available"}), 503
+    if stream is None:
+        response = jsonify({"error": "Too many transcodes in progress"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    if not stream.read_first_chunk():
+        stream.close()
+        return jsonify({"error": "Failed to transcode"}), 500
+    # 長さは変換が終わるまで分からないので chunked で送る
+    return Response(stream, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+# 次に再生する曲の先読み
+prefetch_executor = concurrent.futures.ThreadPoolExecutor(2, thread_name_prefix='prefetch')
+recent_prefetches = collections.OrderedDict()  # {path: 先読みした時刻}
+prefetch_lock = threading.Lock()
+
+def prefetch_file(full_path):
+    """ファイルの先頭をページキャッシュに読み込んでおく"""
+    try:
+        with open(full_path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, STREAM_PREFETCH_BYTES, os.POSIX_FADV_WILLNEED)
+            else:
+                remaining = STREAM_PREFETCH_BYTES
+                while remaining > 0 and f.read(min(STREAM_CHUNK_BYTES, remaining)):
+                    remaining -= STREAM_CHUNK_BYTES
+    except OSError as e:
+        print(f"Error prefetching {full_path}: {e}")
+
+@app.route('/api/prefetch', methods=['POST'])
+@login_required
+def prefetch_music():
+    """キューの次の曲を先読みする"""
+    path = (request.get_json(silent=True) or {}).get('path')
+    full_path = safe_join(MUSIC_DIR, path) if isinstance(path, str) else None
+    if not full_path or not os.path.isfile(full_path):
+        return jsonify({"error": "File not found"}), 404
+
+    now = time.monotonic()
+    with prefetch_lock:
+        if now - recent_prefetches.get(path, -STREAM_PREFETCH_TTL) < STREAM_PREFETCH_TTL:
+            return jsonify({"success": True, "queued": False})
+        recent_prefetches[path] = now
+        recent_prefetches.move_to_end(path)
+        while len(recent_prefetches) > 100:
+            recent_prefetches.popitem(last=False)
+    prefetch_executor.submit(prefetch_file, full_path)
+    return jsonify({"success": True, "queued": True})
+
+@app.route('/api/stream-stats')
+@admin_required
+def get_stream_stats():
+    with stream_stats_lock:
+        recent = list(recent_streams)
+        stats = dict(stream_stats)
+    ttfbs = sorted(r['ttfb'] for r in recent)
+    throughputs = [r['throughput'] for r in recent if r['throughput']]
+    return jsonify(dict(
+        stats,
+        ttfb_median_ms=round(ttfbs[len(ttfbs) // 2] * 1000, 2) if ttfbs else None,
+        throughput_avg=round(sum(throughputs) / len(throughputs)) if throughputs else None,
+        transcode=dict(transcode_cache.stats),
+        recent=[dict(r, ttfb=round(r['ttfb'] * 1000, 2), duration=round(r['duration'], 3)) for r in recent[-20:]]
+    ))
+
+# アルバムアートのキャッシュ
+# 曲のパス -> 画像の内容ハッシュ の対応と、ハッシュ単位の画像データを分けて持つことで
+# 同じアルバムの曲が同じ画像を共有する。画像はメモリ上のLRUとディスクの2段構成
+class AlbumArtCache:
+    NOT_CACHED = object()
+    MIME_EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+
+    def __init__(self, cache_dir, memory_bytes, disk_bytes):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.refs = {}  # {path: (size, mtime, digest, mime)} digest が None なら画像なし
+        self.blobs = collections.OrderedDict()  # {key: (data, mime)}
+        self.blob_bytes = 0
+        self.disk_writes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def lookup(self, path, stat):
+        """曲のアート情報 (digest, mime) を返す。画像がなければ None、未取得なら NOT_CACHED"""
+        with self.lock:
+            ref = self.refs.get(path)
+        if ref is None:
+            with library_db() as conn:
+                row = conn.execute('SELECT size, mtime, digest, mime FROM album_art WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return self.NOT_CACHED
+            ref = tuple(row)
+            with self.lock:
+                self.refs[path] = ref
+        size, mtime, digest, mime = ref
+        # タグ編集などでファイルが変わっていたら取り直す
+        if (size, mtime) != (stat.st_size, stat.st_mtime):
+            self.invalidate([path])
+            return self.NOT_CACHED
+        return (digest, mime) if digest else None
+
+    def known_digests(self, paths):
+        """アートを取得済みの曲について {path: digest} を返す (画像なしは None、未取得の曲は含まない)"""
+        digests = {}
+        paths = list(paths)
+        with library_db() as conn:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                digests.update(conn.execute(f'SELECT path, digest FROM album_art WHERE path IN ({placeholders})', chunk))
+        return digests
+
+    def store(self, path, stat, data, mime):
+        digest = hashlib.sha1(data).hexdigest() if data else None
+        if data:
+            self.put_blob(digest, data, mime)
+        with self.lock:
+            self.refs[path] = (stat.st_size, stat.st_mtime, digest, mime)
+        with library_db() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO album_art (path, size, mtime, digest, mime) VALUES (?, ?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime, digest, mime))
+        return (digest, mime) if digest else None
+
+    def invalidate(self, paths):
+        with self.lock:
+            for path in paths:
+                self.refs.pop(path, None)
+        with library_db() as conn:
+            conn.executemany('DELETE FROM album_art WHERE path = ?', [(p,) for p in paths])
+
+    def blob_file(self, key, mime):
+        return os.path.join(self.cache_dir, key + self.MIME_EXTENSIONS.get(mime, '.img'))
+
+    def put_blob(self, key, data, mime, write_disk=True):
+        with self.lock:
+            if key in self.blobs:
+                self.blobs.move_to_end(key)
+                return
+            self.blobs[key] = (data, mime)
+            self.blob_bytes += len(data)
+            while self.blob_bytes > self.memory_bytes and len(self.blobs) > 1:
+                _, (old_data, _) = self.blobs.popitem(last=False)
+                self.blob_bytes -= len(old_data)
+                self.stats['evictions'] += 1
+        if not write_disk:
+            return
+        blob_file = self.blob_file(key, mime)
+        if not os.path.exists(blob_file):
+            tmp_file = f"{blob_file}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, blob_file)
+            self.disk_writes += 1
+            if self.disk_writes % 100 == 0:
+                self.prune_disk()
+
+    def get_blob(self, key, mime):
+        with self.lock:
+            blob = self.blobs.get(key)
+            if blob is not None:
+                self.blobs.move_to_end(key)
+                self.stats['hits'] += 1
+                return blob
+        try:
+            blob_file = self.blob_file(key, mime)
+            with open(blob_file, 'rb') as f:
+                data = f.read()
+            os.utime(blob_file)  # 最近使ったものとして残す (prune_disk は mtime の古い順に消す)
+        except OSError:
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+        self.put_blob(key, data, mime, write_disk=False)
+        with self.lock:
+            self.stats['hits'] += 1
+        return data, mime
+
+    def get_image(self, digest, mime, size=None):
+        """画像データを返す。size を指定するとその大きさのサムネイル (JPEG) を返す"""
+        if size is None or Image is None:
+            return self.get_blob(digest, mime)
+        key = f"{digest}_{size}"
+        thumbnail = self.get_blob(key, 'image/jpeg')
+        if thumbnail is not None:
+            return thumbnail
+        original = self.get_blob(digest, mime)
+        if original is None:
+            return None
+        try:
+            with Image.open(io.BytesIO(original[0])) as image:
+                image = image.convert('RGB')
+                image.thumbnail((size, size))
+                buffer = io.BytesIO()
+                image.save(buffer, format='JPEG', quality=85)
+        except Exception as e:
+            print(f"Error creating thumbnail: {e}")
+            return original
+        self.put_blob(key, buffer.getvalue(), 'image/jpeg')
+        return buffer.getvalue(), 'image/jpeg'
+
+    def prune_disk(self):
+        """ディスクキャッシュが上限を超えたら最近使っていないものから削除"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):  # 書き込み中のファイルは消さない
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, blob_file in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(blob_file)
+                total -= size
+            except OSError:
+                pass
+
+album_art_cache = AlbumArtCache(ALBUM_ART_CACHE_DIR, ALBUM_ART_MEMORY_BYTES, ALBUM_ART_DISK_BYTES)
+
+@on_library_changed
+def invalidate_album_art(changes):
+    if changes is not None:
+        album_art_cache.invalidate(changes['removed'] + changes['modified'])
+
+def extract_album_art(full_path):
+    """曲ファイルに埋め込まれた画像を (data, mime) で返す。なければ (None, None)"""
+    audio = MutagenFile(full_path)
+    if audio is None:
+        return None, None
+
+    # MP3 (ID3)
+    apic = next((audio.tags[key] for key in (audio.tags or {}).keys() if key.startswith('APIC')), None)
+    if apic is not None:
+        return apic.data, apic.mime
+    # FLAC / OGG (Vorbis Comment)
+    if hasattr(audio, 'pictures') and audio.pictures:
+        return audio.pictures[0].data, audio.pictures[0].mime
+    # MP4 (iTunes style)
+    if 'covr' in audio:
+        artwork = bytes(audio['covr'][0])
+        # covrはMIMEタイプを保持していない場合があるため推測
+        return artwork, 'image/jpeg' if artwork.startswith(b'\xff\xd8') else 'image/png'
+    return None, None
+
+def album_art_source(path):
+    """アートの取得元 (相対パス, フルパス) を返す。同じフォルダに cover.jpg などがあればそちらを優先"""
+    rel_dir, _, name = path.rpartition('/')
+    with structure_lock:
+        entry = library_dirs.get(rel_dir)
+        cover = entry['cover'] if entry and name in entry['files'] else None
+    if cover:
+        cover_path = f"{rel_dir}/{cover}"
+        return cover_path, os.path.join(MUSIC_DIR, cover_path)
+    return path, safe_join(MUSIC_DIR, path)
+
+def read_album_art(source_path, full_path):
+    if os.path.basename(source_path).lower() in FOLDER_COVER_NAMES:
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        return data, 'image/png' if source_path.lower().endswith('.png') else 'image/jpeg'
+    return extract_album_art(full_path)
+
+def album_art_headers(response, etag, last_modified):
+    if etag:
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = f'private, max-age={ALBUM_ART_MAX_AGE}'
+    return response
+
+def album_art_not_modified(etag, last_modified):
+    """If-None-Match / If-Modified-Since から 304 を返せるか"""
+    if request.if_none_match:
+        return bool(etag) and request.if_none_match.contains(etag)
+    return request.if_modified_since is not None and int(last_modified) <= request.if_modified_since.timestamp()
+
+@app.route('/api/album-art/<path:path>')
+@login_required
+def get_album_art(path):
+    size = request.args.get('size', type=int)
+    if size is not None and size not in THUMBNAIL_SIZES:
+        return jsonify({"error": f"size must be one of {list(THUMBNAIL_SIZES)}"}), 400
+
+    # キャッシュキーとして MUSIC_DIR からの相対パスを使用
+    path = path.replace('\\', '/')
+    source_path, full_path = album_art_source(path)
+    try:
+        stat = os.stat(full_path) if full_path else None
+    except OSError:
+        stat = None
+    if stat is None:
+        return jsonify({"error": "File not found"}), 404
+
+    for _ in range(2):
+        art = album_art_cache.lookup(source_path, stat)
+        if art is album_art_cache.NOT_CACHED:
+            # ファイルが更新されていなければ画像も変わっていないので、タグを解析せずに 304 を返す
+            if not request.if_none_match and album_art_not_modified(None, stat.st_mtime):
+                return album_art_headers(Response(status=304), None, stat.st_mtime)
+            try:
+                artwork, mime = read_album_art(source_path, full_path)
+            except Exception as e:
+                print(f"Error extracting album art: {e}")
+                return jsonify({"error": "Error extracting artwork"}), 500
+            art = album_art_cache.store(source_path, stat, artwork, mime)
+
+        if art is None:
+            return jsonify({"error": "No artwork found"}), 404
+
+        etag = art[0] if size is None else f"{art[0]}-{size}"
+        if album_art_not_modified(etag, stat.st_mtime):
+            return album_art_headers(Response(status=304), etag, stat.st_mtime)
+
+        image = album_art_cache.get_image(*art, size=size)
+        if image is not None:
+            return album_art_headers(Response(image[0], mimetype=image[1]), etag, stat.st_mtime)
+        # 画像がキャッシュから消えていたら取り直す
+        album_art_cache.invalidate([source_path])
+
+    return jsonify({"error": "Error extracting artwork"}), 500
+
+# 歌詞
+# 曲と同じ名前の .lrc (走査時に library_dirs に記録したもの) か、埋め込み歌詞 (ID3 の SYLT/USLT、
+# Vorbis の LYRICS、MP4 の ©lyr) を読む。時刻付きの歌詞は (開始ミリ秒の配列, 行の一覧) にしてキャッシュし、
+# 再生位置の行は二分探索で引く
+LYRICS_CACHE_ENTRIES = 256
+LRC_TIMESTAMP = re.compile(r'\[(\d+):(\d+(?:[.:]\d+)?)\]')
+LRC_OFFSET = re.compile(r'^\[offset:\s*([+-]?\d+)\]$', re.IGNORECASE)
+
+lyrics_cache = collections.OrderedDict()  # path -> (取得元, 歌詞 or None)
+lyrics_cache_lock = threading.Lock()
+
+def parse_lyrics_text(text):
+    """LRC 形式なら (開始ミリ秒の配列, 行の一覧)、時刻がなければ (None, 行の一覧) を返す"""
+    timed, plain = [], []
+    offset = 0
+    for line in text.splitlines():
+        line = line.strip()
+        match = LRC_OFFSET.match(line)
+        if match:
+            offset = int(match.group(1))  # 正の値なら歌詞を早める
+            continue
+        stamps, position = [], 0
+        while (match := LRC_TIMESTAMP.match(line, position)):
+            stamps.append(int(match.group(1)) * 60000 + round(float(match.group(2).replace(':', '.')) * 1000))
+            position = match.end()
+        if stamps:
+            # [00:12.00][01:30.00]歌詞 のように1行に複数の時刻が付くこともある
+            timed.extend((stamp, line[position:].strip()) for stamp in stamps)
+        else:
+            plain.append(line)
+    if not timed:
+        while plain and not plain[-1]:
+            plain.pop()
+        while plain and not plain[0]:
+            plain.pop(0)
+        return None, plain
+    timed.sort(key=lambda item: item[0])
+    return array.array('i', (max(stamp - offset, 0) for stamp, _ in timed)), [line for _, line in timed]
+
+def decode_lyrics_file(data):
+    for encoding in ('utf-8-sig', 'utf-16', 'cp932'):
+        if encoding == 'utf-16' and not data.startswith((b'\xff\xfe', b'\xfe\xff')):
+            continue
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('latin-1')
+
+def read_embedded_lyrics(full_path):
+    """曲ファイルに埋め込まれた歌詞を (開始ミリ秒の配列 or None, 行の一覧) で返す。なければ None"""
+    audio = MutagenFile(full_path)
+    if audio is None or not audio.tags:
+        return None
+    tags = audio.tags
+    # MP3 / WAV (ID3)。時刻付きの SYLT (ミリ秒単位のもの) を優先する
+    if hasattr(tags, 'getall'):
+        for frame in tags.getall('SYLT'):
+            if frame.format == 2 and frame.text:
+                timed = sorted(((stamp, text.strip()) for text, stamp in frame.text), key=lambda item: item[0])
+                return array.array('i', (stamp for stamp, _ in timed)), [text for _, text in timed]
+        texts = [frame.text for frame in tags.getall('USLT') if frame.text.strip()]
+    # MP4 (iTunes style)
+    elif '\xa9lyr' in tags:
+        texts = list(tags['\xa9lyr'])
+    # FLAC / OGG (Vorbis Comment)
+    else:
+        texts = [text for key in ('LYRICS', 'UNSYNCEDLYRICS') for text in (tags.get(key) or [])]
+    texts = [text for text in texts if text.strip()]
+    return parse_lyrics_text(texts[0]) if texts else None
+
+def lyrics_source(path):
+    """歌詞の取得元を (相対パス, mtime) で返す。同じ名前の .lrc があればそちらを優先。曲がなければ None"""
+    rel_dir, _, name = path.rpartition('/')
+    stem = os.path.splitext(name)[0]
+    with structure_lock:
+        entry = library_dirs.get(rel_dir)
+        if entry is None or name not in entry['files']:
+            return None
+        for lyrics_name, mtime in entry['lyrics'].items():
+            if os.path.splitext(lyrics_name)[0] == stem:
+                return f"{rel_dir}/{lyrics_name}", mtime
+        return path, entry['files'][name][1]
+
+def load_lyrics(path):
+    """曲の歌詞を {"source", "offsets", "lines"} で返す。歌詞がなければ None。
+    取得元の mtime はインデックスから取るので、キャッシュにあればファイルを開かない"""
+    source = lyrics_source(path)
+    if source is None:
+        return None
+    with lyrics_cache_lock:
+        cached = lyrics_cache.get(path)
+        if cached is not None and cached[0] == source:
+            lyrics_cache.move_to_end(path)
+            return cached[1]
+
+    source_path = source[0]
+    full_path = safe_join(MUSIC_DIR, source_path)
+    if source_path != path:
+        with open(full_path, 'rb') as f:
+            parsed = parse_lyrics_text(decode_lyrics_file(f.read()))
+    else:
+        parsed = read_embedded_lyrics(full_path)
+    lyrics = None
+    if parsed and parsed[1]:
+        lyrics = {"source": 'lrc' if source_path != path else 'embedded', "offsets": parsed[0], "lines": parsed[1]}
+    with lyrics_cache_lock:
+        lyrics_cache[path] = (source, lyrics)
+        lyrics_cache.move_to_end(path)
+        while len(lyrics_cache) > LYRICS_CACHE_ENTRIES:
+            lyrics_cache.popitem(last=False)
+    return lyrics
+
+@on_library_changed
+def invalidate_lyrics(changes):
+    with lyrics_cache_lock:
+        if changes is None:
+            lyrics_cache.clear()
+        else:
+            for path in changes['removed'] + changes['modified']:
+                lyrics_cache.pop(path, None)
+
+@app.route('/api/lyrics/<path:path>')
+@login_required
+def get_lyrics(path):
+    """曲の歌詞。?position=<秒> を付けると、その再生位置で表示する行だけを返す"""
+    entry, _ = lookup_song(path.replace('\\', '/'))
+    if entry is None:
+        return jsonify({"error": "Song not found"}), 404
+    try:
+        lyrics = load_lyrics(entry[2])
+    except Exception as e:
+        print(f"Error reading lyrics: {e}")
+        return jsonify({"error": "Error reading lyrics"}), 500
+    if lyrics is None:
+        return jsonify({"error": "No lyrics found"}), 404
+
+    offsets, lines = lyrics['offsets'], lyrics['lines']
+    position = request.args.get('position')
+    if position is not None:
+        try:
+            position = float(position)
+        except ValueError:
+            position = math.nan
+        if not math.isfinite(position):
+            return jsonify({"error": "position must be a finite number"}), 400
+        if offsets is None:
+            return jsonify({"error": "Lyrics are not synced"}), 400
+        index = bisect.bisect_right(offsets, int(position * 1000)) - 1
+        return jsonify({
+            "index": index,
+            "text": lines[index] if index >= 0 else None,
+            "start": offsets[index] / 1000 if index >= 0 else None,
+            "next": offsets[index + 1] / 1000 if index + 1 < len(offsets) else None,
+        })
+    if offsets is None:
+        return jsonify({"source": lyrics['source'], "synced": False, "lines": [{"text": line} for line in lines]})
+    return jsonify({"source": lyrics['source'], "synced": True,
+                    "lines": [{"time": offset / 1000, "text": line} for offset, line in zip(offsets, lines)]})
+
+# 曲の検索用インデックス。ライブラリ変更のたびに作り直して丸ごと差し替える
+song_index = {"by_name": {}, "by_path": {}}
+
+@on_library_changed
+def rebuild_song_index(changes):
+    by_name, by_path = {}, {}
+    with structure_lock:
+        rel_paths = [rel_path for rel_path, _ in iter_tree_files(library_dirs)]
+    for rel_path in sorted(rel_paths):
+        artist, album, song = track_location(rel_path)
+        entry = (artist, album, rel_path)
+        by_name.setdefault(song, []).append(entry)
+        by_path[rel_path] = entry
+        # アーティスト直下の曲は "Artist/アルバム不明/Song" でも引けるようにする
+        by_path.setdefault(f"{artist}/{album}/{song}", entry)
+    global song_index
+    song_index = {"by_name": by_name, "by_path": by_path}
+
+def lookup_song(song_id):
+    """ファイル名、または "Artist/Album/Song" 形式のパスから曲を探す"""
+    index = song_index
+    if '/' in song_id:
+        entry = index['by_path'].get(song_id)
+        return entry, 1 if entry else 0
+    entries = index['by_name'].get(song_id, [])
+    return (entries[0] if entries else None), len(entries)
+
+def song_data(entry, matches=1):
+    artist, album, rel_path = entry
+    # 音楽ストリーミング用のパスを生成
+    song_path = url_for('stream_music', path=rel_path)
+    return {"artist": artist, "album": album, "songName": rel_path.rsplit('/', 1)[-1], "path": song_path, "matches": matches}
+
+@app.route('/get-song-data/<path:song_name>')
+@login_required
+def get_song_data(song_name):
+    entry, matches = lookup_song(song_name)
+    if entry:
+        return jsonify(song_data(entry, matches))
+    
+    return jsonify({"error": "Song not found"}), 404
+
+@app.route('/api/song-data', methods=['POST'])
+@login_required
+def get_song_data_batch():
+    """複数の曲をまとめて解決する。見つからない曲は null"""
+    songs = (request.get_json(silent=True) or {}).get('songs')
+    if not isinstance(songs, list):
+        return jsonify({"error": "songs must be a list"}), 400
+    
+    results = []
+    for song_id in songs:
+        entry, matches = lookup_song(song_id) if isinstance(song_id, str) else (None, 0)
+        results.append(song_data(entry, matches) if entry else None)
+    return jsonify({"songs": results})
+
+# プレイリスト関連のAPI (ユーザー別)
+# 曲は {"id": tracks.id, "path": 保存・修復した時点のパス} で参照する。読み込むときに id から今のパスを引くので、
+# ファイルが移動・名前変更されても参照が切れない (パスが変わっていたら保存し直す)
+class PlaylistError(Exception):
+    pass
+
+def playlist_item_path(item):
+    """クライアントから送られた曲 ({"artist", "album", "song"} / {"path"} / "Artist/Album/Song") の相対パス"""
+    if isinstance(item, dict) and isinstance(item.get('path'), str):
+        song_id = item['path']
+    elif isinstance(item, dict) and all(isinstance(item.get(key), str) for key in ('artist', 'album', 'song')):
+        song_id = f"{item['artist']}/{item['album']}/{item['song']}"
+    elif isinstance(item, str):
+        song_id = item
+    else:
+        raise PlaylistError("Each item needs artist, album and song (or path)")
+    entry, _ = lookup_song(song_id)
+    return entry[2] if entry else song_id
+
+def query_tracks(column, values):
+    """tracks を id または path で引いて {id: path} を返す"""
+    found = {}
+    values = list(values)
+    with library_db() as conn:
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            found.update(conn.execute(f'SELECT id, path FROM tracks WHERE {column} IN ({placeholders})', chunk))
+    return found
+
+def make_playlist_items(items):
+    if not isinstance(items, list):
+        raise PlaylistError("items must be a list")
+    paths = [playlist_item_path(item) for item in items]
+    ids = {path: track_id for track_id, path in query_tracks('path', set(paths)).items()}
+    return [{"id": ids.get(path), "path": path} for path in paths]
+
+def repair_playlist_items(items):
+    """id から今のパスを引き直した項目の一覧を返す。id が消えていればパスで引き直す (旧形式の項目もここで変換する)"""
+    items = [item if isinstance(item, dict) and 'path' in item else {"id": None, "path": playlist_item_path(item)}
+             for item in items]
+    current = query_tracks('id', {item['id'] for item in items if item.get('id') is not None})
+    lost = {item['path'] for item in items if item.get('id') not in current}
+    by_path = {path: track_id for track_id, path in query_tracks('path', lost).items()} if lost else {}
+    repaired = []
+    for item in items:
+        if item.get('id') in current:
+            repaired.append({"id": item['id'], "path": current[item['id']]})
+        elif item['path'] in by_path:
+            repaired.append({"id": by_path[item['path']], "path": item['path']})
+        else:
+            repaired.append(item)  # ライブラリから消えた曲 (戻ってきたときのためにそのまま残す)
+    return repaired
+
+def resolve_playlist_items(items):
+    """プレイリストの項目をタグ・再生時間・アートのURLまで付けて返す"""
+    metadata = load_track_metadata(item['path'] for item in items)
+    resolved = []
+    for item in items:
+        path = item['path']
+        parts = path.split('/')
+        artist, album, song = track_location(path) if len(parts) >= 2 else ('', UNKNOWN_ALBUM, path)
+        missing = path not in metadata
+        resolved.append(dict(metadata.get(path, {}), id=item.get('id'), path=path, artist=artist, album=album, song=song,
+                             url=None if missing else url_for('stream_music', path=path),
+                             art=None if missing else album_art_url(path), missing=missing))
+    return resolved
+
+def playlist_response(payload, playlist):
+    response = jsonify(payload)
+    response.set_etag(str(playlist.get('version', 0)))
+    return response
+
+@app.route('/save_playlist', methods=['POST'])
+@login_required
+def save_playlist():
+    data = request.json
+    playlist_name = data.get('name')
+    playlist_items = data.get('items')
+    
+    if not playlist_name or not playlist_items:
+        return jsonify({"error": "Name and items are required"}), 400
+    
+    try:
+        items = make_playlist_items(playlist_items)
+    except PlaylistError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Safe name generation
+    safe_name = "".join([c for c in playlist_name if c.isalpha() or c.isdigit() or c==' ' or c=='_']).rstrip()
     
-    if not os.path.exists(user_file):
+    def store_playlist(user_data):
+        previous = user_data.setdefault('playlists', {}).get(safe_name) or {}
+        user_data['playlists'][safe_name] = {
+            "name": playlist_name,
+            "items": items,
+            "created_at": datetime.datetime.now().isoformat(),
+            "version": previous.get('version', 0) + 1
+        }
+        return True
+    
+    if user_store.update(session['user_id'], store_playlist) is None:
         return jsonify({"error": "User not found"}), 404
     
-    with open(user_file, 'r', encoding='utf-8') as file_handle:
-        user_data = json.load(file_handle)
+    return jsonify({"success": True, "name": playlist_name})
+
+@app.route('/playlists')
+@login_required
+def get_playlists():
+    user_data = user_store.get(session['user_id'])
+    
+    if user_data is None:
+        return jsonify({"error": "User not found"}), 404
     
     playlists = []
     for playlist_id, playlist in user_data.get('playlists', {}).items():
@@ -394,42 +3170,783 @@ def get_playlists():
 @app.route('/playlist/<string:playlist_id>')
 @login_required
 def get_playlist(playlist_id):
-    user_file = os.path.join(USERS_DIR, f"{session['user_id']}.json")
+    """曲を解決した一覧を返す。ETag はプレイリストの版 (PATCH の If-Match に使う)"""
+    user_data = user_store.get(session['user_id'])
     
-    if not os.path.exists(user_file):
+    if user_data is None:
         return jsonify({"error": "User not found"}), 404
     
-    with open(user_file, 'r', encoding='utf-8') as file_handle:
-        user_data = json.load(file_handle)
-    
     playlist = user_data.get('playlists', {}).get(playlist_id)
     
     if not playlist:
         return jsonify({"error": "Playlist not found"}), 404
     
-    return jsonify(playlist["items"])
+    items = repair_playlist_items(playlist["items"])
+    if items != playlist["items"]:
+        def store_repaired(data):
+            current = data.get('playlists', {}).get(playlist_id)
+            if current is None or current["items"] != playlist["items"]:
+                return False  # 読んだ後に変更されていたら修復は次回に回す
+            current["items"] = items
+            return True
+        user_store.update(session['user_id'], store_repaired)
+    
+    return playlist_response(resolve_playlist_items(items), playlist)
+
+def apply_playlist_operation(items, op):
+    """append / remove / move を items (リスト) に適用する"""
+    if not isinstance(op, dict):
+        raise PlaylistError("Each operation must be an object")
+    kind = op.get('op')
+    if kind == 'append':
+        new_items = op['resolved']
+        index = op.get('index', len(items))
+        if not is_json_integer(index) or not 0 <= index <= len(items):
+            raise PlaylistError("index out of range")
+        items[index:index] = new_items
+    elif kind == 'remove':
+        indices = op.get('indices', [op.get('index')])
+        if not isinstance(indices, list):
+            raise PlaylistError("indices must be a list")
+        if not all(is_json_integer(i) and 0 <= i < len(items) for i in indices):
+            raise PlaylistError("index out of range")
+        for i in sorted(set(indices), reverse=True):
+            del items[i]
+    elif kind == 'move':
+        source, target = op.get('from'), op.get('to')
+        if not all(is_json_integer(i) and 0 <= i < len(items) for i in (source, target)):
+            raise PlaylistError("index out of range")
+        items.insert(target, items.pop(source))
+    else:
+        raise PlaylistError(f"Unknown operation: {kind}")
+
+@app.route('/playlist/<string:playlist_id>', methods=['PATCH'])
+@login_required
+def patch_playlist(playlist_id):
+    """{"operations": [{"op": "append", "items": [...], "index"?}, {"op": "remove", "indices": [...]},
+    {"op": "move", "from": i, "to": j}]} を順に適用する。If-Match でプレイリストの版を指定できる"""
+    operations = (request.get_json(silent=True) or {}).get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operations must be a non-empty list"}), 400
+    try:
+        # 曲の解決 (DBアクセス) はユーザーファイルのロックの外で済ませておく
+        operations = [dict(op, resolved=make_playlist_items(op.get('items')))
+                      if isinstance(op, dict) and op.get('op') == 'append' else op for op in operations]
+    except PlaylistError as e:
+        return jsonify({"error": str(e)}), 400
+
+    result = {}
+    def apply_operations(user_data):
+        playlist = user_data.get('playlists', {}).get(playlist_id)
+        if playlist is None:
+            result['error'] = ("Playlist not found", 404)
+            return False
+        if request.if_match and not request.if_match.contains(str(playlist.get('version', 0))):
+            result['error'] = ("Playlist was modified", 412)
+            return False
+        items = list(playlist["items"])
+        try:
+            for op in operations:
+                apply_playlist_operation(items, op)
+        except PlaylistError as e:
+            result['error'] = (str(e), 400)
+            return False
+        playlist["items"] = items
+        playlist["version"] = playlist.get('version', 0) + 1
+        result['playlist'] = playlist
+        return True
+    
+    if user_store.update(session['user_id'], apply_operations) is None:
+        return jsonify({"error": "User not found"}), 404
+    if 'error' in result:
+        message, status = result['error']
+        return jsonify({"error": message}), status
+    playlist = result['playlist']
+    return playlist_response({"success": True, "count": len(playlist["items"]), "version": playlist["version"]}, playlist)
 
 @app.route('/delete_playlist/<string:playlist_id>', methods=['DELETE'])
 @login_required
 def delete_playlist(playlist_id):
-    user_file = os.path.join(USERS_DIR, f"{session['user_id']}.json")
+    def remove_playlist(user_data):
+        if playlist_id not in user_data.get('playlists', {}):
+            return False
+        del user_data['playlists'][playlist_id]
+        return True
     
-    if not os.path.exists(user_file):
+    result = user_store.update(session['user_id'], remove_playlist)
+    if result is None:
         return jsonify({"error": "User not found"}), 404
-    
-    with open(user_file, 'r', encoding='utf-8') as file_handle:
-        user_data = json.load(file_handle)
-    
-    if playlist_id not in user_data.get('playlists', {}):
+    if result is False:
         return jsonify({"error": "Playlist not found"}), 404
     
-    del user_data['playlists'][playlist_id]
-    
-    with open(user_file, 'w', encoding='utf-8') as file_handle:
-        json.dump(user_data, file_handle, ensure_ascii=False, indent=2)
-    
     return jsonify({"success": True})
 
+# スマートプレイリスト
+# 追加日・アーティスト・ジャンルの二次インデックスをメモリに持ち、ルールを評価するときは
+# 一番絞り込める索引から候補を作って残りの条件で確認する。結果はインデックスの版ごとにキャッシュする
+SMART_MAX_LIMIT = 1000
+SMART_NAME_SCAN_THRESHOLD = 5000  # 名前順で、候補がこれより多いときは名前順の一覧から拾う
+SMART_SORTS = ('added', 'name', 'random')
+SMART_PRESETS = {
+    "recently-added": {"name": "最近追加した曲", "rules": {"sort": "added", "limit": 100}},
+    "random": {"name": "ランダム50曲", "rules": {"sort": "random", "limit": 50}},
+}
+
+@functools.lru_cache(maxsize=65536)
+def smart_keys(value, split=False):
+    """索引のキー (正規化した文字列)。ジャンルは "Rock; Pop" のような複数指定も分けて登録する"""
+    keys = {normalize_search_text(value)} if value else set()
+    if split and value:
+        keys.update(normalize_search_text(part) for part in value.replace('/', ';').replace(',', ';').split(';'))
+    keys.discard('')
+    return frozenset(keys)
+
+@functools.lru_cache(maxsize=65536)
+def smart_artist_keys(artist, tag_artist):
+    """フォルダ名とタグのどちらのアーティスト名でも引けるようにする"""
+    return smart_keys(artist) | smart_keys(tag_artist)
+
+class SmartIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.ready = False
+        self.reset()
+
+    def reset(self):
+        self.tracks = {}  # path -> (id, added, アーティストのキー, ジャンルのキー)
+        self.paths_by_id = {}
+        # どの一覧も (-added, path) の昇順 = 新しい順。期間の条件は先頭からの範囲になる
+        self.by_added = []
+        self.by_name = []  # パスの昇順 (アーティスト/アルバム/曲名順)
+        self.by_artist = {}  # キー -> [(-added, path)]
+        self.by_genre = {}
+
+    @staticmethod
+    def entry(row):
+        path, track_id, added, tag_artist, genre = row
+        artist, _, _ = track_location(path)
+        return (track_id, added or 0.0, smart_artist_keys(artist, tag_artist), smart_keys(genre, split=True))
+
+    def add(self, path, entry):
+        self.tracks[path] = entry
+        self.paths_by_id[entry[0]] = path
+        item = (-entry[1], path)
+        bisect.insort(self.by_added, item)
+        bisect.insort(self.by_name, path)
+        for key in entry[2]:
+            bisect.insort(self.by_artist.setdefault(key, []), item)
+        for key in entry[3]:
+            bisect.insort(self.by_genre.setdefault(key, []), item)
+
+    def remove(self, path):
+        entry = self.tracks.pop(path, None)
+        if entry is None:
+            return
+        if self.paths_by_id.get(entry[0]) == path:
+            del self.paths_by_id[entry[0]]
+        item = (-entry[1], path)
+        index = bisect.bisect_left(self.by_name, path)
+        if index < len(self.by_name) and self.by_name[index] == path:
+            del self.by_name[index]
+        lists = [self.by_added] + [self.by_artist.get(key) for key in entry[2]] + [self.by_genre.get(key) for key in entry[3]]
+        for items in lists:
+            if items is None:
+                continue
+            index = bisect.bisect_left(items, item)
+            if index < len(items) and items[index] == item:
+                del items[index]
+        for keys, by_key in ((entry[2], self.by_artist), (entry[3], self.by_genre)):
+            for key in keys:
+                if not by_key.get(key, True):
+                    del by_key[key]
+
+    def rebuild(self, rows):
+        tracks = {row[0]: self.entry(row) for row in rows}
+        by_added = sorted((-entry[1], path) for path, entry in tracks.items())
+        by_artist, by_genre = {}, {}
+        for item in by_added:  # 新しい順に追加するので各一覧も並んだ状態になる
+            entry = tracks[item[1]]
+            for key in entry[2]:
+                by_artist.setdefault(key, []).append(item)
+            for key in entry[3]:
+                by_genre.setdefault(key, []).append(item)
+        by_name = sorted(tracks)
+        with self.lock:
+            self.tracks, self.by_added, self.by_name = tracks, by_added, by_name
+            self.paths_by_id = {entry[0]: path for path, entry in tracks.items()}
+            self.by_artist, self.by_genre = by_artist, by_genre
+            self.version += 1
+            self.ready = True
+
+    def update(self, removed, rows, existing_only=False):
+        with self.lock:
+            for path in removed:
+                self.remove(path)
+            for row in rows:
+                if existing_only and row[0] not in self.tracks:
+                    continue
+                self.remove(row[0])
+                self.add(row[0], self.entry(row))
+            self.version += 1
+
+    def evaluate(self, rules, exclude=()):
+        """ルールに合う曲を [{"id", "path"}] で返す。(曲の一覧, 条件に合う曲の総数)。
+        exclude は除く曲の id (最近再生した曲など。候補に比べて少ない前提)"""
+        limit = rules.get('limit', 100)
+        with self.lock:
+            # 一番短い一覧を候補にし、残りの条件は曲ごとのキーで確認する
+            conditions = []
+            if rules.get('artist'):
+                key = normalize_search_text(rules['artist'])
+                conditions.append((self.by_artist.get(key, []), 2, key))
+            if rules.get('genre'):
+                key = normalize_search_text(rules['genre'])
+                conditions.append((self.by_genre.get(key, []), 3, key))
+            base = min(conditions, key=lambda c: len(c[0]))[0] if conditions else self.by_added
+            end = len(base)
+            cutoff = None
+            if rules.get('added_days'):
+                cutoff = time.time() - rules['added_days'] * 86400
+                end = bisect.bisect_right(base, (-cutoff, chr(0x10ffff)))
+            others = [(field, key) for items, field, key in conditions if items is not base]
+            if others:
+                candidates = [item for item in itertools.islice(base, end)
+                              if all(key in self.tracks[item[1]][field] for field, key in others)]
+            else:
+                candidates = base if end == len(base) else base[:end]
+            # 除く曲のうち条件に合うもの (候補に入っているもの) だけを数える
+            skipped = set()
+            for track_id in exclude:
+                path = self.paths_by_id.get(track_id)
+                entry = self.tracks.get(path)
+                if entry is not None and (cutoff is None or entry[1] >= cutoff) and \
+                        all(key in entry[field] for _, field, key in conditions):
+                    skipped.add(path)
+            total = len(candidates) - len(skipped)
+
+            sort = rules.get('sort', 'added')
+            if sort == 'random':
+                rng = random.Random(rules.get('seed', 0))
+                picked = rng.sample(range(len(candidates)), min(limit + len(skipped), len(candidates)))
+                paths = [candidates[i][1] for i in picked if candidates[i][1] not in skipped][:limit]
+            elif sort == 'name' and total > SMART_NAME_SCAN_THRESHOLD:
+                # 候補が多いときは名前順の一覧を先頭から見ていけば、すぐに limit 件そろう
+                paths = []
+                for path in self.by_name:
+                    entry = self.tracks[path]
+                    if (cutoff is None or entry[1] >= cutoff) and path not in skipped and \
+                            all(key in entry[field] for _, field, key in conditions):
+                        paths.append(path)
+                        if len(paths) >= limit:
+                            break
+            elif sort == 'name':
+                paths = heapq.nsmallest(limit, (path for _, path in candidates if path not in skipped))
+            else:
+                paths = [path for _, path in itertools.islice(
+                    (item for item in candidates if item[1] not in skipped), limit)]
+            return [{"id": self.tracks[path][0], "path": path} for path in paths], total
+
+smart_index = SmartIndex()
+smart_cache = {}  # ルールのJSON -> (インデックスの版, 曲の一覧, 総数)
+smart_cache_lock = threading.Lock()
+SMART_CACHE_ENTRIES = 256
+
+def smart_index_rows(paths=None):
+    query = 'SELECT path, id, added, tag_artist, genre FROM tracks'
+    with library_db() as conn:
+        if paths is None:
+            return conn.execute(query).fetchall()
+        paths = list(paths)
+        rows = []
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            rows.extend(conn.execute(f"{query} WHERE path IN ({', '.join('?' * len(chunk))})", chunk))
+        return rows
+
+@on_library_changed
+def update_smart_index(changes):
+    if changes is None:
+        threading.Thread(target=lambda: smart_index.rebuild(smart_index_rows()), name='smart-index', daemon=True).start()
+    else:
+        smart_index.update(changes['removed'], smart_index_rows(changes['added'] + changes['modified']))
+
+@on_catalog_updated
+def update_smart_tags(paths):
+    smart_index.update([], smart_index_rows(paths), existing_only=True)
+
+def is_json_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)  # JSON の true/false は int として読まれる
+
+def is_json_number(value):
+    return (is_json_integer(value) or isinstance(value, float)) and math.isfinite(value)
+
+def parse_smart_rules(rules):
+    """ルール {"artist"?, "genre"?, "added_days"?, "not_played_days"?, "sort"?, "limit"?, "seed"?} を検証して返す"""
+    if not isinstance(rules, dict):
+        raise PlaylistError("rules must be an object")
+    parsed = {}
+    for key in ('artist', 'genre'):
+        if rules.get(key) is not None:
+            if not isinstance(rules[key], str) or not rules[key].strip():
+                raise PlaylistError(f"{key} must be a non-empty string")
+            parsed[key] = rules[key].strip()
+    if rules.get('added_days') is not None:
+        if not is_json_number(rules['added_days']) or rules['added_days'] <= 0:
+            raise PlaylistError("added_days must be a positive number")
+        parsed['added_days'] = rules['added_days']
+    if rules.get('not_played_days') is not None:
+        if not is_json_number(rules['not_played_days']) or rules['not_played_days'] <= 0:
+            raise PlaylistError("not_played_days must be a positive number")
+        parsed['not_played_days'] = rules['not_played_days']
+    parsed['sort'] = rules.get('sort', 'added')
+    if parsed['sort'] not in SMART_SORTS:
+        raise PlaylistError(f"sort must be one of {list(SMART_SORTS)}")
+    parsed['limit'] = rules.get('limit', 100)
+    if not is_json_integer(parsed['limit']) or not 1 <= parsed['limit'] <= SMART_MAX_LIMIT:
+        raise PlaylistError(f"limit must be between 1 and {SMART_MAX_LIMIT}")
+    if rules.get('seed') is not None:
+        if not is_json_integer(rules['seed']):
+            raise PlaylistError("seed must be an integer")
+        parsed['seed'] = rules['seed']
+    return parsed
+
+def evaluate_smart_rules(rules, username):
+    if rules.get('sort') == 'random' and 'seed' not in rules:
+        rules = dict(rules, seed=datetime.date.today().toordinal())  # 指定がなければ日替わり
+    key = json.dumps(rules, sort_keys=True, ensure_ascii=False)
+    version = smart_index.version
+    if rules.get('not_played_days'):
+        # 再生履歴を使うルールはユーザーごとに、新しい再生が記録されるまでキャッシュする
+        key = json.dumps([username, key], ensure_ascii=False)
+        version = (version, play_history_version())
+    with smart_cache_lock:
+        cached = smart_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2], True
+    exclude = recently_played_ids(username, rules['not_played_days']) if rules.get('not_played_days') else ()
+    items, total = smart_index.evaluate(rules, exclude)
+    with smart_cache_lock:
+        if len(smart_cache) >= SMART_CACHE_ENTRIES and key not in smart_cache:
+            smart_cache.pop(next(iter(smart_cache)))
+        smart_cache[key] = (version, items, total)
+    return items, total, False
+
+def smart_playlist_response(playlist_id, name, rules):
+    started = time.perf_counter()
+    items, total, cached = evaluate_smart_rules(rules, session['user_id'])
+    elapsed = (time.perf_counter() - started) * 1000
+    return jsonify({
+        "id": playlist_id,
+        "name": name,
+        "rules": rules,
+        "total": total,
+        "ready": smart_index.ready,
+        "cached": cached,
+        "elapsed_ms": round(elapsed, 2),
+        "items": resolve_playlist_items(items)
+    })
+
+@app.route('/api/smart-playlists')
+@login_required
+def get_smart_playlists():
+    user_data = user_store.get(session['user_id'])
+    if user_data is None:
+        return jsonify({"error": "User not found"}), 404
+    playlists = [{"id": playlist_id, "name": preset["name"], "rules": preset["rules"], "builtin": True}
+                 for playlist_id, preset in SMART_PRESETS.items()]
+    playlists.extend({"id": playlist_id, "name": playlist["name"], "rules": playlist["rules"], "builtin": False}
+                     for playlist_id, playlist in user_data.get('smart_playlists', {}).items())
+    return jsonify(playlists)
+
+@app.route('/api/smart-playlists', methods=['POST'])
+@login_required
+def create_smart_playlist():
+    data = request.get_json(silent=True) or {}
+    name = data.get('name')
+    if not isinstance(name, str) or not name.strip():
+        return jsonify({"error": "name is required"}), 400
+    try:
+        rules = parse_smart_rules(data.get('rules'))
+    except PlaylistError as e:
+        return jsonify({"error": str(e)}), 400
+
+    playlist_id = uuid.uuid4().hex[:12]
+    def store_smart_playlist(user_data):
+        user_data.setdefault('smart_playlists', {})[playlist_id] = {
+            "name": name.strip(),
+            "rules": rules,
+            "created_at": datetime.datetime.now().isoformat()
+        }
+        return True
+    if user_store.update(session['user_id'], store_smart_playlist) is None:
+        return jsonify({"error": "User not found"}), 404
+    return jsonify({"success": True, "id": playlist_id, "rules": rules})
+
+@app.route('/api/smart-playlists/preview', methods=['POST'])
+@login_required
+def preview_smart_playlist():
+    try:
+        rules = parse_smart_rules((request.get_json(silent=True) or {}).get('rules'))
+    except PlaylistError as e:
+        return jsonify({"error": str(e)}), 400
+    return smart_playlist_response(None, None, rules)
+
+@app.route('/api/smart-playlists/<string:playlist_id>')
+@login_required
+def get_smart_playlist(playlist_id):
+    """ルールを評価した結果を、曲を解決して返す"""
+    if playlist_id in SMART_PRESETS:
+        preset = SMART_PRESETS[playlist_id]
+        return smart_playlist_response(playlist_id, preset["name"], preset["rules"])
+    user_data = user_store.get(session['user_id'])
+    if user_data is None:
+        return jsonify({"error": "User not found"}), 404
+    playlist = user_data.get('smart_playlists', {}).get(playlist_id)
+    if playlist is None:
+        return jsonify({"error": "Playlist not found"}), 404
+    return smart_playlist_response(playlist_id, playlist["name"], playlist["rules"])
+
+@app.route('/api/smart-playlists/<string:playlist_id>', methods=['DELETE'])
+@login_required
+def delete_smart_playlist(playlist_id):
+    def remove_smart_playlist(user_data):
+        if playlist_id not in user_data.get('smart_playlists', {}):
+            return False
+        del user_data['smart_playlists'][playlist_id]
+        return True
+
+    result = user_store.update(session['user_id'], remove_smart_playlist)
+    if result is None:
+        return jsonify({"error": "User not found"}), 404
+    if result is False:
+        return jsonify({"error": "Playlist not found"}), 404
+    return jsonify({"success": True})
+
+# 再生履歴
+# 再生イベントはプロセスごとにメモリに溜め、一定数か一定時間ごとにまとめて plays テーブルに追記する。
+# 同じトランザクションで曲・アーティストごとの再生回数も更新するので、集計では plays を走査しない
+PLAY_FLUSH_SECONDS = 5.0
+PLAY_FLUSH_EVENTS = 200
+PLAY_HISTORY_DAYS = int(os.environ.get('PLAY_HISTORY_DAYS', 365))  # 個々の再生記録を残す日数 (回数の集計は消えない)
+PLAY_COMPACT_SECONDS = 24 * 3600
+
+play_buffer = []  # (username, track_id, path, played_at, duration)
+play_buffer_lock = threading.Lock()
+play_flush_condition = threading.Condition(play_buffer_lock)
+play_worker_started = False
+play_stats = {"recorded": 0, "flushed": 0, "dropped": 0, "flushes": 0, "compacted": 0}
+last_play_compaction = 0.0
+
+def write_plays(events):
+    """再生イベントを1つのトランザクションでDBに書き、再生回数を足し込む"""
+    track_counts, artist_counts = {}, {}
+    for username, track_id, path, played_at, _ in events:
+        count, last = track_counts.get((username, track_id), (0, 0.0))
+        track_counts[username, track_id] = (count + 1, max(last, played_at))
+        artist = track_location(path)[0]
+        count, last = artist_counts.get((username, artist), (0, 0.0))
+        artist_counts[username, artist] = (count + 1, max(last, played_at))
+    with library_db() as conn:
+        conn.executemany('INSERT INTO plays (username, track_id, path, played_at, duration) VALUES (?, ?, ?, ?, ?)', events)
+        conn.executemany(
+            'INSERT INTO play_counts (username, track_id, count, last_played) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(username, track_id) DO UPDATE SET count = count + excluded.count, '
+            'last_played = MAX(last_played, excluded.last_played)',
+            [(*key, *value) for key, value in track_counts.items()])
+        conn.executemany(
+            'INSERT INTO artist_play_counts (username, artist, count, last_played) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(username, artist) DO UPDATE SET count = count + excluded.count, '
+            'last_played = MAX(last_played, excluded.last_played)',
+            [(*key, *value) for key, value in artist_counts.items()])
+
+def flush_plays():
+    """溜めた再生イベントをDBに書き、再生回数を足し込む"""
+    with play_buffer_lock:
+        events = play_buffer[:]
+        play_buffer.clear()
+    if not events:
+        return 0
+    written = len(events)
+    try:
+        write_plays(events)
+    except sqlite3.IntegrityError:
+        # 制約に反するイベントが混ざっている。1件ずつ書き直し、書けないものは捨てる (戻すと永久に詰まる)
+        written = 0
+        for event in events:
+            try:
+                write_plays([event])
+                written += 1
+            except sqlite3.IntegrityError as e:
+                play_stats['dropped'] += 1
+                print(f"Dropping invalid play event {event}: {e}")
+    except sqlite3.Error:
+        with play_buffer_lock:
+            play_buffer[:0] = events  # 次の機会に書き直す
+        raise
+    play_stats['flushed'] += written
+    play_stats['flushes'] += 1
+    return written
+
+def compact_plays():
+    """古い再生記録を消す (再生回数の集計には影響しない)"""
+    global last_play_compaction
+    last_play_compaction = time.time()
+    with library_db() as conn:
+        deleted = conn.execute('DELETE FROM plays WHERE played_at < ?',
+                               (time.time() - PLAY_HISTORY_DAYS * 86400,)).rowcount
+    play_stats['compacted'] += deleted
+    return deleted
+
+def play_flush_worker():
+    while True:
+        with play_flush_condition:
+            play_flush_condition.wait_for(lambda: len(play_buffer) >= PLAY_FLUSH_EVENTS, timeout=PLAY_FLUSH_SECONDS)
+        try:
+            flush_plays()
+            if background_owner and time.time() - last_play_compaction > PLAY_COMPACT_SECONDS:
+                compact_plays()
+        except Exception as e:
+            print(f"Error writing play history: {e}")
+
+def record_plays(events):
+    global play_worker_started
+    with play_flush_condition:
+        play_buffer.extend(events)
+        play_stats['recorded'] += len(events)
+        if len(play_buffer) >= PLAY_FLUSH_EVENTS:
+            play_flush_condition.notify()
+        if not play_worker_started:
+            play_worker_started = True
+            threading.Thread(target=play_flush_worker, name='play-history', daemon=True).start()
+
+atexit.register(flush_plays)
+
+def play_history_version():
+    """最後に記録された再生の id (新しい再生が書かれると変わる)"""
+    with library_db() as conn:
+        return conn.execute('SELECT MAX(id) FROM plays').fetchone()[0] or 0
+
+def recently_played_ids(username, days):
+    with library_db() as conn:
+        return {row[0] for row in conn.execute(
+            'SELECT track_id FROM play_counts WHERE username = ? AND last_played >= ?',
+            (username, time.time() - days * 86400))}
+
+@app.route('/api/plays', methods=['POST'])
+@login_required
+def post_plays():
+    """再生を記録する。{"artist", "album", "song"} / {"path"} に "played_at"?, "duration"? (聴いた秒数) を付けたもの、
+    または {"events": [...]}"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    events = data['events'] if isinstance(data.get('events'), list) else [data]
+    if not all(isinstance(event, dict) for event in events):
+        return jsonify({"error": "Each event must be an object"}), 400
+    now = time.time()
+    try:
+        paths = [playlist_item_path(event) for event in events]
+    except PlaylistError as e:
+        return jsonify({"error": str(e)}), 400
+    ids = {path: track_id for track_id, path in query_tracks('path', set(paths)).items()}
+    accepted = []
+    for event, path in zip(events, paths):
+        if path not in ids:
+            continue
+        played_at, duration = event.get('played_at'), event.get('duration')
+        # 数値でない・有限でない・負の値は受け付けない (NaN は DB で NULL になり書き込めなくなる)
+        if any(value is not None and not (is_json_number(value) and value >= 0) for value in (played_at, duration)):
+            continue
+        played_at = now if played_at is None else min(float(played_at), now)
+        accepted.append((session['user_id'], ids[path], path, played_at, duration))
+    record_plays(accepted)
+    return jsonify({"accepted": len(accepted), "ignored": len(events) - len(accepted)}), 202
+
+def play_limit(default=50):
+    _, limit = page_args(default_limit=default, max_limit=500)
+    return limit
+
+@app.route('/api/plays/recent')
+@login_required
+def recent_plays():
+    """最近の再生 (まだDBに書いていないものも含む)"""
+    limit = play_limit()
+    username = session['user_id']
+    with play_buffer_lock:
+        pending = [(path, played_at) for user, _, path, played_at, _ in play_buffer if user == username]
+    with library_db() as conn:
+        rows = conn.execute('SELECT path, played_at FROM plays WHERE username = ? ORDER BY played_at DESC LIMIT ?',
+                            (username, limit)).fetchall()
+    plays = heapq.nlargest(limit, pending + rows, key=lambda row: row[1])
+    return jsonify([dict(zip(('artist', 'album', 'song'), track_location(path)), path=path, played_at=played_at)
+                    for path, played_at in plays])
+
+@app.route('/api/plays/top-artists')
+@login_required
+def top_artists():
+    with library_db() as conn:
+        rows = conn.execute('SELECT artist, count, last_played FROM artist_play_counts WHERE username = ? '
+                            'ORDER BY count DESC, last_played DESC LIMIT ?', (session['user_id'], play_limit(20))).fetchall()
+    return jsonify([{"artist": artist, "count": count, "last_played": last_played} for artist, count, last_played in rows])
+
+@app.route('/api/plays/top-tracks')
+@login_required
+def top_tracks():
+    with library_db() as conn:
+        rows = conn.execute('SELECT tracks.path, play_counts.count, play_counts.last_played FROM play_counts '
+                            'JOIN tracks ON tracks.id = play_counts.track_id WHERE play_counts.username = ? '
+                            'ORDER BY play_counts.count DESC, play_counts.last_played DESC LIMIT ?',
+                            (session['user_id'], play_limit())).fetchall()
+    return jsonify([dict(zip(('artist', 'album', 'song'), track_location(path)), path=path, count=count,
+                         last_played=last_played) for path, count, last_played in rows])
+
+@app.route('/api/plays/counts', methods=['POST'])
+@login_required
+def play_counts():
+    """{"paths": [...]} の曲の再生回数と最後に再生した日時"""
+    data = request.get_json(silent=True)
+    paths = data.get('paths') if isinstance(data, dict) else None
+    if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+        return jsonify({"error": "paths must be a list of strings"}), 400
+    ids = query_tracks('path', set(paths))
+    counts = {}
+    with library_db() as conn:
+        id_list = list(ids)
+        for i in range(0, len(id_list), 500):
+            chunk = id_list[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            for track_id, count, last_played in conn.execute(
+                    f'SELECT track_id, count, last_played FROM play_counts WHERE username = ? AND track_id IN ({placeholders})',
+                    (session['user_id'], *chunk)):
+                counts[ids[track_id]] = {"count": count, "last_played": last_played}
+    return jsonify({path: counts.get(path, {"count": 0, "last_played": None}) for path in paths})
+
+# メタデータの編集
+class MetadataEditError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+# ファイルごとのロック (同じ曲を同時に書き換えたり移動したりしないように)
+# プロセス内はスレッドのロック、ワーカー間はロックファイルで排他する
+file_locks = {}  # {パス: [ロック, 使用中の数]}
+file_locks_lock = threading.Lock()
+FILE_LOCK_STRIPES = 256  # ロックファイルの数 (パスのハッシュで振り分ける)
+
+@contextlib.contextmanager
+def locked_files(*paths):
+    keys = sorted({os.path.normcase(os.path.abspath(path)) for path in paths})  # 常に同じ順で取ってデッドロックを防ぐ
+    stripes = sorted({int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % FILE_LOCK_STRIPES for key in keys})
+    with file_locks_lock:
+        entries = [file_locks.setdefault(key, [threading.Lock(), 0]) for key in keys]
+        for entry in entries:
+            entry[1] += 1
+    try:
+        with contextlib.ExitStack() as stack:
+            for lock, _ in entries:
+                stack.enter_context(lock)
+            for stripe in stripes:
+                stack.enter_context(process_file_lock(f"{stripe:03d}"))
+            yield
+    finally:
+        with file_locks_lock:
+            for key, entry in zip(keys, entries):
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del file_locks[key]
+
+def sanitize_path_part(part):
+    return "".join([c for c in part if c not in '<>:"/\\|?*']).strip()
+
+def resolve_song_path(artist, album, song):
+    old_path = safe_join(MUSIC_DIR, artist, album, song)
+    if (old_path is None or not os.path.exists(old_path)) and album == UNKNOWN_ALBUM:
+        # Songs directly under the artist folder are indexed as Artist/アルバム不明/Song
+        old_path = safe_join(MUSIC_DIR, artist, song)
+    if old_path is None or not os.path.isfile(old_path):
+        raise MetadataEditError(f"File not found: {artist}/{album}/{song}", 404)
+    return old_path
+
+def write_track_tags(full_path, title=None, artist=None, album=None):
+    """タイトル・アーティスト・アルバムのタグを書き換える (None のものはそのまま)"""
+    audio = MutagenFile(full_path)
+    if audio is None:
+        return False
+    from mutagen.id3 import ID3, TIT2, TPE1, TALB
+
+    if audio.tags is None:
+        audio.add_tags()
+
+    for value, frame, key in ((title, TIT2, 'title'), (artist, TPE1, 'artist'), (album, TALB, 'album')):
+        if value is None:
+            continue
+        if isinstance(audio.tags, ID3):
+            audio.tags.add(frame(encoding=3, text=[value]))
+        else:
+            # FLAC, Ogg, m4a, etc. usually support dict-like access
+            audio[key] = [value]
+    audio.save()
+    return True
+
+def rename_track_row(old_path, new_path):
+    """移動した曲の行のパスを先に書き換えて、tracks.id (プレイリストからの参照) を引き継ぐ。
+    タグを書き換えると (size, mtime) が変わり、走査では移動と判定できないため"""
+    old_rel, new_rel = to_rel_path(old_path), to_rel_path(new_path)
+    if old_rel is None or new_rel is None or old_rel == new_rel:
+        return
+    with library_db() as conn:
+        conn.execute('UPDATE OR IGNORE tracks SET path = ? WHERE path = ?', (new_rel, old_rel))
+
+def edit_track_metadata(artist, album, song, new_artist=None, new_album=None, new_title=None):
+    """タグを書き換え、ファイルを アーティスト/アルバム/曲名 に移動する。(元のパス, 新しいパス) を返す。
+    インデックスの更新は呼び出し側でまとめて行う"""
+    old_path = resolve_song_path(artist, album, song)
+    loose = os.path.dirname(old_path) == os.path.join(MUSIC_DIR, artist)
+
+    # We follow the structure: MUSIC_DIR / Artist / Album / Song (keep original extension)
+    s_artist = (sanitize_path_part(new_artist) or "Unknown Artist") if new_artist is not None else artist
+    if new_album is not None:
+        new_dir = os.path.join(MUSIC_DIR, s_artist, sanitize_path_part(new_album) or "Unknown Album")
+    elif loose:
+        new_dir = os.path.join(MUSIC_DIR, s_artist)
+    else:
+        new_dir = os.path.join(MUSIC_DIR, s_artist, album)
+    if new_title is not None:
+        new_filename = (sanitize_path_part(new_title) or "Unknown Title") + os.path.splitext(song)[1]
+    else:
+        new_filename = os.path.basename(old_path)
+    new_path = os.path.join(new_dir, new_filename)
+
+    with locked_files(old_path, new_path):
+        if not os.path.isfile(old_path):
+            raise MetadataEditError(f"File not found: {artist}/{album}/{song}", 404)
+        moving = os.path.abspath(old_path) != os.path.abspath(new_path)
+        # If only case changed on case-insensitive FS, it might be the same file
+        if moving and os.path.exists(new_path) and \
+                os.path.abspath(old_path).lower() != os.path.abspath(new_path).lower():
+            raise MetadataEditError("Destination file already exists", 409)
+
+        # 1. Update tags using mutagen
+        if write_track_tags(old_path, new_title, new_artist, new_album):
+            album_art_cache.invalidate([to_rel_path(old_path)])
+
+        # 2. Rename/Move file to match new metadata if changed
+        if moving:
+            os.makedirs(new_dir, exist_ok=True)
+            os.rename(old_path, new_path)
+            rename_track_row(old_path, new_path)
+
+            # Clean up old empty directories
+            old_dir = os.path.dirname(os.path.abspath(old_path))
+            try:
+                while old_dir != os.path.abspath(MUSIC_DIR) and not os.listdir(old_dir):
+                    os.rmdir(old_dir)
+                    old_dir = os.path.dirname(old_dir)
+            except OSError:
+                pass # Directory not empty or other error
+    return old_path, new_path
+
 @app.route('/api/edit-metadata', methods=['POST'])
 @login_required
 @admin_required
@@ -445,139 +3962,612 @@ def edit_metadata():
     
     if not all([artist, album, song, new_artist, new_album, new_title]):
         return jsonify({"error": "Missing required fields"}), 400
-    
-    old_path = os.path.join(MUSIC_DIR, artist, album, song)
-    if not os.path.exists(old_path):
-        # Try fallback for "アルバム不明" or other edge cases
-        # In current save_music_structure_to_json, it might be just Artist/Song or Artist/Album/Song
-        if album == "アルバム不明":
-             old_path = os.path.join(MUSIC_DIR, artist, song)
-        
-        if not os.path.exists(old_path):
-            return jsonify({"error": f"File not found: {old_path}"}), 404
-    
-    # Sanitize inputs for path usage
-    def sanitize_path_part(part):
-        return "".join([c for c in part if c not in '<>:"/\\|?*']).strip()
-    
-    s_artist = sanitize_path_part(new_artist) or "Unknown Artist"
-    s_album = sanitize_path_part(new_album) or "Unknown Album"
-    s_title = sanitize_path_part(new_title) or "Unknown Title"
-    
+
     try:
-        # 1. Update tags using mutagen
-        audio = MutagenFile(old_path)
-        if audio is not None:
-            # Check for ID3 tags (MP3)
-            from mutagen.id3 import ID3, TIT2, TPE1, TALB
-            
-            if audio.tags is None:
-                audio.add_tags()
-            
-            if isinstance(audio.tags, ID3):
-                audio.tags.add(TIT2(encoding=3, text=[new_title]))
-                audio.tags.add(TPE1(encoding=3, text=[new_artist]))
-                audio.tags.add(TALB(encoding=3, text=[new_album]))
-            else:
-                # FLAC, Ogg, m4a, etc. usually support dict-like access
-                audio['title'] = [new_title]
-                audio['artist'] = [new_artist]
-                audio['album'] = [new_album]
-            
-            audio.save()
-        
-        # 2. Rename/Move file to match new metadata if changed
-        # We follow the structure: MUSIC_DIR / Artist / Album / Song
-        # Keep original extension
-        ext = os.path.splitext(song)[1]
-        new_filename = s_title + ext
-        
-        new_dir = os.path.join(MUSIC_DIR, s_artist, s_album)
-        os.makedirs(new_dir, exist_ok=True)
-        
-        new_path = os.path.join(new_dir, new_filename)
-        
-        # If the path is actually different, move it
-        if os.path.abspath(old_path) != os.path.abspath(new_path):
-            # Check if destination already exists
-            if os.path.exists(new_path):
-                # If only case changed on case-insensitive FS, it might be the same file
-                if os.path.abspath(old_path).lower() != os.path.abspath(new_path).lower():
-                    return jsonify({"error": "Destination file already exists"}), 409
-            
-            os.rename(old_path, new_path)
-            
-            # Clean up old empty directories
-            old_album_dir = os.path.dirname(old_path)
-            old_artist_dir = os.path.dirname(old_album_dir)
-            
-            try:
-                if not os.listdir(old_album_dir):
-                    os.rmdir(old_album_dir)
-                if not os.listdir(old_artist_dir):
-                    os.rmdir(old_artist_dir)
-            except OSError:
-                pass # Directory not empty or other error
-        
-        # 3. Rescan library
-        save_music_structure_to_json(MUSIC_DIR)
-        
+        old_path, new_path = edit_track_metadata(artist, album, song, new_artist, new_album, new_title)
+        # 3. Rescan only the affected folders
+        update_library([old_path, new_path])
         return jsonify({"success": True})
-        
+    except MetadataEditError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         print(f"Error editing metadata: {e}")
         return jsonify({"error": str(e)}), 500
 
+# まとめて編集するジョブ
+# 受け付けたジョブはこのプロセスの1つのスレッドで順に処理し、最後に一度だけインデックスを更新する。
+# 進み具合はどのワーカーからでも確認できるようDBに書く
+METADATA_JOB_MAX_ERRORS = 100
+
+metadata_job_queue = queue.Queue()
+metadata_job_worker_started = False
+metadata_job_worker_lock = threading.Lock()
+
+def check_metadata_fields(op, fields):
+    """新しい値は文字列か省略 (null) だけを受け付ける"""
+    for field in fields:
+        if op.get(field) is not None and not isinstance(op[field], str):
+            raise MetadataEditError(f"{field} must be a string")
+
+def metadata_job_operations(data):
+    """リクエストを (artist, album, song, 新しいアーティスト, 新しいアルバム, 新しいタイトル) のリストにする"""
+    fields = ('newArtist', 'newAlbum', 'newTitle')
+    if not isinstance(data, dict) or not isinstance(data.get('operations') or [], list):
+        raise MetadataEditError("operations must be a list")
+    operations = []
+    for op in data.get('operations') or []:
+        if not isinstance(op, dict) or not all(isinstance(op.get(key), str) and op.get(key) for key in ('artist', 'album', 'song')):
+            raise MetadataEditError("Each operation needs artist, album and song")
+        check_metadata_fields(op, fields)
+        operations.append((op['artist'], op['album'], op['song'], *(op.get(field) for field in fields)))
+
+    # アルバム全体に同じ変更を適用する
+    target = data.get('album')
+    if isinstance(target, dict):
+        if not all(isinstance(target.get(key), str) and target.get(key) for key in ('artist', 'album')):
+            raise MetadataEditError("album needs artist and album")
+        check_metadata_fields(target, ('newArtist', 'newAlbum'))
+        with structure_lock:
+            songs = list(music_structure.get(target.get('artist'), {}).get(target.get('album'), []))
+        if not songs:
+            raise MetadataEditError("Album not found", 404)
+        changes = [target.get(field) for field in ('newArtist', 'newAlbum')]
+        operations.extend((target['artist'], target['album'], song, *changes, None) for song in songs)
+
+    if not operations:
+        raise MetadataEditError("No operations")
+    for op in operations:
+        if all(value is None for value in op[3:]):
+            raise MetadataEditError(f"Nothing to change for {op[2]}")
+    return operations
+
+def run_metadata_job(job_id, operations):
+    with library_db() as conn:
+        conn.execute("UPDATE metadata_jobs SET status = 'running' WHERE id = ?", (job_id,))
+    paths = []
+    completed = failed = 0
+    errors = []
+    for i, op in enumerate(operations):
+        try:
+            paths.extend(edit_track_metadata(*op))
+            completed += 1
+        except Exception as e:
+            failed += 1
+            if len(errors) < METADATA_JOB_MAX_ERRORS:
+                errors.append({"artist": op[0], "album": op[1], "song": op[2], "error": str(e)})
+        if i % 10 == 9 or i == len(operations) - 1:
+            with library_db() as conn:
+                conn.execute('UPDATE metadata_jobs SET completed = ?, failed = ?, errors = ? WHERE id = ?',
+                             (completed, failed, json.dumps(errors, ensure_ascii=False), job_id))
+    try:
+        if paths:
+            update_library(paths)
+        status = 'done'
+    except Exception as e:
+        print(f"Error updating library after metadata job: {e}")
+        status = 'failed'
+    with library_db() as conn:
+        conn.execute('UPDATE metadata_jobs SET status = ?, finished = ? WHERE id = ?', (status, time.time(), job_id))
+
+def metadata_job_worker():
+    while True:
+        job_id, operations = metadata_job_queue.get()
+        try:
+            run_metadata_job(job_id, operations)
+        except Exception as e:
+            print(f"Error running metadata job {job_id}: {e}")
+
+@app.route('/api/edit-metadata/jobs', methods=['POST'])
+@login_required
+@admin_required
+def create_metadata_job():
+    """{"operations": [{"artist", "album", "song", "newArtist"?, "newAlbum"?, "newTitle"?}]} または
+    {"album": {"artist", "album", "newArtist"?, "newAlbum"?}} を受け付けてジョブIDを返す"""
+    global metadata_job_worker_started
+    try:
+        operations = metadata_job_operations(request.get_json(silent=True) or {})
+    except MetadataEditError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    job_id = uuid.uuid4().hex
+    with library_db() as conn:
+        conn.execute("INSERT INTO metadata_jobs (id, username, status, total, created) VALUES (?, ?, 'queued', ?, ?)",
+                     (job_id, session['user_id'], len(operations), time.time()))
+    metadata_job_queue.put((job_id, operations))
+    with metadata_job_worker_lock:
+        if not metadata_job_worker_started:
+            metadata_job_worker_started = True
+            threading.Thread(target=metadata_job_worker, name='metadata-jobs', daemon=True).start()
+    return jsonify({"job_id": job_id, "total": len(operations)}), 202
+
+@app.route('/api/edit-metadata/jobs/<job_id>')
+@login_required
+@admin_required
+def get_metadata_job(job_id):
+    with library_db() as conn:
+        row = conn.execute('SELECT status, total, completed, failed, errors, created, finished '
+                           'FROM metadata_jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return jsonify({"error": "Job not found"}), 404
+    status, total, completed, failed, errors, created, finished = row
+    return jsonify({
+        "job_id": job_id,
+        "status": status,
+        "total": total,
+        "completed": completed,
+        "failed": failed,
+        "progress": (completed + failed) / total if total else 1.0,
+        "errors": json.loads(errors) if errors else [],
+        "elapsed": round((finished or time.time()) - created, 3),
+    })
+
+def upload_destination(filename):
+    """アップロードされたファイル名 (フォルダを含む) から保存先を決める。音声ファイル以外は None"""
+    # Sanitize and normalize path separators
+    filename = filename.replace('\\', '/')
+    parts = filename.split('/')
+
+    # Filter out empty parts, '..' and hidden names
+    parts = [p for p in parts if p and p != '..' and not p.startswith('.')]
+
+    if not parts:
+        return None
+
+    # Determine destination path based on depth
+    if len(parts) == 1:
+        save_path = os.path.join(MUSIC_DIR, "Unknown Artist", "Unknown Album", parts[0])
+    elif len(parts) == 2:
+        save_path = os.path.join(MUSIC_DIR, "Unknown Artist", parts[0], parts[1])
+    else:
+        # Use the last 3 parts to ensure Artist/Album/Song structure
+        save_path = os.path.join(MUSIC_DIR, *parts[-3:])
+
+    # Ensure the file is an audio file
+    if not save_path.lower().endswith(SUPPORTED_EXTENSIONS):
+        return None
+    return save_path
+
+def move_into_place(tmp_file, save_path):
+    """一時ファイルを保存先に置き換える (途中の状態が見えないように)"""
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    try:
+        os.replace(tmp_file, save_path)
+    except OSError:
+        # 別のファイルシステムの場合は保存先の隣にコピーしてから置き換える
+        staged = os.path.join(os.path.dirname(save_path), f".{uuid.uuid4().hex}.part")
+        shutil.copyfile(tmp_file, staged)
+        os.replace(staged, save_path)
+        os.remove(tmp_file)
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_files():
     if 'files' not in request.files:
         return jsonify({"error": "No files part"}), 400
-    
+
     files = request.files.getlist('files')
-    uploaded_count = 0
-    
+    saved_paths = []
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+
     for file in files:
         if file.filename == '':
             continue
-        
-        # Sanitize and normalize path separators
-        filename = file.filename.replace('\\', '/')
-        parts = filename.split('/')
-        
-        # Filter out empty parts and '..'
-        parts = [p for p in parts if p and p != '..']
-        
-        if not parts:
+        save_path = upload_destination(file.filename)
+        if save_path is None:
             continue
+        tmp_file = upload_part_file(uuid.uuid4().hex)
+        file.save(tmp_file)
+        move_into_place(tmp_file, save_path)
+        saved_paths.append(save_path)
+
+    # Update music structure
+    update_library(saved_paths)
+
+    return jsonify({"success": True, "count": len(saved_paths)})
+
+# 分割・再開可能なアップロード
+# POST /api/uploads でバッチを作り、ファイルごとに PUT /api/uploads/<id> (Upload-Offset ヘッダー付き)
+# でチャンクを送る。チャンクは MUSIC_DIR/.uploads の一時ファイルに追記しながらハッシュを計算し、
+# 最後まで届いたら保存先に移動する。同じ内容のファイルが既にあれば置き換えない。
+# バッチの全ファイルが終わったところで一度だけ update_library を呼ぶ
+UPLOAD_TMP_DIR = os.path.join(MUSIC_DIR, '.uploads')  # 保存先と同じファイルシステムに置いて rename で移動する
+UPLOAD_CHUNK_BYTES = 256 * 1024
+UPLOAD_REQUEST_BYTES = 8 * 1024 * 1024  # クライアントが1回の PUT で送る大きさ
+UPLOAD_EXPIRE_SECONDS = 24 * 3600  # 放置されたアップロードを消すまでの時間
+
+upload_hashers = {}  # {upload_id: (ハッシュ済みのバイト数, sha1)} このプロセスで受け取った分の途中経過
+upload_locks = {}
+upload_locks_lock = threading.Lock()
+
+def upload_part_file(upload_id):
+    return os.path.join(UPLOAD_TMP_DIR, upload_id + '.part')
+
+def file_sha1(path, hasher=None):
+    hasher = hasher or hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b''):
+            hasher.update(chunk)
+    return hasher
+
+def get_upload(upload_id):
+    with library_db() as conn:
+        row = conn.execute(
+            'SELECT u.id, u.batch, u.path, u.size, u.status, b.username FROM uploads u '
+            'JOIN upload_batches b ON b.id = u.batch WHERE u.id = ?', (upload_id,)).fetchone()
+    if row is None or row[5] != session['user_id']:
+        return None
+    return dict(zip(('id', 'batch', 'path', 'size', 'status', 'username'), row))
 
-        # Determine destination path based on depth
-        if len(parts) == 1:
-            save_path = os.path.join(MUSIC_DIR, "Unknown Artist", "Unknown Album", parts[0])
-        elif len(parts) == 2:
-            save_path = os.path.join(MUSIC_DIR, "Unknown Artist", parts[0], parts[1])
-        elif len(parts) >= 3:
-            # Use the last 3 parts to ensure Artist/Album/Song structure
-            relevant_parts = parts[-3:]
-            save_path = os.path.join(MUSIC_DIR, *relevant_parts)
+def set_upload_status(upload_id, status, digest=None):
+    with library_db() as conn:
+        conn.execute('UPDATE uploads SET status = ?, sha1 = COALESCE(?, sha1), updated = ? WHERE id = ?',
+                     (status, digest, time.time(), upload_id))
+
+def finish_upload(upload, digest):
+    """届いたファイルを保存先に移動する。既に同じ内容のファイルがあれば捨てる"""
+    part_file = upload_part_file(upload['id'])
+    save_path = os.path.join(MUSIC_DIR, upload['path'])
+    try:
+        if os.path.isfile(save_path) and os.path.getsize(save_path) == upload['size'] \
+                and file_sha1(save_path).hexdigest() == digest:
+            os.remove(part_file)
+            status = 'duplicate'
         else:
-             continue
-        
-        # Ensure the file is an audio file
-        if not save_path.lower().endswith(('.mp3', '.wav', '.ogg', '.m4a', '.flac')):
-             continue
+            move_into_place(part_file, save_path)
+            status = 'done'
+    except OSError as e:
+        print(f"Error saving upload {upload['path']}: {e}")
+        status = 'failed'
+        try:
+            os.remove(part_file)
+        except OSError:
+            pass
+    set_upload_status(upload['id'], status, digest)
+    return status
 
-        # Create directories
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        
-        # Save file
-        file.save(save_path)
-        uploaded_count += 1
-        
-    # Update music structure
-    save_music_structure_to_json(MUSIC_DIR)
-    
-    return jsonify({"success": True, "count": uploaded_count})
+def complete_upload_batch(batch_id, cancel=False):
+    """全ファイルが終わったバッチをライブラリに反映する (一度だけ)。cancel=True なら未完了のものを取り消す"""
+    with library_db() as conn:
+        unfinished = [row[0] for row in conn.execute(
+            "SELECT id FROM uploads WHERE batch = ? AND status = 'uploading'", (batch_id,))]
+        if unfinished and not cancel:
+            return False
+        conn.execute("UPDATE uploads SET status = 'cancelled', updated = ? WHERE batch = ? AND status = 'uploading'",
+                     (time.time(), batch_id))
+        claimed = conn.execute("UPDATE upload_batches SET status = 'indexed' WHERE id = ? AND status = 'open'",
+                               (batch_id,)).rowcount
+        paths = [row[0] for row in conn.execute(
+            "SELECT path FROM uploads WHERE batch = ? AND status = 'done'", (batch_id,))]
+    for upload_id in unfinished:
+        upload_hashers.pop(upload_id, None)
+        try:
+            os.remove(upload_part_file(upload_id))
+        except OSError:
+            pass
+    if claimed and paths:
+        update_library([os.path.join(MUSIC_DIR, p) for p in paths])
+    return bool(claimed)
+
+def remove_expired_uploads():
+    """放置されたアップロードの一時ファイルと記録を消す"""
+    expired = time.time() - UPLOAD_EXPIRE_SECONDS
+    with library_db() as conn:
+        batches = [row[0] for row in conn.execute('SELECT id FROM upload_batches WHERE created < ?', (expired,))]
+        for batch_id in batches:
+            conn.execute('DELETE FROM uploads WHERE batch = ?', (batch_id,))
+            conn.execute('DELETE FROM upload_batches WHERE id = ?', (batch_id,))
+    with os.scandir(UPLOAD_TMP_DIR) as it:
+        for entry in it:
+            try:
+                if entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload_batch():
+    """アップロードするファイルの一覧 ({"files": [{"path", "size"}]}) を受け取ってバッチを作る"""
+    files = (request.get_json(silent=True) or {}).get('files')
+    if not isinstance(files, list) or not files:
+        return jsonify({"error": "No files"}), 400
+
+    batch_id = uuid.uuid4().hex
+    now = time.time()
+    uploads, skipped = [], []
+    for item in files:
+        path = item.get('path') if isinstance(item, dict) else None
+        size = item.get('size') if isinstance(item, dict) else None
+        save_path = upload_destination(path) if isinstance(path, str) else None
+        if save_path is None or not isinstance(size, int) or size < 0:
+            skipped.append(path)
+            continue
+        uploads.append({"id": uuid.uuid4().hex, "path": path, "dest": to_rel_path(save_path), "size": size})
+    if not uploads:
+        return jsonify({"error": "No audio files", "skipped": skipped}), 400
+
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    remove_expired_uploads()
+    for upload in uploads:
+        open(upload_part_file(upload['id']), 'wb').close()
+    with library_db() as conn:
+        conn.execute("INSERT INTO upload_batches (id, username, created, status) VALUES (?, ?, ?, 'open')",
+                     (batch_id, session['user_id'], now))
+        conn.executemany("INSERT INTO uploads (id, batch, path, size, status, updated) VALUES (?, ?, ?, ?, 'uploading', ?)",
+                         [(u['id'], batch_id, u['dest'], u['size'], now) for u in uploads])
+    return jsonify({"batch_id": batch_id, "files": uploads, "skipped": skipped,
+                    "chunk_size": UPLOAD_REQUEST_BYTES})
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_upload_offset(upload_id):
+    """再開するときに受信済みのバイト数を返す"""
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+    try:
+        offset = os.path.getsize(upload_part_file(upload_id))
+    except OSError:
+        offset = upload['size'] if upload['status'] in ('done', 'duplicate') else 0
+    return jsonify({"offset": offset, "size": upload['size'], "status": upload['status']})
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+    if upload['status'] != 'uploading':
+        return jsonify({"error": "Upload already finished", "status": upload['status']}), 409
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Upload-Offset header is required"}), 400
+
+    with upload_locks_lock:
+        lock = upload_locks.setdefault(upload_id, threading.Lock())
+    with lock:
+        part_file = upload_part_file(upload_id)
+        try:
+            received = os.path.getsize(part_file)
+        except OSError:
+            return jsonify({"error": "Upload expired"}), 410
+        if offset != received:
+            return jsonify({"error": "Offset mismatch", "offset": received}), 409
+
+        hashed, hasher = upload_hashers.get(upload_id, (0, None))
+        if hasher is None or hashed != received:
+            # 別のワーカーが受け取った分やサーバー再起動前の分は読み直してハッシュを追いつかせる
+            hasher = file_sha1(part_file)
+        try:
+            with open(part_file, 'ab') as f:
+                while received < upload['size']:
+                    chunk = request.stream.read(min(UPLOAD_CHUNK_BYTES, upload['size'] - received))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    received += len(chunk)
+        finally:
+            # 途中で切断されても受け取った分は残し、続きから再開できるようにする
+            upload_hashers[upload_id] = (received, hasher)
+        if received < upload['size']:
+            return jsonify({"offset": received, "status": "uploading"})
+        status = finish_upload(upload, hasher.hexdigest())
+        upload_hashers.pop(upload_id, None)
+    with upload_locks_lock:
+        upload_locks.pop(upload_id, None)
+
+    complete_upload_batch(upload['batch'])
+    return jsonify({"offset": received, "status": status})
+
+@app.route('/api/uploads/batches/<batch_id>/finish', methods=['POST'])
+@login_required
+def finish_upload_batch(batch_id):
+    """未完了のファイルを取り消してバッチを終える"""
+    with library_db() as conn:
+        row = conn.execute('SELECT username FROM upload_batches WHERE id = ?', (batch_id,)).fetchone()
+    if row is None or row[0] != session['user_id']:
+        return jsonify({"error": "Batch not found"}), 404
+    complete_upload_batch(batch_id, cancel=True)
+    return get_upload_batch(batch_id)
+
+@app.route('/api/uploads/batches/<batch_id>')
+@login_required
+def get_upload_batch(batch_id):
+    """バッチの進み具合と転送速度"""
+    with library_db() as conn:
+        batch = conn.execute('SELECT username, created, status FROM upload_batches WHERE id = ?', (batch_id,)).fetchone()
+        rows = conn.execute('SELECT id, path, size, status, updated FROM uploads WHERE batch = ? ORDER BY path',
+                            (batch_id,)).fetchall()
+    if batch is None or batch[0] != session['user_id']:
+        return jsonify({"error": "Batch not found"}), 404
+
+    files = []
+    counts = collections.Counter()
+    for upload_id, path, size, status, updated in rows:
+        if status == 'uploading':
+            try:
+                received = os.path.getsize(upload_part_file(upload_id))
+            except OSError:
+                received = 0
+        else:
+            received = size if status in ('done', 'duplicate') else 0
+        counts[status] += 1
+        files.append({"id": upload_id, "path": path, "size": size, "received": received, "status": status})
+
+    total = sum(f['size'] for f in files)
+    received = sum(f['received'] for f in files)
+    finished_at = max(row[4] for row in rows) if batch[2] == 'indexed' else time.time()
+    elapsed = max(finished_at - batch[1], 0.001)
+    return jsonify({
+        "batch_id": batch_id,
+        "status": batch[2],
+        "files": files,
+        "counts": dict(counts),
+        "total_bytes": total,
+        "received_bytes": received,
+        "progress": received / total if total else 1.0,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(received / elapsed),  # バイト/秒
+    })
+
+# メトリクスとリクエストのプロファイリング
+http_request_seconds = Histogram('music_http_request_seconds', 'Time to produce a response (streams: until the first byte)',
+                                 ['route', 'method'])
+http_requests_total = Counter('music_http_requests_total', 'HTTP requests', ['route', 'method', 'status'])
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # 設定するとログインなしで Bearer トークンで /metrics を取得できる
+
+Gauge('music_library_tracks', 'Tracks in the library index',
+      callback=lambda: sum(len(entry['files']) for entry in list(library_dirs.values())))
+Gauge('music_library_artists', 'Artists in the library index', callback=lambda: len(music_structure))
+Gauge('music_library_generation', 'Last applied library change', callback=lambda: library_generation)
+Gauge('music_background_owner', '1 if this process scans and watches the library', callback=lambda: int(background_owner))
+Gauge('music_structure_bytes', 'Size of the /music_structure payload',
+      callback=lambda: len(library_snapshot['body']) if library_snapshot else None)
+Counter('music_library_rescans_total', 'Library rescans', ['scope'],
+        callback=lambda: {('full',): library_stats['full_rescans'], ('subtree',): library_stats['subtree_rescans']})
+Counter('music_watchdog_events_total', 'File system events received', callback=lambda: library_events.stats['events_received'])
+Counter('music_watchdog_paths_total', 'Changed paths after coalescing', ['result'],
+        callback=lambda: {('applied',): library_events.stats['paths_applied'], ('skipped',): library_events.stats['paths_skipped']})
+Gauge('music_watchdog_pending_paths', 'Paths waiting for the quiet period', callback=lambda: len(library_events.pending))
+Counter('music_catalog_parsed_total', 'Tracks whose tags were read', callback=lambda: catalog_stats['parsed'])
+Gauge('music_catalog_pending', 'Tracks waiting for tag reading', callback=lambda: len(catalog_pending))
+Counter('music_fingerprints_total', 'Tracks fingerprinted', callback=lambda: fingerprint_stats['hashed'])
+Gauge('music_fingerprints_pending', 'Tracks waiting for fingerprinting', callback=lambda: len(fingerprint_pending))
+Gauge('music_search_index_terms', 'Terms in the search index', callback=lambda: len(search_index.postings))
+Counter('music_album_art_cache_total', 'Album art cache lookups and evictions', ['result'],
+        callback=lambda: {(key,): value for key, value in album_art_cache.stats.items()})
+Gauge('music_album_art_cache_bytes', 'Album art kept in memory', callback=lambda: album_art_cache.blob_bytes)
+Gauge('music_album_art_cache_entries', 'Album art images kept in memory', callback=lambda: len(album_art_cache.blobs))
+Gauge('music_play_events_buffered', 'Play events waiting to be written', callback=lambda: len(play_buffer))
+Counter('music_play_events_total', 'Play events recorded, written, dropped and compacted away', ['stage'],
+        callback=lambda: {(key,): value for key, value in play_stats.items() if key != 'flushes'})
+Counter('music_play_flushes_total', 'Play history batch writes', callback=lambda: play_stats['flushes'])
+Counter('music_stream_requests_total', 'Audio stream responses', callback=lambda: stream_stats['streams'])
+Counter('music_stream_bytes_total', 'Audio bytes sent (finished streams)', callback=lambda: stream_stats['bytes'])
+Gauge('music_active_streams', 'Audio streams being sent', callback=lambda: stream_stats['active'])
+Counter('music_transcode_total', 'Transcode cache hits, misses and encoder results', ['result'],
+        callback=lambda: {(key,): value for key, value in transcode_cache.stats.items() if key != 'active'})
+Gauge('music_active_transcodes', 'Encoders running', callback=lambda: transcode_cache.stats['active'])
+
+# 管理者が有効にすると、閾値より遅かったリクエストの cProfile を PROFILE_DIR に保存する。
+# 設定はファイルに置き、どのワーカーにも反映されるようにする
+PROFILE_DIR = os.path.join('cache', 'profiles')
+PROFILE_KEEP = 50  # 残しておくプロファイルの数
+profiling_settings = {"enabled": False, "threshold_ms": 500, "checked_at": 0.0}
+profiling_lock = threading.Lock()  # cProfile は同時に1つしか動かせないので、1リクエストずつ
+
+def load_profiling_settings():
+    now = time.monotonic()
+    if now - profiling_settings['checked_at'] < USER_CACHE_CHECK_SECONDS:
+        return profiling_settings
+    profiling_settings['checked_at'] = now
+    try:
+        with open(os.path.join(PROFILE_DIR, 'settings.json'), encoding='utf-8') as f:
+            profiling_settings.update(json.load(f))
+    except (OSError, ValueError):
+        profiling_settings['enabled'] = False
+    return profiling_settings
+
+def save_request_profile(profiler, elapsed):
+    import pstats
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(elapsed * 1000)}ms-{request.method}-" \
+           f"{''.join(c if c.isalnum() else '_' for c in route).strip('_')[:60]}.prof"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    with open(os.path.join(PROFILE_DIR, name[:-5] + '.txt'), 'w', encoding='utf-8') as f:
+        f.write(f"{request.method} {request.full_path} {elapsed * 1000:.1f}ms\n\n")
+        pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(40)
+    dumps = sorted(entry for entry in os.listdir(PROFILE_DIR) if entry.endswith(('.prof', '.txt')))
+    for old in dumps[:-PROFILE_KEEP * 2]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except OSError:
+            pass
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    settings = load_profiling_settings()
+    if settings['enabled'] and profiling_lock.acquire(blocking=False):
+        import cProfile
+        g.profiler = cProfile.Profile()
+        try:
+            g.profiler.enable()
+        except ValueError:  # 他のプロファイラが動いている
+            g.pop('profiler')
+            profiling_lock.release()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_request_seconds.observe(elapsed, route=route, method=request.method)
+    http_requests_total.inc(route=route, method=request.method, status=response.status_code)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profiling_lock.release()
+        if elapsed * 1000 >= profiling_settings['threshold_ms']:
+            try:
+                save_request_profile(profiler, elapsed)
+            except OSError as e:
+                print(f"Error saving profile: {e}")
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus 形式のメトリクス (管理者のみ)"""
+    authorized = METRICS_TOKEN and request.headers.get('Authorization') == f"Bearer {METRICS_TOKEN}"
+    if not authorized:
+        if 'user_id' not in session or not session_is_admin():
+            return jsonify({"error": "Unauthorized"}), 401
+
+    lines = []
+    for metric in metrics_registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            print(f"Error collecting metric {metric.name}: {e}")
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiling', methods=['GET', 'POST'])
+@admin_required
+def profiling():
+    """遅いリクエストのプロファイリングの設定 ({"enabled": true, "threshold_ms": 500}) と保存済みの一覧"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+        threshold_ms = data.get('threshold_ms', profiling_settings['threshold_ms'])
+        if not is_json_number(threshold_ms) or threshold_ms < 0:
+            # NaN を受け付けると比較が常に偽になり、黙ってプロファイリングが止まる
+            return jsonify({"error": "threshold_ms must be a finite number >= 0"}), 400
+        settings = {
+            "enabled": bool(data.get('enabled', profiling_settings['enabled'])),
+            "threshold_ms": float(threshold_ms),
+        }
+        with open(os.path.join(PROFILE_DIR, 'settings.json'), 'w', encoding='utf-8') as f:
+            json.dump(settings, f)
+        profiling_settings.update(settings, checked_at=time.monotonic())
+    dumps = sorted((entry for entry in os.listdir(PROFILE_DIR) if entry.endswith('.prof')), reverse=True)
+    return jsonify({
+        "enabled": profiling_settings['enabled'],
+        "threshold_ms": profiling_settings['threshold_ms'],
+        "profiles": dumps,
+    })
+
+@app.route('/api/profiling/<name>')
+@admin_required
+def download_profile(name):
+    """.prof (pstats 形式) または .txt (上位40関数) を返す"""
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=name.endswith('.prof'))
 
 # メインルート (ログイン必須)
 @app.route('/')
@@ -586,18 +4576,93 @@ def index():
         return redirect('/login')
     return send_from_directory('frontend', 'index.html')
 
-if __name__ == '__main__':
+# 起動処理
+SERVER_WORKERS = int(os.environ.get('WORKERS', 2))  # 本番モードのワーカープロセス数 (gunicorn のみ)
+SERVER_THREADS = int(os.environ.get('THREADS', 8))  # ワーカーごとのスレッド数
+LIBRARY_SYNC_SECONDS = float(os.environ.get('LIBRARY_SYNC_SECONDS', 2.0))  # 他のワーカーが書いた変更を取り込む間隔
 
-    # 初期設定
+owner_lock_file = None
 
-    save_music_structure_to_json(MUSIC_DIR)
+def acquire_background_owner():
+    """ロックファイルを取得できたプロセスが走査・フォルダ監視の担当になる"""
+    global owner_lock_file, background_owner
+    if background_owner:
+        return True
+    lock_file = open(LIBRARY_DB_FILE + '.owner.lock', 'a+')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    owner_lock_file = lock_file  # プロセスが終わるまで開いたままにする
+    background_owner = True
+    return True
+
+def start_background_tasks():
+    """フォルダ監視を始めてから、保存済みインデックスとディスクの照合をバックグラウンドで行う"""
+    start_watchdog()
+    threading.Thread(target=reconcile_library, name='library-reconcile', daemon=True).start()
 
+def init_app():
+    """DB・インデックス・管理者ユーザーを準備する。ロックを取れたプロセスだけがバックグラウンド処理を動かす"""
+    owner = acquire_background_owner()
+    init_library_db()
+    import_user_files()
     init_admin_user()
+    load_library_index()
+    if owner:
+        start_background_tasks()
+    # 担当プロセスも他のワーカーが書いた変更 (アップロード・タグ編集) を取り込む
+    threading.Thread(target=library_sync_worker, args=(LIBRARY_SYNC_SECONDS,),
+                     name='library-sync', daemon=True).start()
 
-    # フォルダ監視を開始（デバッグモードのリローダーによる二重起動を防止）
-    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not app.debug:
-        start_watchdog()
+def run_production(port):
+    """本番用サーバーで起動する (POSIX では gunicorn、Windows などでは waitress)"""
+    try:
+        if os.name == 'nt':
+            raise ImportError
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        from waitress import serve
+        init_app()
+        print(f"Starting waitress on port {port} ({SERVER_THREADS} threads)")
+        serve(app, host='0.0.0.0', port=port, threads=SERVER_THREADS)
+        return
 
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"0.0.0.0:{port}")
+            self.cfg.set('workers', SERVER_WORKERS)
+            self.cfg.set('threads', SERVER_THREADS)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', 0)  # 長い音声ストリームを切らない
+            # フォーク後に各ワーカーで初期化し、担当はロックを取れた1プロセスだけにする
+            self.cfg.set('post_worker_init', lambda worker: init_app())
+
+        def load(self):
+            return app
+
+    # スキーマの更新と管理者ユーザーの作成はフォーク前に1度だけ行う (ワーカーが同時に ALTER TABLE しないように)
+    init_library_db()
+    import_user_files()
+    init_admin_user()
+    print(f"Starting gunicorn on port {port} ({SERVER_WORKERS} workers x {SERVER_THREADS} threads)")
+    ProductionServer().run()
+
+if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
 
-    app.run(host="0.0.0.0", port=port, debug=True)
+    if '--production' in sys.argv[1:] or os.environ.get('SERVER_MODE') == 'production':
+        run_production(port)
+    else:
+        # 初期設定
+        # リローダーの親プロセスは子プロセスを起動し直すだけなので、初期化は子プロセスだけで行う（二重起動を防止）
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            init_app()
+
+        app.run(host="0.0.0.0", port=port, debug=True)
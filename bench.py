@@ -0,0 +1,373 @@
+# bench.py
+# 合成ライブラリを生成して、走査・検索・各APIの速度とメモリ使用量を測るベンチマーク
+#
+#   python bench.py --artists 50 --albums 4 --tracks 12 --output bench_results.json
+#   python bench.py --compare bench_results.json   # 前回の結果と比べる
+#
+# app は環境変数とカレントディレクトリから設定を読むので、作業ディレクトリを用意してから import する
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import zlib
+import argparse
+import tempfile
+import platform
+import subprocess
+import statistics
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 有効な MPEG-1 Layer III のフレーム (128kbps / 44.1kHz、中身は無音)
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\0' * 413
+
+
+def png_image(seed, size=8):
+    """seed ごとに色の違う小さな PNG を作る"""
+    r, g, b = (seed * 67) % 256, (seed * 131) % 256, (seed * 199) % 256
+    raw = b''.join(b'\0' + bytes((r, g, b)) * size for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw))
+            + chunk(b'IEND', b''))
+
+
+def write_track(path, title, artist, album, track_no, frames, art=None):
+    from mutagen.id3 import ID3, TIT2, TPE1, TALB, TRCK, TCON, APIC
+    # 1フレームごとに1バイト変えて、曲ごとに音声データ (指紋) が違うようにする
+    seed = zlib.crc32(path.encode('utf-8')) & 0xff
+    with open(path, 'wb') as f:
+        for i in range(frames):
+            f.write(MP3_FRAME[:4] + bytes(((seed + i) & 0xff,)) + MP3_FRAME[5:])
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=[title]))
+    tags.add(TPE1(encoding=3, text=[artist]))
+    tags.add(TALB(encoding=3, text=[album]))
+    tags.add(TRCK(encoding=3, text=[str(track_no)]))
+    tags.add(TCON(encoding=3, text=[random.choice(('Rock', 'Jazz', 'Pop', 'Classical'))]))
+    if art is not None:
+        tags.add(APIC(encoding=3, mime='image/png', type=3, desc='Cover', data=art))
+    tags.save(path)
+
+
+def generate_library(music_dir, artists, albums, tracks, frames):
+    """アーティスト × アルバム × 曲 の合成ライブラリを作り、曲の相対パスを返す"""
+    paths = []
+    for a in range(artists):
+        artist = f"Artist {a:04d}"
+        for b in range(albums):
+            album = f"Album {b:02d}"
+            album_dir = os.path.join(music_dir, artist, album)
+            os.makedirs(album_dir, exist_ok=True)
+            art = png_image(a * albums + b)
+            for t in range(tracks):
+                song = f"{t + 1:02d} Track {a}-{b}-{t}.mp3"
+                write_track(os.path.join(album_dir, song), f"Track {a}-{b}-{t}", artist, album, t + 1, frames,
+                            art if t == 0 else None)  # アルバムアートは各アルバムの1曲目だけに埋め込む
+                paths.append(f"{artist}/{album}/{song}")
+    return paths
+
+
+def synthetic_search_documents(app, count, seed=0):
+    """ファイルを作らずに検索インデックス用の文書を count 件作る (英単語風の語と日本語の語を混ぜる)"""
+    rng = random.Random(seed)
+    syllables = ['a', 'ka', 'lo', 've', 'mi', 'ra', 'to', 'shi', 'ne', 'ru', 'sun', 'star', 'night', 'light',
+                 'dream', 'sky', 'blue', 'heart', 'fire', 'rain', 'moon', 'love', 'l', 'el', 'in', 'on']
+    words = sorted({''.join(rng.choice(syllables) for _ in range(rng.randint(1, 3))) for _ in range(5000)})
+    kanji = '星空夜恋光夢雨月花風海愛心君僕桜雪青春歌道街涙声色'
+    kana = 'あいうえおかきくけこさしすせそたちつてとなにぬねのまみむめもらりるれろ'
+    jp_words = [''.join(rng.choice(kanji + kana) for _ in range(rng.randint(2, 5))) for _ in range(3000)]
+
+    def phrase(low, high):
+        return ' '.join(rng.choice(jp_words) if rng.random() < 0.3 else rng.choice(words)
+                        for _ in range(rng.randint(low, high)))
+
+    artists = [f"Artist {i}" if i % 3 == 0 else phrase(1, 2) for i in range(max(1, count // 25))]
+    documents = []
+    for i in range(count):
+        artist = artists[rng.randrange(len(artists))]
+        path = f"{artist}/{phrase(1, 3)}/{i % 20 + 1:02d} {phrase(1, 4)}.mp3"
+        documents.append((path, app.SearchIndex.document(path, None)))
+    return documents
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        "count": len(times),
+        "mean_ms": round(statistics.fmean(times) * 1000, 3),
+        "p50_ms": round(times[len(times) // 2] * 1000, 3),
+        "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))] * 1000, 3),
+        "max_ms": round(times[-1] * 1000, 3),
+    }
+
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return time.perf_counter() - started, result
+
+
+def measure(func, iterations):
+    times = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - started)
+    return summarize(times)
+
+
+def max_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024  # Linux は KB 単位
+
+
+def wait_for(condition, timeout):
+    started = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - started > timeout:
+            return None
+        time.sleep(0.01)
+    return time.perf_counter() - started
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args, work_dir):
+    results = {}
+    music_dir = os.path.join(work_dir, 'music')
+
+    elapsed, paths = timed(lambda: generate_library(music_dir, args.artists, args.albums, args.tracks, args.frames))
+    results['generate'] = {"seconds": round(elapsed, 3), "tracks": len(paths),
+                           "bytes": sum(os.path.getsize(os.path.join(music_dir, p)) for p in paths)}
+
+    # app の設定は import 時に読まれる
+    os.chdir(work_dir)
+    os.environ.update({
+        'MUSIC_DIR': music_dir,
+        'LIBRARY_DB_FILE': os.path.join(work_dir, 'library.db'),
+        'ALBUM_ART_CACHE_DIR': os.path.join(work_dir, 'cache', 'album_art'),
+        'TRANSCODE_CACHE_DIR': os.path.join(work_dir, 'cache', 'transcode'),
+    })
+    sys.path.insert(0, REPO_DIR)
+    import app
+
+    app.init_library_db()
+    app.init_admin_user()
+    app.background_owner = True  # タグ読み取りと指紋計算も動かす (フォルダ監視は起動しない)
+
+    # 走査
+    elapsed, _ = timed(app.rebuild_library)
+    results['scan_cold'] = {"seconds": round(elapsed, 3)}
+    catalog_wait = wait_for(lambda: not app.catalog_pending and app.catalog_stats['parsed'] >= len(paths), 600)
+    fingerprint_wait = wait_for(lambda: not app.fingerprint_pending and app.fingerprint_stats['hashed'] >= len(paths), 600)
+    results['catalog'] = {"seconds_after_scan": round(catalog_wait, 3) if catalog_wait is not None else None,
+                          "parsed": app.catalog_stats['parsed'], "errors": app.catalog_stats['errors']}
+    results['fingerprints'] = {"seconds_after_catalog": round(fingerprint_wait, 3) if fingerprint_wait is not None else None,
+                               "hashed": app.fingerprint_stats['hashed']}
+    elapsed, _ = timed(app.rebuild_library)
+    results['scan_unchanged'] = {"seconds": round(elapsed, 3)}
+
+    tracemalloc.start()
+    elapsed, _ = timed(app.load_library_index)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results['index_load'] = {"seconds": round(elapsed, 3), "python_bytes": current, "python_peak_bytes": peak}
+    elapsed, _ = timed(app.reconcile_library)
+    results['reconcile_unchanged'] = {"seconds": round(elapsed, 3)}
+
+    # N 曲を変更・追加・削除したあとの部分更新
+    rng = random.Random(0)
+    changed = rng.sample(paths, min(args.changes, len(paths)))
+    for rel_path in changed:
+        with open(os.path.join(music_dir, rel_path), 'ab') as f:
+            f.write(MP3_FRAME)
+    elapsed, changes = timed(lambda: app.update_library([os.path.join(music_dir, p) for p in changed]))
+    results['update_modified'] = {"seconds": round(elapsed, 3), "paths": len(changed), "modified": len(changes['modified'])}
+
+    new_dir = os.path.join(music_dir, 'Bench New Artist', 'Bench New Album')
+    os.makedirs(new_dir)
+    added = []
+    for i in range(args.changes):
+        added.append(os.path.join(new_dir, f"{i:03d} New.mp3"))
+        write_track(added[-1], f"New {i}", 'Bench New Artist', 'Bench New Album', i + 1, args.frames)
+    elapsed, changes = timed(lambda: app.update_library(added))
+    results['update_added'] = {"seconds": round(elapsed, 3), "paths": len(added), "added": len(changes['added'])}
+    shutil.rmtree(os.path.join(music_dir, 'Bench New Artist'))
+    elapsed, changes = timed(lambda: app.update_library(added))
+    results['update_removed'] = {"seconds": round(elapsed, 3), "paths": len(added), "removed": len(changes['removed'])}
+    # MUSIC_DIR 自体のイベント (全体の再走査になる)
+    elapsed, changes = timed(lambda: app.update_library([music_dir]))
+    results['update_root'] = {"seconds": round(elapsed, 3), "changed": sum(len(v) for v in changes.values())}
+    wait_for(lambda: not app.catalog_pending and not app.fingerprint_pending, 600)
+
+    # HTTP API (テストクライアント経由)
+    client = app.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = app.ADMIN_USERNAME
+    n = args.iterations
+
+    response = client.get('/music_structure')
+    gzipped = client.get('/music_structure', headers={'Accept-Encoding': 'gzip'})
+    etag = response.headers.get('ETag')
+    results['music_structure'] = {
+        "bytes": len(response.data),
+        "gzip_bytes": len(gzipped.data),
+        "full": measure(lambda i: client.get('/music_structure').data, n),
+        "gzip": measure(lambda i: client.get('/music_structure', headers={'Accept-Encoding': 'gzip'}).data, n),
+        "not_modified": measure(lambda i: client.get('/music_structure', headers={'If-None-Match': etag}), n),
+    }
+
+    artists = sorted({p.split('/')[0] for p in paths})
+    results['library_views'] = {
+        "artists": measure(lambda i: client.get('/api/library/artists?limit=200').data, n),
+        "albums": measure(lambda i: client.get('/api/library/albums', query_string={'artist': artists[i % len(artists)]}).data, n),
+        "tracks": measure(lambda i: client.get('/api/library/tracks', query_string={
+            'artist': artists[i % len(artists)], 'album': 'Album 00'}).data, n),
+        "albums_recent_page": measure(lambda i: client.get('/api/library/albums?sort=added&limit=100').data, n),
+        "tracks_recent_page": measure(lambda i: client.get('/api/library/tracks?sort=added&limit=100').data, n),
+    }
+
+    wait_for(lambda: app.smart_index.ready, 60)
+    results['smart_playlists'] = {
+        "recently_added": measure(lambda i: client.get('/api/smart-playlists/recently-added').data, n),
+        "artist_random": measure(lambda i: client.post('/api/smart-playlists/preview', json={'rules': {
+            'artist': artists[i % len(artists)], 'sort': 'random', 'limit': 50, 'seed': i}}).data, n),
+    }
+
+    songs = [p.rsplit('/', 1)[1] for p in paths]
+    results['song_lookup'] = {
+        "by_name": measure(lambda i: client.get(f"/get-song-data/{songs[rng.randrange(len(songs))]}").data, n),
+        "by_path": measure(lambda i: client.get(f"/get-song-data/{paths[rng.randrange(len(paths))]}").data, n),
+        "batch_50": measure(lambda i: client.post('/api/song-data', json={'songs': rng.sample(paths, min(50, len(paths)))}).data,
+                            max(1, n // 10)),
+        "search": measure(lambda i: client.get('/api/search', query_string={'q': f"track {i % args.artists}"}).data, n),
+    }
+
+    first_tracks = [p for p in paths if p.rsplit('/', 1)[1].startswith('01 ')]
+    art_cold = first_tracks[:n]
+    art_etag = client.get(f"/api/album-art/{art_cold[0]}").headers.get('ETag', '')
+    results['album_art'] = {
+        "cold": measure(lambda i: client.get(f"/api/album-art/{art_cold[i]}").data, len(art_cold)),
+        "warm": measure(lambda i: client.get(f"/api/album-art/{art_cold[i % len(art_cold)]}").data, n),
+        "thumbnail_64": measure(lambda i: client.get(f"/api/album-art/{art_cold[i % len(art_cold)]}?size=64").data, n),
+        "not_modified": measure(lambda i: client.get(f"/api/album-art/{art_cold[0]}", headers={'If-None-Match': art_etag}), n),
+    }
+
+    results['stream'] = {
+        "range_64k": measure(lambda i: client.get(f"/music/{paths[i % len(paths)]}", headers={'Range': 'bytes=0-65535'}).data, n),
+    }
+
+    items = [{"artist": p.split('/')[0], "album": p.split('/')[1], "song": p.split('/')[2]}
+             for p in rng.sample(paths, min(args.playlist_size, len(paths)))]
+    results['playlists'] = {
+        "save": measure(lambda i: client.post('/save_playlist', json={'name': f"bench {i % 20}", 'items': items}).data, n),
+        "list": measure(lambda i: client.get('/playlists').data, n),
+        "load": measure(lambda i: client.get(f"/playlist/bench {i % 20}").data, n),
+    }
+
+    if args.search_docs:
+        # 大きなライブラリでの検索 (ファイルは作らず、インデックスだけを合成した文書で作る)
+        documents = synthetic_search_documents(app, args.search_docs)
+        index = app.SearchIndex()
+        elapsed, _ = timed(lambda: index.rebuild(documents))
+        queries = ['a', 'l', 'love', 'artist', 'artist love 12', 'star night', '星', '星空', 'あい', 'zzz']
+        results['search_index'] = {
+            "documents": len(documents),
+            "terms": len(index.terms),
+            "rebuild_seconds": round(elapsed, 3),
+            "queries": {query: measure(lambda i: index.search(query), max(1, n // 10)) for query in queries},
+        }
+        del documents, index
+
+    results['memory'] = {"max_rss_bytes": max_rss_bytes()}
+    return results
+
+
+def compare(old, new, prefix=''):
+    """数値ごとに前回の結果との比 (new / old) を表示する"""
+    for key, value in new.items():
+        name = f"{prefix}{key}"
+        previous = old.get(key) if isinstance(old, dict) else None
+        if isinstance(value, dict):
+            compare(previous or {}, value, name + '.')
+        elif isinstance(value, (int, float)) and isinstance(previous, (int, float)) and previous:
+            ratio = value / previous
+            marker = '  <-- slower/larger' if ratio > 1.2 and key.endswith(('_ms', 'seconds', 'bytes')) else ''
+            print(f"{name:60} {previous:>14} -> {value:>14}  x{ratio:.2f}{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='home-music-stream benchmark')
+    parser.add_argument('--artists', type=int, default=20)
+    parser.add_argument('--albums', type=int, default=5, help='albums per artist')
+    parser.add_argument('--tracks', type=int, default=10, help='tracks per album')
+    parser.add_argument('--frames', type=int, default=40, help='MP3 frames per track (1 frame = 26ms)')
+    parser.add_argument('--changes', type=int, default=20, help='files modified / added for the incremental update')
+    parser.add_argument('--iterations', type=int, default=100, help='requests per API measurement')
+    parser.add_argument('--playlist-size', type=int, default=200)
+    parser.add_argument('--search-docs', type=int, default=500000,
+                        help='synthetic documents for the large search index measurement (0 to skip)')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='previous result file to compare against')
+    parser.add_argument('--work-dir', help='keep the generated library in this directory')
+    args = parser.parse_args()
+
+    random.seed(0)
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='music-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    output = os.path.abspath(args.output)
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+
+    try:
+        results = run_benchmarks(args, work_dir)
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'work_dir')},
+        },
+        "results": results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    print(f"Results written to {output}")
+    if previous is not None:
+        print(f"\nCompared with {args.compare} ({previous['meta'].get('revision')}):")
+        compare(previous['results'], results)
+    sys.stdout.flush()
+    os._exit(0)  # バックグラウンドのスレッドを待たずに終了する
+
+
+if __name__ == '__main__':
+    main()